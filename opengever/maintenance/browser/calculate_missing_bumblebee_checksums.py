@@ -1,5 +1,9 @@
+from multiprocessing.pool import ThreadPool
+from opengever.maintenance.parallel import chunked
 from plone import api
 from Products.Five.browser import BrowserView
+from ZODB.POSException import POSKeyError
+from ZODB.interfaces import BlobError
 import transaction
 
 
@@ -11,6 +15,11 @@ except ImportError:
     BUMBLEBEE_AVAILABLE = False
 
 
+BATCH_SIZE = 500
+PREFETCH_THREADS = 4
+PREFETCH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
 class CaluclateMissingBumblebeeChecksumsView(BrowserView):
     """
     Calculates Bumblebee checksums for documents that are missing them, and
@@ -26,12 +35,23 @@ class CaluclateMissingBumblebeeChecksumsView(BrowserView):
 
     /@@calculate-missing-bumblebee-checksums?run=true
     (Actually perform the work)
+
+    /@@calculate-missing-bumblebee-checksums?run=true&batch_size=1000
+    (Commit every 1000 documents instead of every 500)
     """
 
     def __call__(self):
         if not BUMBLEBEE_AVAILABLE:
             return "Bumblebee not available."
 
+        try:
+            batch_size = int(self.request.form.get('batch_size', BATCH_SIZE))
+        except ValueError:
+            batch_size = 0
+        if batch_size < 1:
+            self.request.response.setStatus(400)
+            return "Invalid batch_size, it has to be a positive number."
+
         run = bool(self.request.form.get('run'))
         dryrun = not run
 
@@ -39,20 +59,52 @@ class CaluclateMissingBumblebeeChecksumsView(BrowserView):
             print 'dryrun ...'
             transaction.doom()
 
-        calculate_missing_bumblebee_checksums(dryrun)
-
-        if not dryrun:
-            transaction.get().note(
-                "Calculate Bumblebee checksums for docs that were "
-                "missing them.")
-            transaction.commit()
+        calculate_missing_bumblebee_checksums(dryrun, batch_size=batch_size)
 
         return "All done (dryrun=%r)" % dryrun
 
 
-def calculate_missing_bumblebee_checksums(dryrun):
-    affected = get_affected_docs()
-    for doc in affected:
+def calculate_missing_bumblebee_checksums(dryrun, batch_size=BATCH_SIZE,
+                                          prefetch_threads=PREFETCH_THREADS):
+    """Calculate and store checksums for all affected documents.
+
+    Affected documents are streamed in batches. While a batch is being
+    processed, the blob files of the next batch are already read from disk
+    by a pool of threads, so that calculating the checksum mostly hits the
+    OS page cache instead of waiting for (network) storage. Unless this is a
+    dryrun, every batch is committed.
+
+    Only the blob reads are done in parallel. Checksums are still calculated
+    one document at a time by Bumblebee itself (`_handle_update`), which also
+    queues the storing of every document in Bumblebee separately.
+    """
+    pool = ThreadPool(prefetch_threads)
+    prefetching = None
+    processed = 0
+
+    try:
+        for batch in chunked(get_affected_docs(), batch_size):
+            # Start reading this batch's blobs, then process the previous one
+            # while they are being read.
+            upcoming = pool.map_async(prefetch_blob, blob_filenames(batch))
+            if prefetching is not None:
+                processed += process_batch(prefetching, dryrun)
+            prefetching = (batch, upcoming)
+
+        if prefetching is not None:
+            processed += process_batch(prefetching, dryrun)
+    finally:
+        pool.close()
+        pool.join()
+
+    print "Done. Processed %s documents." % processed
+
+
+def process_batch(prefetching, dryrun):
+    batch, prefetched = prefetching
+    prefetched.wait()
+
+    for doc in batch:
         url = doc.absolute_url()
         print "Affected: %s" % url
 
@@ -63,10 +115,52 @@ def calculate_missing_bumblebee_checksums(dryrun):
             # otherwise storing of the document *should* actually be skipped
             IBumblebeeDocument(doc)._handle_update(force=False)
 
+    if not dryrun:
+        transaction.get().note(
+            "Calculate Bumblebee checksums for docs that were "
+            "missing them.")
+        transaction.commit()
+        print "Intermediate commit after %s documents." % len(batch)
+
+    return len(batch)
+
+
+def blob_filenames(docs):
+    """Filenames of the committed blob files of the given documents.
+
+    This has to happen in the main thread, persistent objects must not be
+    accessed from the prefetching threads.
+    """
+    filenames = []
+    for doc in docs:
+        blob = getattr(doc.file, '_blob', None)
+        if blob is None:
+            continue
+        try:
+            filenames.append(blob.committed())
+        except (BlobError, POSKeyError):
+            continue
+    return filenames
+
+
+def prefetch_blob(filename):
+    """Read a blob file in large chunks, so it ends up in the page cache.
+    """
+    try:
+        with open(filename, 'rb') as blob_file:
+            while blob_file.read(PREFETCH_CHUNK_SIZE):
+                pass
+    except IOError:
+        pass
+
 
 def get_affected_docs():
+    """Yield documents missing their checksum.
+
+    Candidates are determined using the `bumblebee_checksum` metadata, only
+    those are actually loaded.
+    """
     print "Gathering affected documents..."
-    affected = []
 
     catalog = api.portal.get_tool('portal_catalog')
     brains = catalog.unrestrictedSearchResults(
@@ -86,7 +180,4 @@ def get_affected_docs():
             # Only consider documents that actually have a file
             continue
 
-        affected.append(doc)
-
-    print "Done."
-    return affected
+        yield doc
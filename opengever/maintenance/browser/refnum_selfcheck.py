@@ -1,5 +1,6 @@
 from Acquisition import aq_inner
 from Acquisition import aq_parent
+from collections import defaultdict
 from opengever.base.interfaces import IReferenceNumber
 from opengever.base.interfaces import IReferenceNumberPrefix
 from opengever.dossier.behaviors.dossier import IDossierMarker
@@ -15,6 +16,7 @@ from zope.app.intid.interfaces import IIntIds
 from zope.component import getAdapter
 from zope.component import getUtility
 from zope.component import queryAdapter
+import json
 import transaction
 
 
@@ -43,6 +45,15 @@ except ImportError:
 
 class RefnumSelfcheckView(BrowserView):
     """A view to run self-checks on reference numbers.
+
+    Request parameters:
+
+    format=json         Return the structured report as JSON instead of
+                        the log
+    trust_metadata=1    Take the reference numbers from the catalog
+                        metadata instead of the objects (skips
+                        check_if_index_equals_objdata)
+    checks=<a,b,...>    Only run the given checks
     """
 
     def log(self, msg):
@@ -51,9 +62,24 @@ class RefnumSelfcheckView(BrowserView):
     def __call__(self):
         transaction.doom()
 
+        form = self.request.form
+        as_json = form.get('format') == 'json'
+        checks = None
+        if form.get('checks'):
+            checks = form.get('checks').split(',')
+
         site = self.context
-        checker = ReferenceNumberChecker(self.log, site)
-        checker.selfcheck()
+        log_func = self.log
+        if as_json:
+            log_func = lambda msg: None
+
+        checker = ReferenceNumberChecker(
+            log_func, site, trust_metadata=bool(form.get('trust_metadata')))
+        checker.selfcheck(checks)
+
+        if as_json:
+            self.request.response.setHeader('Content-Type', 'application/json')
+            return json.dumps(checker.report, indent=2, sort_keys=True)
 
 
 class ReferenceNumberHelper(object):
@@ -97,175 +123,282 @@ class ReferenceNumberHelper(object):
         return mapping
 
 
+class RefnumRecord(object):
+    """A dossier or repository folder visited by the selfcheck. The object
+    and its reference number are loaded at most once, and only if a check
+    asks for them.
+    """
+
+    def __init__(self, brain, is_dossier, is_template):
+        self.brain = brain
+        self.is_dossier = is_dossier
+        self.is_template = is_template
+        self.path = brain.getPath()
+        self.id = self.path.split('/')[-1]
+        self._obj = None
+        self._obj_refnum = None
+
+    @property
+    def url(self):
+        return self.brain.getURL()
+
+    @property
+    def metadata_refnum(self):
+        return getattr(self.brain, 'reference', None)
+
+    @property
+    def obj(self):
+        if self._obj is None:
+            self._obj = self.brain.getObject()
+        return self._obj
+
+    @property
+    def obj_refnum(self):
+        if self._obj_refnum is None:
+            self._obj_refnum = getAdapter(
+                self.obj, IReferenceNumber).get_number()
+        return self._obj_refnum
+
+    @property
+    def is_loaded(self):
+        return self._obj is not None
+
+
 class ReferenceNumberChecker(object):
     """Various checks to validate reference number integrity.
+
+    All checks are run in a single pass over the dossiers and repository
+    folders: every object is loaded at most once and its reference number
+    computed once, then it's handed to all checks. With `trust_metadata`,
+    reference numbers are taken from the `reference` catalog metadata, so
+    objects are only loaded for the mapping checks (the comparison between
+    metadata and object, `check_if_index_equals_objdata`, is skipped).
+
+    With `path` (a catalog path query) only the dossiers and repository
+    folders matching it are checked.
+
+    Besides logging, the results and all problems found are collected in
+    `report`.
     """
 
-    def __init__(self, log_func, site):
+    checks = ('check_if_dossier_refnums_are_complete',
+              'check_for_duplicate_refnums',
+              'check_if_index_equals_objdata',
+              'check_if_in_proper_mappings',
+              'check_if_mappings_are_persistent')
+
+    def __init__(self, log_func, site, trust_metadata=False, path=None):
         self.parent_logger = log_func
         self.site = site
+        self.trust_metadata = trust_metadata
+        self.path = path
         self.helper = ReferenceNumberHelper(log_func, site)
         self.intids = getUtility(IIntIds)
         self.ignored_ids = ['vorlagen']
+        self._separator = None
+        self.report = None
+        self.paths_by_refnum = None
 
     def log(self, msg):
         msg = "    " + msg
         return self.parent_logger(msg)
 
-    def selfcheck(self):
-        self.log("Running reference number self-checks...")
-
-        checks = ('check_if_dossier_refnums_are_complete',
-                  'check_for_duplicate_refnums',
-                  'check_if_index_equals_objdata',
-                  'check_if_in_proper_mappings',
-                  'check_if_mappings_are_persistent')
+    def selfcheck(self, checks=None):
+        """Run the given checks (by default all of them) and return their
+        results, a dict check name -> 'PASSED' / 'FAILED' / 'SKIPPED'.
+        """
+        if checks is None:
+            checks = self.checks
+        unknown = set(checks) - set(self.checks)
+        if unknown:
+            raise ValueError("Unknown checks: %s" % ', '.join(sorted(unknown)))
 
-        results = {}
-        for checkname in checks:
-            self.log("Running '{}'...".format(checkname))
-            result = getattr(self, checkname)()
-            self.log("Done {}: {}".format(checkname, result))
-            results[checkname] = result
+        self.log("Running reference number self-checks...")
 
+        self.report = {
+            'results': dict((checkname, 'PASSED') for checkname in checks),
+            'problems': dict((checkname, []) for checkname in checks),
+            'objects': 0,
+            'objects_loaded': 0,
+            'trust_metadata': self.trust_metadata,
+        }
+        if self.trust_metadata and 'check_if_index_equals_objdata' in checks:
+            self.report['results']['check_if_index_equals_objdata'] = 'SKIPPED'
+            checks = [checkname for checkname in checks
+                      if checkname != 'check_if_index_equals_objdata']
+
+        self.paths_by_refnum = defaultdict(list)
+        for record in self.iter_records():
+            self.report['objects'] += 1
+            for checkname in checks:
+                getattr(self, '_' + checkname)(record)
+            if record.is_loaded:
+                self.report['objects_loaded'] += 1
+
+        if 'check_for_duplicate_refnums' in checks:
+            self.report_duplicate_refnums()
+
+        results = self.report['results']
+        for checkname in self.checks:
+            if checkname in results:
+                self.log("Done {}: {}".format(checkname, results[checkname]))
         return results
 
-    def check_if_dossier_refnums_are_complete(self):
-        check_result = 'PASSED'
+    def iter_records(self):
         catalog = self.site.portal_catalog
-        dossier_brains = catalog(object_provides=IDossierMarker.__identifier__)
+        query = {}
+        if self.path is not None:
+            query['path'] = self.path
+
+        template_paths = set(
+            brain.getPath() for brain in
+            catalog(object_provides=ITemplateDossier.__identifier__, **query))
 
+        dossier_brains = catalog(object_provides=IDossierMarker.__identifier__,
+                                 **query)
         for brain in dossier_brains:
-            dossier = brain.getObject()
-            sep = self.helper.get_repo_dossier_separator(obj=dossier)
-            url = dossier.absolute_url()
+            yield RefnumRecord(
+                brain, True, brain.getPath() in template_paths)
 
-            if dossier.id in self.ignored_ids:
-                continue
-            if ITemplateDossier.providedBy(dossier):
-                continue
+        repo_brains = catalog(object_provides=IRepositoryFolder.__identifier__,
+                              **query)
+        for brain in repo_brains:
+            yield RefnumRecord(brain, False, False)
 
-            refNumb = getAdapter(dossier, IReferenceNumber)
-            obj_refnum = refNumb.get_number()
-            refnum_parts = obj_refnum.split(sep)
-            if '/desktop/' in url:
-                # Dossiers in Desktop position have a custom reference number
-                continue
+    def fail(self, checkname, msg, **details):
+        """Mark `checkname` as failed and record a problem.
+        """
+        self.report['results'][checkname] = 'FAILED'
+        details['message'] = msg
+        self.report['problems'][checkname].append(details)
+        self.log("WARNING: %s" % msg)
+
+    def get_refnum(self, record):
+        """The reference number of a record, from the catalog metadata when
+        trusting it (and it isn't empty), otherwise from the object.
+        """
+        if self.trust_metadata and record.metadata_refnum:
+            return record.metadata_refnum
+        return record.obj_refnum
 
-            if not len(refnum_parts) == 2:
-                check_result = 'FAILED'
-                self.log("WARNING: Something's wrong with "
-                         "refnum '%s' for object '%s'"
-                    % (obj_refnum, url))
-                continue
+    def get_separator(self):
+        if self._separator is None:
+            self._separator = self.helper.get_repo_dossier_separator(
+                obj=self.site)
+        return self._separator
 
-            right_part = refnum_parts[1].strip()
-            left_part = refnum_parts[0].strip()
-            if right_part.endswith('.') or right_part.startswith('.') \
+    def check_if_dossier_refnums_are_complete(self):
+        return self.selfcheck(
+            ['check_if_dossier_refnums_are_complete'])[
+                'check_if_dossier_refnums_are_complete']
+
+    def _check_if_dossier_refnums_are_complete(self, record):
+        checkname = 'check_if_dossier_refnums_are_complete'
+        if not record.is_dossier or record.is_template:
+            return
+        if record.id in self.ignored_ids:
+            return
+        if '/desktop/' in record.path:
+            # Dossiers in Desktop position have a custom reference number
+            return
+
+        obj_refnum = self.get_refnum(record)
+        refnum_parts = obj_refnum.split(self.get_separator())
+        if not len(refnum_parts) == 2:
+            self.fail(checkname,
+                      "Something's wrong with refnum '%s' for object '%s'"
+                      % (obj_refnum, record.url),
+                      path=record.path, refnum=obj_refnum)
+            return
+
+        right_part = refnum_parts[1].strip()
+        left_part = refnum_parts[0].strip()
+        if right_part.endswith('.') or right_part.startswith('.') \
                 or left_part.endswith('.') or left_part.startswith('.'):
-                check_result = 'FAILED'
-                self.log("WARNING: refnum '%s' for object '%s' is "
-                         "incomplete!" % (obj_refnum, url))
-                continue
-
-        return check_result
+            self.fail(checkname,
+                      "refnum '%s' for object '%s' is incomplete!"
+                      % (obj_refnum, record.url),
+                      path=record.path, refnum=obj_refnum)
 
     def check_for_duplicate_refnums(self):
-        check_result = 'PASSED'
-        all_refnums = dict()
-
-        catalog = self.site.portal_catalog
-
-        dossier_brains = catalog(object_provides=IDossierMarker.__identifier__)
-        repo_brains = catalog(object_provides=IRepositoryFolder.__identifier__)
+        return self.selfcheck(
+            ['check_for_duplicate_refnums'])['check_for_duplicate_refnums']
 
-        all_brains = []
-        all_brains.extend(dossier_brains)
-        all_brains.extend(repo_brains)
+    def _check_for_duplicate_refnums(self, record):
+        if '/desktop/' in record.path:
+            # Dossiers in Desktop position have a custom reference number
+            return
 
-        for brain in all_brains:
-            obj = brain.getObject()
-            obj_path = '/'.join(obj.getPhysicalPath())
+        reporoot_prefix = '/'.join(record.path.split('/')[:3])
+        key = (reporoot_prefix, self.get_refnum(record))
+        self.paths_by_refnum[key].append(record.path)
 
-            if '/desktop/' in obj_path:
-                # Dossiers in Desktop position have a custom reference number
+    def report_duplicate_refnums(self):
+        """Report every (reporoot prefix, refnum) that is used by more than
+        one object.
+        """
+        checkname = 'check_for_duplicate_refnums'
+        for (reporoot_prefix, obj_refnum), paths in sorted(
+                self.paths_by_refnum.items()):
+            if len(paths) < 2:
                 continue
 
-            reporoot_prefix = '/'.join(obj_path.split('/')[:3])
-
-            refNumb = getAdapter(obj, IReferenceNumber)
-            obj_refnum = refNumb.get_number()
-
-            if obj_refnum in all_refnums.values():
-                dups = [path for path, rn in all_refnums.items()
-                        if obj_refnum == rn]
-                dups = filter(lambda path: path.startswith(
-                    reporoot_prefix), dups)
-                if dups:
-                    check_result = 'FAILED'
-                    self.log("WARNING: Reference Number for object "
-                             "'%s' is a duplicate!" % obj.id)
-                    self.log("Object: %s" % obj.absolute_url())
-                    self.log("RefNum: %s" % obj_refnum)
-                    self.log("Duplicates:")
-                    for dup in dups:
-                        self.log(dup)
-                    self.log("")
-
-            all_refnums[obj_path] = obj_refnum
-        return check_result
+            self.fail(checkname,
+                      "Reference Number '%s' is used by %s objects in '%s'!"
+                      % (obj_refnum, len(paths), reporoot_prefix),
+                      refnum=obj_refnum, paths=paths)
+            self.log("Duplicates:")
+            for path in paths:
+                self.log(path)
+            self.log("")
 
     def check_if_index_equals_objdata(self):
-        check_result = 'PASSED'
-        catalog = self.site.portal_catalog
-        dossier_brains = catalog(object_provides=IDossierMarker.__identifier__)
-
-        for brain in dossier_brains:
-            dossier = brain.getObject()
-
-            if dossier.absolute_url().endswith('vorlagen'):
-                continue
-
-            refNumb = getAdapter(dossier, IReferenceNumber)
-            obj_refnum = refNumb.get_number()
-
-            if not brain.reference == obj_refnum:
-                check_result = 'FAILED'
-                self.log("WARNING: ReferenceNumber for Dossier '%s' differs "
-                    "from value in catalog metadata!" % dossier.absolute_url())
-                msg_objvalue = ("Object: %s" % obj_refnum).ljust(40)
-                msg_idxvalue = ("Metadata: %s" % brain.reference).ljust(40)
-                self.log("%s %s" % (msg_objvalue, msg_idxvalue))
-                self.log("")
-        return check_result
+        return self.selfcheck(
+            ['check_if_index_equals_objdata'])['check_if_index_equals_objdata']
+
+    def _check_if_index_equals_objdata(self, record):
+        if not record.is_dossier or record.id == 'vorlagen':
+            return
+
+        if not record.metadata_refnum == record.obj_refnum:
+            self.fail('check_if_index_equals_objdata',
+                      "ReferenceNumber for Dossier '%s' differs from value in "
+                      "catalog metadata!" % record.url,
+                      path=record.path, object=record.obj_refnum,
+                      metadata=record.metadata_refnum)
+            msg_objvalue = ("Object: %s" % record.obj_refnum).ljust(40)
+            msg_idxvalue = ("Metadata: %s" % record.metadata_refnum).ljust(40)
+            self.log("%s %s" % (msg_objvalue, msg_idxvalue))
+            self.log("")
 
     def _check_if_in_new_mappings(self, obj):
         """Check whether `obj` is in both new-style mappings of its parent.
         """
-        check_result = 'PASSED'
+        checkname = 'check_if_in_proper_mappings'
+        path = '/'.join(obj.getPhysicalPath())
         parent = aq_parent(aq_inner(obj))
         local_number = IReferenceNumberPrefix(parent).get_number(obj)
         intid = self.intids.getId(obj)
         try:
             child_mapping = self.helper.get_new_mapping(CHILD_REF_KEY, obj)
             if not child_mapping[local_number] == intid:
-                check_result = 'FAILED'
-                self.log("WARNING: obj %s not in child mapping of parent!" % obj)
+                self.fail(checkname,
+                          "obj %s not in child mapping of parent!" % obj,
+                          path=path)
 
             prefix_mapping = self.helper.get_new_mapping(PREFIX_REF_KEY, obj)
             if not prefix_mapping[intid] == local_number:
-                check_result = 'FAILED'
-                self.log("WARNING: obj %s not in prefix mapping of parent!" % obj)
+                self.fail(checkname,
+                          "obj %s not in prefix mapping of parent!" % obj,
+                          path=path)
         except Exception, e:
-            check_result = 'FAILED'
-            self.log("WARNING: '%s' for %s" % (e, obj))
-
-        return check_result
+            self.fail(checkname, "'%s' for %s" % (e, obj), path=path)
 
     def _check_if_in_old_mappings(self, obj):
         """Check whether `obj` is in both old-style mappings of its parent.
         """
-        check_result = 'PASSED'
+        checkname = 'check_if_in_proper_mappings'
+        path = '/'.join(obj.getPhysicalPath())
         parent = aq_parent(aq_inner(obj))
         local_number = IReferenceNumberPrefix(parent).get_number(obj)
         intid = self.intids.getId(obj)
@@ -274,81 +407,61 @@ class ReferenceNumberChecker(object):
         try:
             child_mapping = ann.get(CHILD_REF_KEY)
             if not child_mapping[local_number] == intid:
-                check_result = 'FAILED'
-                self.log("WARNING: obj %s not in child mapping of parent!" % obj)
+                self.fail(checkname,
+                          "obj %s not in child mapping of parent!" % obj,
+                          path=path)
 
             prefix_mapping = ann.get(PREFIX_REF_KEY)
             if not prefix_mapping[intid] == local_number:
-                check_result = 'FAILED'
-                self.log("WARNING: obj %s not in prefix mapping of parent!" % obj)
+                self.fail(checkname,
+                          "obj %s not in prefix mapping of parent!" % obj,
+                          path=path)
         except Exception, e:
-            check_result = 'FAILED'
-            self.log("WARNING: '%s' for %s" % (e, obj))
-
-        return check_result
+            self.fail(checkname, "'%s' for %s" % (e, obj), path=path)
 
     def check_if_in_proper_mappings(self):
-        check_result = 'PASSED'
-        catalog = self.site.portal_catalog
-
-        dossier_brains = catalog(object_provides=IDossierMarker.__identifier__)
-        repo_brains = catalog(object_provides=IRepositoryFolder.__identifier__)
+        return self.selfcheck(
+            ['check_if_in_proper_mappings'])['check_if_in_proper_mappings']
 
-        all_brains = []
-        all_brains.extend(dossier_brains)
-        all_brains.extend(repo_brains)
+    def _check_if_in_proper_mappings(self, record):
+        # Skip ignored objects
+        if record.id in self.ignored_ids \
+                or record.brain.portal_type == 'opengever.phvs.homefolder':
+            return
 
-        for brain in all_brains:
-            obj = brain.getObject()
-
-            # Skip ignored objects
-            if obj.id in self.ignored_ids \
-                or obj.portal_type == 'opengever.phvs.homefolder':
-                continue
-
-            if OLD_CODE_BASE:
-                result = self._check_if_in_old_mappings(obj)
-            else:
-                result = self._check_if_in_new_mappings(obj)
-            if not result == 'PASSED':
-                check_result = 'FAILED'
-        return check_result
+        if OLD_CODE_BASE:
+            self._check_if_in_old_mappings(record.obj)
+        else:
+            self._check_if_in_new_mappings(record.obj)
 
     def check_if_mappings_are_persistent(self):
-        check_result = 'PASSED'
-        catalog = self.site.portal_catalog
-
-        dossier_brains = catalog(object_provides=IDossierMarker.__identifier__)
-        repo_brains = catalog(object_provides=IRepositoryFolder.__identifier__)
-
-        all_brains = []
-        all_brains.extend(dossier_brains)
-        all_brains.extend(repo_brains)
+        return self.selfcheck(
+            ['check_if_mappings_are_persistent'])[
+                'check_if_mappings_are_persistent']
 
-        for brain in all_brains:
-            obj = brain.getObject()
-            url = obj.absolute_url()
-            ann = IAnnotations(obj)
+    def _check_if_mappings_are_persistent(self, record):
+        checkname = 'check_if_mappings_are_persistent'
+        obj = record.obj
+        ann = IAnnotations(obj)
 
-            if OLD_CODE_BASE:
-                child_refs = ann.get(CHILD_REF_KEY)
-                prefix_refs = ann.get(PREFIX_REF_KEY)
-            else:
-                child_refs = self.helper.get_new_mapping(CHILD_REF_KEY, obj)
-                prefix_refs = self.helper.get_new_mapping(PREFIX_REF_KEY, obj)
-
-            if child_refs:
-                child_refs_persistent = is_persistent(child_refs)
-                if not child_refs_persistent:
-                    check_result = 'FAILED'
-                    self.log("FAILED: child refs not persistent for %s" % url)
-
-            if prefix_refs:
-                prefix_refs_persistent = is_persistent(prefix_refs)
-                if not prefix_refs_persistent:
-                    check_result = 'FAILED'
-                    self.log("FAILED: prefix refs not persistent for %s" % url)
-        return check_result
+        if OLD_CODE_BASE:
+            child_refs = ann.get(CHILD_REF_KEY)
+            prefix_refs = ann.get(PREFIX_REF_KEY)
+        else:
+            child_refs = self.helper.get_new_mapping(CHILD_REF_KEY, obj)
+            prefix_refs = self.helper.get_new_mapping(PREFIX_REF_KEY, obj)
+
+        if child_refs:
+            if not is_persistent(child_refs):
+                self.fail(checkname,
+                          "child refs not persistent for %s" % record.url,
+                          path=record.path)
+
+        if prefix_refs:
+            if not is_persistent(prefix_refs):
+                self.fail(checkname,
+                          "prefix refs not persistent for %s" % record.url,
+                          path=record.path)
 
 
 def instance_of(obj, types):
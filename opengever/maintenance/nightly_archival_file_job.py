@@ -1,4 +1,9 @@
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from datetime import datetime
+from datetime import timedelta
 from opengever.document.archival_file import ArchivalFileConverter
+from persistent.mapping import PersistentMapping
 from plone import api
 from Products.CMFPlone.interfaces import IPloneSiteRoot
 from time import sleep
@@ -10,6 +15,7 @@ from zope.interface import Interface
 from zope.intid.interfaces import IIntIds
 from zope.publisher.interfaces.browser import IBrowserRequest
 import logging
+import time
 
 # Conditional import to not cause issues on og.core versions where
 # opengever.nightlyjobs.interfaces doesn't exist yet
@@ -29,8 +35,12 @@ except:
     NightlyJobProviderBase = object
 
 MISSING_ARCHIVAL_FILE_KEY = 'DOCS_WITH_MISSING_ARCHIVAL_FILE'
+MISSING_ARCHIVAL_FILE_STATS_KEY = 'DOCS_WITH_MISSING_ARCHIVAL_FILE_STATS'
 MAX_CONVERSION_REQUESTS_PER_NIGHT = 10000
 
+# Seconds to wait between two conversion requests
+CONVERSION_REQUEST_STAGGER = 1
+
 # Track total number of conversion requests sent per nightly run
 sent_conversion_requests = 0
 
@@ -106,6 +116,8 @@ class NightlyArchivalFileConversion(NightlyJobProviderBase):
         self.logger.info("Triggering conversion jobs for documents in %r" % dossier)
 
         queue = self.get_queue()
+        # Has to be set up before touching the queue
+        stats = ArchivalFileQueueStats(self.context)
         for doc_intid in queue[dossier_intid]:
             interrupt_if_necessary()
             doc = self.intids.getObject(doc_intid)
@@ -114,6 +126,129 @@ class NightlyArchivalFileConversion(NightlyJobProviderBase):
 
             # Stagger conversion requests at least a little bit, in order to
             # avoid overloading Bumblebee. This likely will have to be tuned.
-            sleep(1)
+            sleep(CONVERSION_REQUEST_STAGGER)
+
+        sent = len(queue.pop(dossier_intid))
+        stats.dequeued(dossier_intid, sent)
+        stats.record_sent(sent)
+
+
+class ArchivalFileQueueStats(object):
+    """Bookkeeping kept alongside the archival file conversion queue.
+
+    Counting the queued documents would require loading every dossier's set
+    of document IntIds, so the totals are kept in `Length` counters that are
+    updated whenever the queue changes. In addition we keep when (and with
+    how many documents) each dossier was queued, and how many conversion
+    requests have been sent per night, to be able to forecast how long it
+    takes to drain the queue.
 
-        queue.pop(dossier_intid)
+    Counters are rebuilt from the queue if they don't exist yet (queues that
+    were filled before this bookkeeping existed). The age of such entries is
+    unknown.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        ann = IAnnotations(context)
+        if MISSING_ARCHIVAL_FILE_STATS_KEY not in ann:
+            ann[MISSING_ARCHIVAL_FILE_STATS_KEY] = self._build(
+                ann.get(MISSING_ARCHIVAL_FILE_KEY, {}))
+        self.storage = ann[MISSING_ARCHIVAL_FILE_STATS_KEY]
+
+    @staticmethod
+    def _build(queue):
+        storage = PersistentMapping()
+        storage['queued_docs'] = Length()
+        storage['queued_dossiers'] = Length()
+        # dossier IntId -> (queued at timestamp, number of documents)
+        storage['queued_at'] = IOBTree()
+        # ordinal of the night's date -> number of sent conversion requests
+        storage['sent_per_night'] = IOBTree()
+
+        for dossier_intid, doc_intids in queue.items():
+            storage['queued_docs'].change(len(doc_intids))
+            storage['queued_dossiers'].change(1)
+            storage['queued_at'][dossier_intid] = (None, len(doc_intids))
+        return storage
+
+    @property
+    def queued_docs(self):
+        return self.storage['queued_docs']()
+
+    @property
+    def queued_dossiers(self):
+        return self.storage['queued_dossiers']()
+
+    def enqueued(self, dossier_intid, doc_count, replaced_count=None):
+        """Track that `doc_count` documents of a dossier were queued,
+        replacing `replaced_count` already queued ones (None if the dossier
+        wasn't queued yet). The age of a replaced entry is kept.
+        """
+        queued_at = int(time.time())
+        if replaced_count is None:
+            self.storage['queued_dossiers'].change(1)
+            replaced_count = 0
+        elif dossier_intid in self.storage['queued_at']:
+            queued_at = self.storage['queued_at'][dossier_intid][0]
+
+        self.storage['queued_docs'].change(doc_count - replaced_count)
+        self.storage['queued_at'][dossier_intid] = (queued_at, doc_count)
+
+    def reset(self):
+        """Reset the counters for an emptied queue, keeping the history.
+        """
+        self.storage['queued_docs'].set(0)
+        self.storage['queued_dossiers'].set(0)
+        self.storage['queued_at'] = IOBTree()
+
+    def dequeued(self, dossier_intid, doc_count):
+        self.storage['queued_dossiers'].change(-1)
+        self.storage['queued_docs'].change(-doc_count)
+        self.storage['queued_at'].pop(dossier_intid, None)
+
+    def record_sent(self, count, now=None):
+        """Add sent conversion requests to the current night's total.
+
+        Nightly jobs usually run across midnight, so requests are attributed
+        to the night by the date 12 hours before they were sent.
+        """
+        now = now or datetime.now()
+        night = (now - timedelta(hours=12)).date().toordinal()
+        sent_per_night = self.storage['sent_per_night']
+        sent_per_night[night] = sent_per_night.get(night, 0) + count
+
+    def sent_per_night(self, nights=None):
+        """Return (date, sent) tuples for the most recent nights, oldest first.
+        """
+        items = list(self.storage['sent_per_night'].items())
+        if nights:
+            items = items[-nights:]
+        return [(datetime.fromordinal(night).date(), sent)
+                for night, sent in items]
+
+    def age_percentiles(self, percentiles=(50, 90, 99, 100), now=None):
+        """Return the age (in seconds) of the queued documents at the given
+        percentiles, weighted by the number of documents per dossier.
+
+        Returns None for a percentile if it falls into entries of unknown age.
+        """
+        now = now or time.time()
+        entries = [
+            ((None if queued_at is None else now - queued_at), doc_count)
+            for queued_at, doc_count in self.storage['queued_at'].values()]
+        # Entries of unknown age are the oldest ones
+        entries.sort(key=lambda entry: (entry[0] is None, entry[0]))
+
+        total = sum(doc_count for age, doc_count in entries)
+        result = {}
+        for percentile in percentiles:
+            threshold = total * percentile / 100.0
+            cumulated = 0
+            result[percentile] = None
+            for age, doc_count in entries:
+                cumulated += doc_count
+                if cumulated >= threshold:
+                    result[percentile] = age
+                    break
+        return result
@@ -0,0 +1,210 @@
+"""
+Helpers to distribute read-mostly maintenance work over several processes.
+
+Worker processes are forked from the `bin/instance run` process. Each worker
+opens its own ZODB connection (with its own transaction manager) to the same
+database and sets up the Plone site just like `setup_plone` does for the
+main process. Work is handed to the workers in shards (lists of picklable
+items, usually paths or RIDs), results are sent back to the parent and can be
+merged there in shard order.
+
+Workers can be pinned to a snapshot of the database by passing the TID
+to `WorkerPool` as `at`. They then get read-only historical connections
+that all see the same state, regardless of what gets committed meanwhile.
+
+Workers that need to commit (`writable`) instead get a connection using the
+default transaction manager, like the main process, so that the indexing
+queue and other transaction hooks work as usual. The connection inherited
+from the parent is detached from that transaction manager first, and the
+worker starts with a clean transaction. The parent must not have any
+uncommitted changes when the pool is started.
+
+In all workers, the Solr connection and the SQLAlchemy connection pools
+inherited from the parent are replaced, their sockets belong to the parent.
+
+This requires a storage that hands out an independent storage instance per
+connection (RelStorage). For other storages (FileStorage, ZEO) the parent's
+storage file handles / sockets would be shared by the forked processes, so
+`WorkerPool` falls back to processing all shards in the current process.
+"""
+from AccessControl.SecurityManagement import noSecurityManager
+from opengever.maintenance.debughelpers import setup_plone
+from ZODB.interfaces import IMVCCStorage
+from zope.component import getUtilitiesFor
+from zope.globalrequest import setRequest
+import argparse
+import logging
+import multiprocessing
+import traceback
+import transaction
+
+
+try:
+    from ftw.solr.connection import local_data as solr_local_data
+except ImportError:
+    solr_local_data = None
+
+try:
+    from z3c.saconfig.interfaces import IEngineFactory
+except ImportError:
+    IEngineFactory = None
+
+
+logger = logging.getLogger('opengever.maintenance')
+
+
+# State handed over to the forked workers. Since the workers are forked, the
+# callables don't have to be picklable (scripts run via `bin/instance run`
+# aren't importable modules), only the shards and the results have to be.
+_worker_state = {}
+
+
+class WorkerError(Exception):
+    """Raised in the parent process if processing a shard failed in a worker.
+    """
+
+
+def chunked(items, size):
+    """Split a sequence of items into lists of at most `size` items.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def supports_parallel_connections(context):
+    """Whether worker processes can safely open their own connections to the
+    database `context` is stored in.
+    """
+    return IMVCCStorage.providedBy(context._p_jar.db().storage)
+
+
+class WorkerPool(object):
+    """Process shards of work in forked worker processes.
+
+    `setup_worker` is called once per worker process with the worker's own
+    Plone site and returns the object that is then passed to
+    `process_shard(worker, shard)` for every shard that worker processes.
+    With `at` (a TID), the workers' connections are read-only and see the
+    database as of that transaction. With `writable`, workers can commit
+    with the default transaction manager (`transaction.commit()`).
+
+    Usage:
+
+        pool = WorkerPool(portal, 4, setup_worker, process_shard)
+        for result in pool.imap(chunked(paths, 50)):
+            merge(result)
+    """
+
+    def __init__(self, context, processes, setup_worker, process_shard,
+                 at=None, writable=False):
+        if at is not None and writable:
+            raise ValueError("Connections to a snapshot are read-only.")
+
+        self.context = context
+        self.setup_worker = setup_worker
+        self.process_shard = process_shard
+        self.processes = processes
+        self.at = at
+        self.writable = writable
+
+        if processes > 1 and not supports_parallel_connections(context):
+            logger.warning(
+                'Storage does not support independent connections per '
+                'process, processing everything in the current process.')
+            self.processes = 1
+
+    def imap(self, shards):
+        """Process shards and yield their results in the order of `shards`.
+        """
+        if self.processes <= 1:
+            worker = self.setup_worker(self.context)
+            for shard in shards:
+                yield self.process_shard(worker, shard)
+            return
+
+        conn = self.context._p_jar
+        _worker_state.update({
+            'db': conn.db(),
+            'site_path': '/'.join(self.context.getPhysicalPath()),
+            'cache_size': conn._cache.cache_size,
+            'at': self.at,
+            'writable': self.writable,
+            'parent_conn': conn,
+            'setup_worker': self.setup_worker,
+            'process_shard': self.process_shard,
+        })
+
+        pool = multiprocessing.Pool(self.processes, initializer=_init_worker)
+        try:
+            for result in pool.imap(_run_shard, shards):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_state.clear()
+
+
+def _detach_inherited_connections():
+    """Replace the Solr connection and the SQLAlchemy connection pools
+    inherited from the parent process, since their sockets are shared with
+    the parent. The inherited objects are kept referenced, so that they
+    never get closed (and e.g. send a terminate message to the database)
+    by the worker.
+    """
+    inherited = _worker_state.setdefault('inherited_connections', [])
+
+    if solr_local_data is not None:
+        inherited.append(dict(solr_local_data.__dict__))
+        solr_local_data.__dict__.clear()
+
+    if IEngineFactory is not None:
+        for name, engine_factory in getUtilitiesFor(IEngineFactory):
+            engine = engine_factory()
+            inherited.append(engine.pool)
+            engine.pool = engine.pool.recreate()
+
+
+def _init_worker():
+    _detach_inherited_connections()
+
+    if _worker_state['writable']:
+        # Never touch the connection inherited from the parent process, it
+        # must not take part in our transactions either.
+        transaction.manager.unregisterSynch(_worker_state['parent_conn'])
+        # Drop the inherited transaction (with the parent's resources and
+        # hooks) without aborting it, and start a clean one.
+        transaction.manager.free(transaction.get())
+        transaction.begin()
+        conn = _worker_state['db'].open()
+    else:
+        # Never touch the connection inherited from the parent process: it
+        # is registered with the default transaction manager, so we use our
+        # own.
+        conn = _worker_state['db'].open(
+            transaction_manager=transaction.TransactionManager(),
+            at=_worker_state['at'])
+    conn._cache.cache_size = _worker_state['cache_size']
+
+    noSecurityManager()
+    options = argparse.Namespace(site_root=_worker_state['site_path'])
+    site = setup_plone(conn.root()['Application'], options)
+    setRequest(site.REQUEST)
+
+    _worker_state['worker'] = _worker_state['setup_worker'](site)
+
+
+def _run_shard(shard):
+    try:
+        return _worker_state['process_shard'](_worker_state['worker'], shard)
+    except Exception:
+        # Tracebacks don't survive the trip to the parent process
+        raise WorkerError(traceback.format_exc())
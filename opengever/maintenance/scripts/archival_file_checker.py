@@ -2,7 +2,7 @@
 Script that reports documents missing their archival file, and optionally
 queues them for conversion by a nightly job.
 
-Usage: archival_file_checker.py [-n] [report_missing | queue_missing]
+Usage: archival_file_checker.py [-n] [-p N] [report_missing | queue_missing | queue_stats]
 
 The script takes one of two commmands:
 
@@ -16,13 +16,33 @@ queue_missing
 reset_queue
     Reset the current persistent queue.
 
+queue_stats
+    Report the queue length, the age of the queued documents and a forecast
+    of how many nights it takes to drain the queue, based on the nightly
+    scheduler's rate and the conversion requests sent in past nights.
+    Use --budget to forecast for a different MAX_CONVERSION_REQUESTS_PER_NIGHT.
+
+summarize_profile
+    Summarize the profile trace of a previous run (given with --profile),
+    listing the dossiers that dominate runtime and memory usage.
+
+With -p N the resolved dossiers are checked by N worker processes, each
+using its own ZODB connection (requires RelStorage). The report and the queue
+are the same as for a sequential run.
+
 The script will display some basic console output, and automatically log
 that ouput and some more detailed information to a logfile.
+
+For every checked dossier a profile record (wall time, ZODB object loads,
+pickle cache size, RSS and time spent in garbage collection) is written to a
+JSONL trace next to the logfile. The interval for the explicit garbage
+collection can be tuned with --gc-interval.
 """
 from BTrees.IIBTree import IITreeSet
 from BTrees.IOBTree import IOBTree
 from collections import Counter
 from collections import OrderedDict
+from datetime import timedelta
 from ftw.bumblebee.interfaces import IBumblebeeDocument
 from opengever.document.archival_file import ArchivalFileConverter
 from opengever.document.archival_file import STATE_FAILED_TEMPORARILY
@@ -30,11 +50,17 @@ from opengever.document.behaviors import IBaseDocument
 from opengever.dossier.behaviors.dossier import IDossierMarker
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.nightly_archival_file_job import ArchivalFileQueueStats
+from opengever.maintenance.nightly_archival_file_job import CONVERSION_REQUEST_STAGGER
+from opengever.maintenance.nightly_archival_file_job import MAX_CONVERSION_REQUESTS_PER_NIGHT
 from opengever.maintenance.nightly_archival_file_job import MISSING_ARCHIVAL_FILE_KEY
+from opengever.maintenance.parallel import chunked
+from opengever.maintenance.parallel import WorkerPool
 from opengever.maintenance.utils import LogFilePathFinder
 from opengever.maintenance.utils import TextTable
 from opengever.private.dossier import IPrivateDossier
 from plone import api
+from plone.registry.interfaces import IRegistry
 from Products.CMFPlone.interfaces import IPloneSiteRoot
 from zope.annotation import IAnnotations
 from zope.component import getUtility
@@ -45,9 +71,11 @@ import argparse
 import gc
 import json
 import logging
+import math
 import os
 import subprocess
 import sys
+import time
 import transaction
 
 
@@ -55,6 +83,8 @@ logger = logging.getLogger('archival_file_checker')
 logger.setLevel(logging.INFO)
 
 
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
 # Duplicating this here instead of importing from opengever.dossier.resolve
 # in order to avoid hard dependency from opengever.maintenance
 AFTER_RESOLVE_JOBS_PENDING_KEY = 'opengever.dossier.resolve.after_resolve_jobs_pending'
@@ -75,15 +105,17 @@ class ArchivalFileChecker(object):
 
         self.log = logger.log
         self.log_to_file = logger.log_to_file
-        self.log_memory = logger.log_memory
+        self.log_profile = logger.log_profile
 
         self.catalog = api.portal.get_tool('portal_catalog')
         self.intids = getUtility(IIntIds)
         self.all_dossier_stats = None
 
-        # Bookkeeping stats for memory usage
+        # Bookkeeping stats for memory usage and profiling
         self.rss_max = 0
         self.checked_docs_count = 0
+        self.gc_time = 0.0
+        self.gc_runs = 0
 
     def run(self):
         assert IPloneSiteRoot.providedBy(self.context)
@@ -93,13 +125,17 @@ class ArchivalFileChecker(object):
             self.log("Queue reset")
             return
 
+        if self.options.cmd == 'queue_stats':
+            self.report_queue_stats()
+            return
+
         missing_by_dossier = self.check()
         if self.options.cmd == 'queue_missing':
             self.queue_missing(missing_by_dossier)
 
         self.log("")
         self.log("Detailed log written to %s" % self.logger.logfile_path)
-        self.log("Memory log written to %s" % self.logger.memory_logfile_path)
+        self.log("Profile trace written to %s" % self.logger.profile_logfile_path)
 
     def check(self):
         """For all candidate dossiers, check if the documents contained in
@@ -133,22 +169,12 @@ class ArchivalFileChecker(object):
         all_dossier_stats = OrderedDict()
         missing_by_dossier = []
 
-        for brain in resolved_dossier_brains:
-            dossier = brain.getObject()
-
-            if IPrivateDossier.providedBy(dossier):
-                # Documents in private dossiers don't need archival files
+        for result in self.check_dossiers(resolved_dossier_brains):
+            if result is None:
                 continue
 
-            if self.after_resolve_jobs_pending(dossier):
-                # Nightly resolve job for this dossier hasn't run yet, so
-                # it's archival files *can't* exist yet
-                continue
-
-            self.log_memstats()
-
-            dossier_stats, docs_missing_archival_file = self._check_dossier(dossier)
-            dossier_intid = self.intids.getId(dossier)
+            dossier_intid, dossier_stats, docs_missing_archival_file, profile = result
+            self.log_dossier_profile(profile)
             all_dossier_stats[dossier_intid] = dossier_stats
 
             if docs_missing_archival_file:
@@ -183,39 +209,88 @@ class ArchivalFileChecker(object):
 
         # Display current queue length, just to be helpful
         assert IPloneSiteRoot.providedBy(self.context)
-        ann = IAnnotations(self.context)
-        queue = ann.get(MISSING_ARCHIVAL_FILE_KEY, {})
-
-        queued_dossiers = len(queue)
-        queued_docs = sum(map(len, queue.values()))
+        stats = ArchivalFileQueueStats(self.context)
 
         self.log("")
         self.log("Current queue length")
         self.log("=" * 80)
         self.log("%s documents queued (from %s dossiers)" % (
-            queued_docs, queued_dossiers))
+            stats.queued_docs, stats.queued_dossiers))
 
         return missing_by_dossier
 
-    def log_memstats(self):
-        rss = self.get_rss() / 1024.0
-        self.rss_max = max(self.rss_max, rss)
-        memstats = {
-            'items': self.checked_docs_count,
-            'rss_current': rss,
-            'rss_max': self.rss_max,
-        }
-        self.log_memory(json.dumps(memstats))
+    def check_dossiers(self, brains):
+        """Check the candidate dossiers for the given brains, in order.
+
+        Yields a `(dossier_intid, dossier_stats, docs_missing_archival_file,
+        profile)` tuple per checked dossier, or None for dossiers that aren't
+        candidates after all.
+
+        With more than one process, the dossiers are sharded by path and
+        checked in worker processes, each with its own ZODB connection. The
+        results are yielded in the same order as in the sequential mode.
+        """
+        processes = self.options.processes
+        if processes <= 1:
+            for brain in brains:
+                yield self.check_candidate_dossier(brain.getObject())
+            return
 
-    def get_rss(self):
-        """Get current memory usage (RSS) of this process.
+        paths = [brain.getPath() for brain in brains]
+        pool = WorkerPool(
+            self.context, processes,
+            setup_worker=self._setup_worker,
+            process_shard=self._check_dossier_shard)
+
+        for results in pool.imap(chunked(paths, self.options.chunk_size)):
+            for result in results:
+                if result is not None:
+                    self.checked_docs_count += result[1]['total_docs_in_dossier']
+                yield result
+
+    def _setup_worker(self, site):
+        # Objects of the parent process must not be used in the workers, so
+        # every worker gets its own checker bound to its own connection.
+        return ArchivalFileChecker(site, self.options, NullLogger())
+
+    @staticmethod
+    def _check_dossier_shard(checker, paths):
+        results = []
+        for path in paths:
+            dossier = checker.context.unrestrictedTraverse(path)
+            results.append(checker.check_candidate_dossier(dossier))
+        return results
+
+    def check_candidate_dossier(self, dossier):
+        """Check a resolved dossier, unless it turns out not to be a
+        candidate dossier. Returns None in that case.
         """
-        out = subprocess.check_output(
-            ["ps", "-p", "%s" % os.getpid(), "-o", "rss"])
-        try:
-            return int(out.splitlines()[-1].strip())
-        except ValueError:
-            return 0
+        if IPrivateDossier.providedBy(dossier):
+            # Documents in private dossiers don't need archival files
+            return None
+
+        if self.after_resolve_jobs_pending(dossier):
+            # Nightly resolve job for this dossier hasn't run yet, so
+            # it's archival files *can't* exist yet
+            return None
+
+        profiler = DossierProfiler(self)
+        dossier_stats, docs_missing_archival_file = self._check_dossier(dossier)
+        dossier_intid = self.intids.getId(dossier)
+        profile = profiler.stop(dossier_intid, dossier_stats['total_docs_in_dossier'])
+
+        return dossier_intid, dossier_stats, docs_missing_archival_file, profile
+
+    def log_dossier_profile(self, profile):
+        """Write the profile record of a checked dossier to the trace.
+
+        The checked items and the RSS high-water mark are bookkept by the
+        main process, RSS of records from worker processes is the worker's.
+        """
+        self.rss_max = max(self.rss_max, profile['rss'])
+        profile['items'] = self.checked_docs_count
+        profile['rss_max'] = self.rss_max
+        self.log_profile(json.dumps(profile, sort_keys=True))
 
     def collect_garbage(self, site):
         # In order to get rid of leaking references, the Plone site needs to be
@@ -225,12 +300,17 @@ class ArchivalFileChecker(object):
         # it was previously holding on to.
         setSite(getSite())
 
+        start = time.time()
+
         # Trigger garbage collection for the cPickleCache
         site._p_jar.cacheGC()
 
         # Also trigger Python garbage collection.
         gc.collect()
 
+        self.gc_time += time.time() - start
+        self.gc_runs += 1
+
         # (These two don't seem to affect the memory high-water-mark a lot,
         # but result in a more stable / predictable growth over time.
         #
@@ -258,9 +338,9 @@ class ArchivalFileChecker(object):
             doc = doc_brain.getObject()
             doc_intid = self.intids.getId(doc)
 
-            # GC every 500 items proved a happy medium between memory
-            # high watermark and slowdown in runtime
-            if self.checked_docs_count % 500 == 0:
+            # GC every 500 items (the default interval) proved a happy medium
+            # between memory high watermark and slowdown in runtime
+            if self.checked_docs_count % self.options.gc_interval == 0:
                 # Trigger GC to keep memory usage in check
                 self.collect_garbage(self.context)
 
@@ -385,15 +465,21 @@ class ArchivalFileChecker(object):
         if MISSING_ARCHIVAL_FILE_KEY not in ann:
             ann[MISSING_ARCHIVAL_FILE_KEY] = IOBTree()
         queue = ann[MISSING_ARCHIVAL_FILE_KEY]
+        # Has to be set up before touching the queue, since missing stats
+        # are built from the queue's current content.
+        stats = ArchivalFileQueueStats(self.context)
 
         for group in missing_by_dossier:
             dossier_intid = group['dossier']
             missing = group['missing']
             self.log("  Queueing %s documents for Dossier %r" % (len(missing), dossier_intid))
 
+            replaced_count = None
             if dossier_intid in queue:
                 self.log('  (Replacing already queued documents for Dossier %r)' % dossier_intid)
+                replaced_count = len(queue[dossier_intid])
 
+            stats.enqueued(dossier_intid, len(missing), replaced_count)
             queue[dossier_intid] = IITreeSet()
             for doc_intid in missing:
                 queue[dossier_intid].add(doc_intid)
@@ -407,6 +493,226 @@ class ArchivalFileChecker(object):
         ann = IAnnotations(self.context)
         if MISSING_ARCHIVAL_FILE_KEY in ann:
             ann.pop(MISSING_ARCHIVAL_FILE_KEY)
+        ArchivalFileQueueStats(self.context).reset()
+
+    def report_queue_stats(self):
+        """Report queue length, backlog age and a forecast of the nights
+        needed to drain the queue.
+
+        The scheduler rate is the per-night budget, limited by the number of
+        requests that fit into the nightly jobs time window given the
+        staggering between requests. The observed rate is the average of
+        conversion requests actually sent in the recent nights.
+        """
+        stats = ArchivalFileQueueStats(self.context)
+        queued_docs = stats.queued_docs
+
+        self.log("Archival file conversion queue")
+        self.log("=" * 80)
+        self.log("%s documents queued (from %s dossiers)" % (
+            queued_docs, stats.queued_dossiers))
+
+        self.log("")
+        self.log("Backlog age (weighted by documents)")
+        self.log("=" * 80)
+        age_table = TextTable()
+        age_table.add_row(('percentile', 'age_days'))
+        for percentile, age in sorted(stats.age_percentiles().items()):
+            age_days = 'unknown' if age is None else '%.1f' % (age / 86400.0)
+            age_table.add_row(('p%s' % percentile, age_days))
+        for line in age_table.generate_output().splitlines():
+            self.log(line)
+
+        budget = self.options.budget or MAX_CONVERSION_REQUESTS_PER_NIGHT
+        window = get_nightly_jobs_window()
+        scheduler_rate = budget
+        if window is not None:
+            capacity = int(window.total_seconds() / CONVERSION_REQUEST_STAGGER)
+            scheduler_rate = min(budget, capacity)
+
+        history = stats.sent_per_night(self.options.history_nights)
+        active_nights = [sent for night, sent in history if sent]
+        observed_rate = None
+        if active_nights:
+            observed_rate = sum(active_nights) / float(len(active_nights))
+
+        self.log("")
+        self.log("Conversion requests sent per night")
+        self.log("=" * 80)
+        history_table = TextTable()
+        history_table.add_row(('night', 'sent'))
+        for night, sent in history:
+            history_table.add_row((night.isoformat(), sent))
+        for line in history_table.generate_output().splitlines():
+            self.log(line)
+
+        self.log("")
+        self.log("Forecast")
+        self.log("=" * 80)
+        self.log("Budget per night: %s" % budget)
+        if window is not None:
+            self.log("Nightly jobs window: %s (room for %s requests)" % (
+                window, capacity))
+        forecast_table = TextTable()
+        forecast_table.add_row(('rate', 'requests_per_night', 'nights_to_drain'))
+        forecast_table.add_row((
+            'scheduler', scheduler_rate, nights_to_drain(queued_docs, scheduler_rate)))
+        if observed_rate is not None:
+            forecast_table.add_row((
+                'observed', '%.0f' % observed_rate,
+                nights_to_drain(queued_docs, min(observed_rate, scheduler_rate))))
+        for line in forecast_table.generate_output().splitlines():
+            self.log(line)
+
+
+def get_nightly_jobs_window():
+    """Return the length of the nightly jobs time window as timedelta, or
+    None on og.core versions without configurable nightly jobs.
+    """
+    try:
+        from opengever.nightlyjobs.interfaces import INightlyJobsSettings
+    except ImportError:
+        return None
+
+    settings = getUtility(IRegistry).forInterface(INightlyJobsSettings)
+    window = settings.end_time - settings.start_time
+    if window < timedelta(0):
+        # Window spans midnight
+        window += timedelta(days=1)
+    return window
+
+
+def nights_to_drain(queued_docs, rate):
+    if not queued_docs:
+        return 0
+    if not rate:
+        return 'never'
+    return int(math.ceil(queued_docs / float(rate)))
+
+
+class DossierProfiler(object):
+    """Measures wall time, ZODB object loads and GC pauses while checking a
+    dossier, and records the resulting pickle cache size and RSS.
+    """
+
+    def __init__(self, checker):
+        self.checker = checker
+        self.conn = checker.context._p_jar
+        self.start = time.time()
+        self.loads = self.conn.getTransferCounts()[0]
+        self.gc_time = checker.gc_time
+        self.gc_runs = checker.gc_runs
+
+    def stop(self, dossier_intid, docs):
+        return {
+            'dossier': dossier_intid,
+            'pid': os.getpid(),
+            'docs': docs,
+            'wall': round(time.time() - self.start, 4),
+            'loads': self.conn.getTransferCounts()[0] - self.loads,
+            'cache_size': len(self.conn._cache),
+            'cache_non_ghosts': self.conn._cache.cache_non_ghost_count,
+            'rss': get_rss() / 1024.0,
+            'gc_time': round(self.checker.gc_time - self.gc_time, 4),
+            'gc_runs': self.checker.gc_runs - self.gc_runs,
+        }
+
+
+def get_rss():
+    """Get current memory usage (RSS in KiB) of this process.
+
+    Read from /proc where available, in order to not fork a `ps` per dossier.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * PAGE_SIZE / 1024
+    except (IOError, IndexError, ValueError):
+        pass
+
+    out = subprocess.check_output(
+        ["ps", "-p", "%s" % os.getpid(), "-o", "rss"])
+    try:
+        return int(out.splitlines()[-1].strip())
+    except ValueError:
+        return 0
+
+
+def summarize_profile(path, top=20):
+    """Return a multiline summary of a profile trace, listing the dossiers
+    that dominate runtime, object loads and memory growth.
+    """
+    records = []
+    with open(path) as trace:
+        for line in trace:
+            if line.strip():
+                records.append(json.loads(line))
+
+    if not records:
+        return 'No profile records found in %s' % path
+
+    # Memory growth is attributed to the dossier during whose check it was
+    # observed, per process (worker processes each have their own RSS).
+    last_rss = {}
+    for record in records:
+        pid = record.get('pid')
+        record['rss_growth'] = record['rss'] - last_rss.get(pid, record['rss'])
+        last_rss[pid] = record['rss']
+
+    total_wall = sum(record['wall'] for record in records)
+    total_gc = sum(record['gc_time'] for record in records)
+
+    output = ''
+    totals_table = TextTable()
+    totals_table.add_row(('dossiers', 'docs', 'wall_total', 'gc_time_total',
+                          'gc_runs_total', 'loads_total', 'rss_max'))
+    totals_table.add_row((
+        len(records),
+        sum(record['docs'] for record in records),
+        '%.1f' % total_wall,
+        '%.1f' % total_gc,
+        sum(record['gc_runs'] for record in records),
+        sum(record['loads'] for record in records),
+        '%.1f' % max(record['rss'] for record in records),
+    ))
+    output += totals_table.generate_output()
+
+    for title, key in (('Dossiers dominating runtime', 'wall'),
+                       ('Dossiers dominating object loads', 'loads'),
+                       ('Dossiers dominating memory growth', 'rss_growth')):
+        table = TextTable()
+        table.add_row(('dossier_intid', 'docs', 'wall', 'wall_share',
+                       'loads', 'rss_growth', 'cache_size', 'gc_time'))
+        ranked = sorted(records, key=lambda record: record[key], reverse=True)
+        for record in ranked[:top]:
+            table.add_row((
+                record['dossier'],
+                record['docs'],
+                '%.2f' % record['wall'],
+                '%.1f%%' % (100.0 * record['wall'] / total_wall if total_wall else 0),
+                record['loads'],
+                '%.1f' % record['rss_growth'],
+                record['cache_size'],
+                '%.2f' % record['gc_time'],
+            ))
+        output += '\n\n%s\n%s\n' % (title, '=' * 80)
+        output += table.generate_output()
+
+    return output
+
+
+class NullLogger(object):
+    """Logger for checkers running in worker processes. Their results are
+    logged by the main process.
+    """
+
+    logfile_path = None
+    profile_logfile_path = None
+
+    def log(self, line):
+        pass
+
+    log_to_file = log_profile = log
 
 
 class Logger(LogFilePathFinder):
@@ -418,15 +724,16 @@ class Logger(LogFilePathFinder):
     def __init__(self, filename_basis):
         super(Logger, self).__init__()
         self.logfile_path = self.get_logfile_path(filename_basis)
-        self.memory_logfile_path = self.get_logfile_path(filename_basis + '-memory')
+        self.profile_logfile_path = self.get_logfile_path(
+            filename_basis + '-profile', extension='jsonl')
 
     def __enter__(self):
         self.logfile = open(self.logfile_path, 'w')
-        self.memory_logfile = open(self.memory_logfile_path, 'w')
+        self.profile_logfile = open(self.profile_logfile_path, 'w')
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.memory_logfile.close()
+        self.profile_logfile.close()
         self.logfile.close()
 
     def log(self, line):
@@ -440,24 +747,55 @@ class Logger(LogFilePathFinder):
             line += '\n'
         self.logfile.write(line)
 
-    def log_memory(self, line):
+    def log_profile(self, line):
         if not line.endswith('\n'):
             line += '\n'
-        self.memory_logfile.write(line)
+        self.profile_logfile.write(line)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('cmd', choices=['report_missing', 'queue_missing', 'reset_queue'],
+    parser.add_argument('cmd', choices=['report_missing', 'queue_missing',
+                                        'reset_queue', 'queue_stats',
+                                        'summarize_profile'],
                         help='Command')
     parser.add_argument('-s', dest='site_root', default=None,
                         help='Absolute path to the Plone site')
     parser.add_argument('-n', dest='dryrun', default=False, help='Dryrun')
+    parser.add_argument('-p', dest='processes', type=int, default=1,
+                        help='Number of worker processes used to check '
+                             'dossiers (requires RelStorage)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        default=50,
+                        help='Number of dossiers handed to a worker at once')
+    parser.add_argument('--gc-interval', dest='gc_interval', type=int,
+                        default=500,
+                        help='Number of documents between garbage collections')
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help='Profile trace to summarize (summarize_profile)')
+    parser.add_argument('--top', dest='top', type=int, default=20,
+                        help='Number of dossiers listed per summary table')
+    parser.add_argument('--budget', dest='budget', type=int, default=None,
+                        help='Conversion requests per night to forecast with '
+                             '(queue_stats, defaults to '
+                             'MAX_CONVERSION_REQUESTS_PER_NIGHT)')
+    parser.add_argument('--history-nights', dest='history_nights', type=int,
+                        default=14,
+                        help='Number of past nights considered (queue_stats)')
 
     options = parser.parse_args(sys.argv[3:])
-
-    # report_missing should always be readonly
-    if options.cmd == 'report_missing':
+    if options.gc_interval < 1:
+        parser.error('--gc-interval must be a positive number')
+
+    if options.cmd == 'summarize_profile':
+        # Only reads the trace, no need to touch the database
+        if not options.profile:
+            parser.error('summarize_profile requires --profile')
+        print summarize_profile(options.profile, top=options.top)
+        return
+
+    # report_missing and queue_stats should always be readonly
+    if options.cmd in ('report_missing', 'queue_stats'):
         options.dryrun = True
 
     app = setup_app()
@@ -3,14 +3,17 @@ Stores all documents in the given dossier in Bumblebee.
 
     bin/instance run bumblebee_store_dossier.py -n <dossier_path>
 
+Documents are stored in committed batches, throttled to a number of store
+requests per second. Interrupted runs resume where they stopped, see
+`bumblebee_store_engine` for details.
+
 """
-from ftw.bumblebee.interfaces import IBumblebeeable
-from ftw.bumblebee.interfaces import IBumblebeeConverter
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.bumblebee_store_engine import add_store_options
+from opengever.maintenance.scripts.bumblebee_store_engine import BumblebeeStoreEngine
 from plone import api
-from zope.component import getUtility
 import logging
 import sys
 import transaction
@@ -23,44 +26,24 @@ stream_handler = log.root.handlers[0]
 stream_handler.setLevel(logging.INFO)
 
 
-def get_documents_to_store(dossier_path):
-    catalog = api.portal.get_tool('portal_catalog')
-    brains = catalog.unrestrictedSearchResults(
-        object_provides=IBumblebeeable.__identifier__, path=dossier_path)
-    return brains
-
-
 def store_dossier(dossier_path, options):
-    brains = get_documents_to_store(dossier_path)
-    print("Considering %s documents total" % len(brains))
-
-    for brain in brains:
-        print("Considering: %s" % brain.getPath())
-
-    if not options.dryrun:
-        converter = getUtility(IBumblebeeConverter)
-
-        # Patch GeverBumblebeeConverter's batch_query so we can limit
-        # by date range instead of storing ALL documents
-        query = {'object_provides': IBumblebeeable.__identifier__}
-        query['path'] = dossier_path
-        converter.batch_query = query
+    catalog = api.portal.get_tool('portal_catalog')
+    query = {'path': dossier_path}
+    job = 'bumblebee_store_dossier %s' % dossier_path
 
-        converter.store(deferred=True, reset_timestamp=True)
-    return
+    BumblebeeStoreEngine(catalog, query, job, options).run()
 
 
 if __name__ == '__main__':
     app = setup_app()
 
     parser = setup_option_parser()
-    parser.add_option("-n", "--dry-run", action="store_true",
-                      dest="dryrun", default=False)
+    add_store_options(parser)
     (options, args) = parser.parse_args()
 
     if len(args) != 1:
         print("Must supply exactly one argument (<dossier_path>)")
-        print("Usage: bin/instance run bumblebee_store_since.py -n <dossier_path>")
+        print("Usage: bin/instance run bumblebee_store_dossier.py [-n] [-b <batch-size>] [-r <rps>] <dossier_path>")
         sys.exit(1)
 
     dossier_path = args[0]
@@ -0,0 +1,214 @@
+"""
+Throttled, resumable storing of documents in Bumblebee.
+
+Used by `bumblebee_store_since.py` and `bumblebee_store_dossier.py`. The
+candidate documents are processed in batches sorted by path. For every batch
+the GEVER Bumblebee converter is limited to the batch's UIDs and asked to
+store them deferred, then the transaction is committed (which releases the
+store jobs to the task queue).
+
+Between batches the engine sleeps as necessary to not exceed the configured
+number of store requests per second. How many of those requests are sent
+to Bumblebee concurrently is determined by the task queue workers.
+
+After every batch the path of the last processed document is written to a
+cursor file. If a run gets interrupted, running the script again with the
+same arguments resumes after that document. The cursor file is removed once
+a run completes. By default the cursor file is placed in the log directory
+and its name is derived from the job (script and arguments).
+"""
+from datetime import datetime
+from ftw.bumblebee.interfaces import IBumblebeeable
+from ftw.bumblebee.interfaces import IBumblebeeConverter
+from opengever.maintenance.utils import LogFilePathFinder
+from zope.component import getUtility
+import hashlib
+import json
+import os
+import time
+import transaction
+
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_REQUESTS_PER_SECOND = 10.0
+
+
+def add_store_options(parser):
+    """Add the options for the store engine to an OptionParser.
+    """
+    parser.add_option("-n", "--dry-run", action="store_true",
+                      dest="dryrun", default=False)
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int",
+                      default=DEFAULT_BATCH_SIZE,
+                      help="Number of documents stored per commit")
+    parser.add_option("-r", "--requests-per-second", dest="rps",
+                      type="float", default=DEFAULT_REQUESTS_PER_SECOND,
+                      help="Maximum number of store requests queued per "
+                           "second (0 for no limit)")
+    parser.add_option("--cursor", dest="cursor_path", default=None,
+                      help="Path of the cursor file used to resume "
+                           "interrupted runs")
+    parser.add_option("--restart", action="store_true", dest="restart",
+                      default=False,
+                      help="Ignore an existing cursor and start over")
+
+
+class StoreCursor(object):
+    """Persists the path of the last stored document in a JSON file.
+    """
+
+    def __init__(self, path, job):
+        self.path = path
+        self.job = job
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return None
+
+        with open(self.path) as cursor_file:
+            data = json.load(cursor_file)
+
+        if data.get('job') != self.job:
+            raise Exception(
+                "Cursor file %s belongs to a different job (%r), use "
+                "--restart or another --cursor." % (self.path, data.get('job')))
+        return data
+
+    def save(self, last_path, done, total):
+        data = {'job': self.job,
+                'last_path': last_path,
+                'done': done,
+                'total': total,
+                'updated': datetime.now().isoformat()}
+
+        # Write and rename, so an interrupted write never corrupts the cursor
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cursor_file:
+            json.dump(data, cursor_file)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class ProgressReport(object):
+    """Prints throughput and an ETA after every batch.
+    """
+
+    def __init__(self, total, done=0):
+        self.total = total
+        self.done = done
+        self.done_at_start = done
+        self.start_time = time.time()
+
+    def update(self, count):
+        self.done += count
+        elapsed = time.time() - self.start_time
+        done_in_run = self.done - self.done_at_start
+        rate = done_in_run / elapsed if elapsed else 0
+        remaining = self.total - self.done
+        eta = int(remaining / rate) if rate else 0
+
+        ts = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+        print "{} Stored {}/{} documents ({:.1f} docs/s, ETA {} min {} sec)".format(
+            ts, self.done, self.total, rate, eta // 60, eta % 60)
+
+
+class BumblebeeStoreEngine(object):
+    """Stores the documents matching `query` in Bumblebee in throttled,
+    committed batches.
+
+    `job` identifies the run (e.g. the script and its arguments) and is
+    used to make sure a cursor file is only used to resume the same run.
+    """
+
+    def __init__(self, catalog, query, job, options):
+        self.catalog = catalog
+        self.query = dict(query,
+                          object_provides=IBumblebeeable.__identifier__)
+        self.job = job
+        self.options = options
+
+        cursor_path = options.cursor_path
+        if cursor_path is None:
+            cursor_path = LogFilePathFinder().get_logfile_path(
+                'bumblebee-store-cursor-%s' % hashlib.md5(job).hexdigest()[:8],
+                add_timestamp=False, extension='json')
+        self.cursor = StoreCursor(cursor_path, job)
+
+    def get_brains(self):
+        return self.catalog.unrestrictedSearchResults(
+            sort_on='path', **self.query)
+
+    def run(self):
+        brains = self.get_brains()
+        total = len(brains)
+        print "Considering %s documents total" % total
+
+        if self.options.dryrun:
+            if self.options.verbose:
+                for brain in brains:
+                    print "Considering: %s" % brain.getPath()
+            return
+
+        state = None
+        if self.options.restart:
+            self.cursor.clear()
+        else:
+            state = self.cursor.load()
+
+        last_path = None
+        done = 0
+        if state is not None:
+            last_path = state['last_path']
+            done = state['done']
+            print "Resuming after %s (%s documents already stored)" % (
+                last_path, done)
+
+        converter = getUtility(IBumblebeeConverter)
+        progress = ProgressReport(total, done)
+        # Only a fresh run resets the timestamp, a resumed one continues
+        reset_timestamp = state is None
+
+        for batch in self.iter_batches(brains, last_path):
+            batch_start = time.time()
+
+            # Patch GeverBumblebeeConverter's batch_query so only the
+            # documents of this batch get stored
+            converter.batch_query = dict(
+                self.query, UID=[brain.UID for brain in batch])
+            converter.store(deferred=True, reset_timestamp=reset_timestamp)
+            reset_timestamp = False
+
+            transaction.commit()
+
+            done += len(batch)
+            self.cursor.save(batch[-1].getPath(), done, total)
+            progress.update(len(batch))
+
+            self.throttle(len(batch), time.time() - batch_start)
+
+        self.cursor.clear()
+        print "Done."
+
+    def iter_batches(self, brains, last_path):
+        batch = []
+        for brain in brains:
+            if last_path is not None and brain.getPath() <= last_path:
+                continue
+
+            batch.append(brain)
+            if len(batch) >= self.options.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def throttle(self, count, elapsed):
+        if not self.options.rps:
+            return
+
+        min_duration = count / self.options.rps
+        if elapsed < min_duration:
+            time.sleep(min_duration - elapsed)
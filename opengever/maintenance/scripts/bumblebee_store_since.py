@@ -3,15 +3,20 @@ Stores all documents since the given date in Bumblebee.
 
     bin/instance run bumblebee_store_since.py -n 2018-03-28
 
+Documents are stored in committed batches, throttled to a number of store
+requests per second. Interrupted runs resume where they stopped, see
+`bumblebee_store_engine` for details:
+
+    bin/instance run bumblebee_store_since.py -b 200 -r 5 2018-03-28
+
 """
 from datetime import datetime
-from ftw.bumblebee.interfaces import IBumblebeeable
-from ftw.bumblebee.interfaces import IBumblebeeConverter
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.bumblebee_store_engine import add_store_options
+from opengever.maintenance.scripts.bumblebee_store_engine import BumblebeeStoreEngine
 from plone import api
-from zope.component import getUtility
 import logging
 import sys
 import transaction
@@ -24,45 +29,24 @@ stream_handler = log.root.handlers[0]
 stream_handler.setLevel(logging.INFO)
 
 
-def get_documents_to_store(date_range):
-    catalog = api.portal.get_tool('portal_catalog')
-    brains = catalog.unrestrictedSearchResults(
-        portal_type='opengever.document.document', created=date_range)
-    return brains
-
-
 def store_since(since, options):
-    date_range = {'query': (since,), 'range': 'min'}
-    brains = get_documents_to_store(date_range)
-    print "Considering %s documents total" % len(brains)
-
-    for brain in brains:
-        print "Considering: %s - %s" % (brain.created, brain.getPath())
-
-    if not options.dryrun:
-        converter = getUtility(IBumblebeeConverter)
-
-        # Patch GeverBumblebeeConverter's batch_query so we can limit
-        # by date range instead of storing ALL documents
-        query = {'object_provides': IBumblebeeable.__identifier__}
-        query['created'] = date_range
-        converter.batch_query = query
+    catalog = api.portal.get_tool('portal_catalog')
+    query = {'created': {'query': (since,), 'range': 'min'}}
+    job = 'bumblebee_store_since %s' % since.strftime('%Y-%m-%d')
 
-        converter.store(deferred=True, reset_timestamp=True)
-    return
+    BumblebeeStoreEngine(catalog, query, job, options).run()
 
 
 if __name__ == '__main__':
     app = setup_app()
 
     parser = setup_option_parser()
-    parser.add_option("-n", "--dry-run", action="store_true",
-                      dest="dryrun", default=False)
+    add_store_options(parser)
     (options, args) = parser.parse_args()
 
     if len(args) != 1:
         print "Must supply exactly one argument (<since>, in %Y-%m-%d)"
-        print "Usage: bin/instance run bumblebee_store_since.py -n <since>"
+        print "Usage: bin/instance run bumblebee_store_since.py [-n] [-b <batch-size>] [-r <rps>] <since>"
         sys.exit(1)
 
     since = datetime.strptime(args[0], '%Y-%m-%d')
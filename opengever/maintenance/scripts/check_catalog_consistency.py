@@ -1,31 +1,78 @@
 """
 This script attempts to discover inconsistencies in the internal data
 structures of the catalog.
+
+    bin/instance run check_catalog_consistency.py [-p <processes>] [-o <path>]
+
+The `IndexConsistencyChecker` checks one index at a time. It streams the
+index's forward (`_index`) and reverse (`_unindex`) BTrees once each and
+compares them in bulk, instead of fetching the data of every index for
+every brain. Indexes are checked in parallel by -p worker processes (see
+opengever.maintenance.parallel). Every inconsistency found is written as a
+JSON line (index, problem, rid, path, value) to var/log/ (or -o), to be used
+by a repair step, e.g. reindexing the affected paths in the affected index.
+
+Problems reported:
+
+orphaned_rid       The index contains a RID that isn't in the catalog.
+missing_forward    The reverse index has a value for a RID, that the forward
+                   index doesn't have.
+missing_reverse    The forward index has a RID for a value, that the reverse
+                   index doesn't have.
+unknown_wid        A text index references a word ID missing in the lexicon.
+catalog_uid        The catalog's `paths` and `uids` mappings disagree.
+catalog_metadata   A cataloged RID doesn't have a metadata record.
+
+The --per-object option runs the old check (also available as check
+catalog_consistency in run_object_audit.py), which fetches the data of all
+indexes for every brain.
 """
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import difference
+from BTrees.IOBTree import IOBTree
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.parallel import chunked
+from opengever.maintenance.parallel import WorkerPool
+from opengever.maintenance.scripts.object_audit import AuditChecker
+from opengever.maintenance.scripts.object_audit import ObjectAuditEngine
+from opengever.maintenance.utils import LogFilePathFinder
 from plone import api
+from Products.PluginIndexes.BooleanIndex.BooleanIndex import BooleanIndex
+from Products.PluginIndexes.common.UnIndex import UnIndex
+from Products.PluginIndexes.KeywordIndex.KeywordIndex import KeywordIndex
+from Products.ZCTextIndex.WidCode import decode
+from Products.ZCTextIndex.ZCTextIndex import ZCTextIndex
+import json
 
 
 SEPARATOR = '-' * 78
 
+HASH_MASK = 2 ** 64 - 1
+
+
+class CatalogConsistencyChecker(AuditChecker):
 
-class CatalogConsistencyChecker(object):
+    name = 'catalog_consistency'
+
+    # Only catalog data structures are checked
+    needs_object = False
 
     def __init__(self):
         self.catalog = api.portal.get_tool('portal_catalog')
 
-    def check(self):
-        brains = self.catalog.unrestrictedSearchResults()
+    def run(self):
+        ObjectAuditEngine([self], self.catalog).run()
 
-        for brain in brains:
-            # Trigger RID key errors
-            self._get_index_data_for_brain(brain)
+    def check(self, obj, brain):
+        # Trigger RID key errors
+        self._get_index_data_for_brain(brain)
 
-            # Trigger key errors in _wordinfo mapping
-            self._check_wordinfo_consistency(brain)
+        # Trigger key errors in _wordinfo mapping
+        self._check_wordinfo_consistency(brain)
 
+    def finish(self):
         print "All checks done."
 
     def _get_index_data_for_brain(self, brain):
@@ -99,16 +146,241 @@ class CatalogConsistencyChecker(object):
                     print msg.format(idx_name, word, rid, e, brain.getPath())
 
 
+def combine(checksums, rid, value):
+    """Add the hash of `value` to the order independent checksum of `rid`.
+    """
+    checksums[rid] = (checksums.get(rid, 0) + hash(value)) & HASH_MASK
+
+
+class IndexConsistencyChecker(object):
+    """Compares the forward and reverse BTrees of catalog indexes in bulk.
+
+    For every RID, a checksum of the values is computed once while streaming
+    the forward index and once while streaming the reverse index. Only RIDs
+    with differing checksums are looked at in detail.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._catalog = catalog._catalog
+        self.paths = self._catalog.paths
+
+    def check_index(self, name):
+        index = self._catalog.getIndex(name)
+        problems = []
+
+        def report(problem, rid, value=None):
+            problems.append({'index': name,
+                             'problem': problem,
+                             'rid': rid,
+                             'path': self.paths.get(rid),
+                             'value': repr(value)})
+
+        if isinstance(index, ZCTextIndex):
+            self.check_text_index(index, report)
+        elif isinstance(index, BooleanIndex):
+            self.check_boolean_index(index, report)
+        elif isinstance(index, UnIndex) and hasattr(
+                getattr(index, '_index', None), 'iteritems'):
+            self.check_unindex(index, report)
+        else:
+            # At least make sure the index doesn't reference unknown RIDs
+            # (e.g. DateRangeIndex, ExtendedPathIndex)
+            unindex = getattr(index, '_unindex', None)
+            if unindex is not None:
+                self.check_orphaned_rids(unindex, report)
+
+        return {'index': name,
+                'meta_type': index.meta_type,
+                'problems': problems}
+
+    def check_orphaned_rids(self, unindex, report):
+        if isinstance(unindex, IOBTree):
+            orphaned = difference(unindex, self.paths).iteritems()
+        else:
+            orphaned = ((rid, value) for rid, value in unindex.iteritems()
+                        if rid not in self.paths)
+
+        for rid, value in orphaned:
+            report('orphaned_rid', rid, value)
+
+    def check_unindex(self, index, report):
+        multi_valued = isinstance(index, KeywordIndex)
+
+        def iter_values(value):
+            if multi_valued:
+                return value
+            return (value, )
+
+        forward = {}
+        for value, rids in index._index.iteritems():
+            if isinstance(rids, int):
+                rids = (rids, )
+            for rid in rids:
+                combine(forward, rid, value)
+
+        reverse = {}
+        for rid, values in index._unindex.iteritems():
+            for value in iter_values(values):
+                combine(reverse, rid, value)
+
+        self.check_orphaned_rids(index._unindex, report)
+
+        forward_only = set()
+        for rid in self.get_differing_rids(forward, reverse):
+            # Look at the RID in detail
+            values = set(iter_values(index._unindex.get(rid, ())))
+            checksum = 0
+            for value in values:
+                rids = index._index.get(value)
+                if isinstance(rids, int):
+                    rids = (rids, )
+                if rids is None or rid not in rids:
+                    report('missing_forward', rid, value)
+                else:
+                    checksum = (checksum + hash(value)) & HASH_MASK
+
+            if checksum != forward.get(rid, 0):
+                # The forward index has values the reverse index doesn't
+                forward_only.add(rid)
+
+        if not forward_only:
+            return
+
+        # Find those values with another pass over the forward index
+        for value, rids in index._index.iteritems():
+            if isinstance(rids, int):
+                rids = (rids, )
+            for rid in forward_only.intersection(rids):
+                if value not in iter_values(index._unindex.get(rid, ())):
+                    report('missing_reverse', rid, value)
+
+    def get_differing_rids(self, forward, reverse):
+        for rid in sorted(set(forward) | set(reverse)):
+            if forward.get(rid) != reverse.get(rid):
+                yield rid
+
+    def check_boolean_index(self, index, report):
+        # The forward index only contains the RIDs of the less frequent value
+        indexed = IITreeSet(index._index)
+        expected = IITreeSet(rid for rid, value in index._unindex.iteritems()
+                             if value == index._index_value)
+
+        self.check_orphaned_rids(index._unindex, report)
+        for rid in expected:
+            if rid not in indexed:
+                report('missing_forward', rid, bool(index._index_value))
+        for rid in indexed:
+            if rid not in expected:
+                report('missing_reverse', rid, bool(index._index_value))
+
+    def check_text_index(self, index, report):
+        text_index = index.index
+        lexicon = index.getLexicon()
+
+        for wid in difference(text_index._wordinfo, lexicon._words).keys():
+            report('unknown_wid', None, wid)
+
+        forward = {}
+        for wid, postings in text_index._wordinfo.iteritems():
+            for rid in postings.keys():
+                combine(forward, rid, wid)
+
+        reverse = {}
+        for rid, widcode in text_index._docwords.iteritems():
+            for wid in set(decode(widcode)):
+                combine(reverse, rid, wid)
+
+        self.check_orphaned_rids(text_index._docwords, report)
+
+        for rid in self.get_differing_rids(forward, reverse):
+            widcode = text_index._docwords.get(rid)
+            if widcode is None:
+                report('missing_reverse', rid)
+                continue
+
+            wids = set(decode(widcode))
+            for wid in sorted(wids):
+                postings = text_index._wordinfo.get(wid)
+                if postings is None or rid not in postings:
+                    report('missing_forward', rid, wid)
+
+    def check_catalog(self):
+        """Check the catalog's own mappings (paths, uids and metadata).
+        """
+        problems = []
+        for path, rid in self._catalog.uids.iteritems():
+            if self.paths.get(rid) != path:
+                problems.append({'index': None, 'problem': 'catalog_uid',
+                                 'rid': rid, 'path': path,
+                                 'value': repr(self.paths.get(rid))})
+
+        for rid, path in difference(self.paths, self._catalog.data).iteritems():
+            problems.append({'index': None, 'problem': 'catalog_metadata',
+                             'rid': rid, 'path': path, 'value': None})
+        return problems
+
+
+def _setup_worker(site):
+    return IndexConsistencyChecker(api.portal.get_tool('portal_catalog'))
+
+
+def _check_index_shard(checker, names):
+    return [checker.check_index(name) for name in names]
+
+
+def check_indexes(plone, processes, output_path):
+    catalog = api.portal.get_tool('portal_catalog')
+    names = sorted(catalog._catalog.indexes.keys())
+
+    total = 0
+    with open(output_path, 'w') as output:
+
+        def write(problems):
+            for problem in problems:
+                output.write(json.dumps(problem) + '\n')
+
+        problems = IndexConsistencyChecker(catalog).check_catalog()
+        write(problems)
+        total += len(problems)
+        print "catalog: %s problems" % len(problems)
+
+        pool = WorkerPool(plone, processes, _setup_worker, _check_index_shard)
+        for results in pool.imap(chunked(names, 1)):
+            for result in results:
+                write(result['problems'])
+                total += len(result['problems'])
+                print "%s (%s): %s problems" % (
+                    result['index'], result['meta_type'],
+                    len(result['problems']))
+
+    print SEPARATOR
+    print "%s problems written to %s" % (total, output_path)
+
+
 def main():
     app = setup_app()
 
     parser = setup_option_parser()
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      default=1)
+    parser.add_option("-o", "--output", dest="output_path", default=None)
+    parser.add_option("--per-object", action="store_true",
+                      dest="per_object", default=False)
     (options, args) = parser.parse_args()
 
     print SEPARATOR
-    setup_plone(app, options)
+    plone = setup_plone(app, options)
+
+    if options.per_object:
+        CatalogConsistencyChecker().run()
+        return
 
-    CatalogConsistencyChecker().check()
+    output_path = options.output_path
+    if output_path is None:
+        output_path = LogFilePathFinder().get_logfile_path(
+            'catalog-consistency', extension='jsonl')
+    check_indexes(plone, options.processes, output_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+"""
+Compares the documents in Solr with the objects in the catalog.
+
+    bin/instance run diff_catalog_solr.py [--fields <f1,f2,...>] [--repair [-n]]
+
+Pages through all Solr documents sorted by UID (with a cursorMark) and walks
+the catalog's UID index in the same order, like a merge join. For every
+document in both, a digest of the selected fields (catalog metadata columns
+and `path`, by default path, portal_type, review_state and modified) is
+compared. Reports
+
+missing     Objects in the catalog that aren't in Solr
+orphaned    Documents in Solr that aren't in the catalog
+stale       Documents whose fields differ from the catalog
+
+as JSON lines (status, uid, path, fields) to var/log/ (or -o).
+
+With --repair, missing objects are indexed in Solr, the differing fields of
+stale documents are updated with atomic updates, and orphaned documents are
+deleted. The updates are sent in bulk (--batch-size) and committed once at
+the end (see solr_batch.py). Values are taken from the objects, so if the
+catalog is what's out of date, a repaired document might still differ from
+the catalog on the next run. -n only reports what would be repaired.
+"""
+from DateTime import DateTime
+from ftw.solr.interfaces import ISolrIndexHandler
+from Missing import MV
+from opengever.maintenance.debughelpers import setup_app
+from opengever.maintenance.debughelpers import setup_option_parser
+from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.solr_batch import iter_solr_docs
+from opengever.maintenance.scripts.solr_batch import SolrUpdateBuffer
+from opengever.maintenance.utils import LogFilePathFinder
+from plone import api
+from zope.component import getMultiAdapter
+import hashlib
+import json
+import re
+import transaction
+
+
+DEFAULT_FIELDS = ('path', 'portal_type', 'review_state', 'modified')
+
+SOLR_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?Z$')
+
+
+def normalize(value):
+    """Normalize catalog metadata and Solr values, so they can be compared.
+    """
+    if isinstance(value, DateTime):
+        # Solr dates are UTC, with varying precision
+        return value.toZone('UTC').ISO8601()[:19]
+    if isinstance(value, basestring) and SOLR_DATE.match(value):
+        return value[:19]
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(item) for item in value)
+    if value is MV or value == '' or value == ():
+        # Not indexed in Solr
+        return None
+    return value
+
+
+class CatalogSolrDiffer(object):
+
+    def __init__(self, fields=DEFAULT_FIELDS, output_path=None,
+                 repair=False, dryrun=False, batch_size=1000,
+                 soft_commit_interval=0):
+        self.catalog = api.portal.get_tool('portal_catalog')
+        self._catalog = self.catalog._catalog
+        self.portal = api.portal.get()
+        self.fields = list(fields)
+        self.repair = repair
+        self.dryrun = dryrun
+        self.batch_size = batch_size
+
+        unknown = [name for name in self.fields
+                   if name != 'path' and name not in self._catalog.schema]
+        if unknown:
+            raise ValueError(
+                'Fields %r are not catalog metadata columns.' % unknown)
+
+        if output_path is None:
+            output_path = LogFilePathFinder().get_logfile_path(
+                'catalog-solr-diff', extension='jsonl')
+        self.output_path = output_path
+
+        self.buffer = None
+        if repair and not dryrun:
+            self.buffer = SolrUpdateBuffer(batch_size, soft_commit_interval)
+
+        self.stats = {'missing': 0, 'orphaned': 0, 'stale': 0, 'ok': 0}
+
+    def run(self):
+        with open(self.output_path, 'w') as output:
+            for status, uid, rid, doc, fields in self.diff():
+                self.stats[status] += 1
+                if status == 'ok':
+                    continue
+
+                if rid is not None:
+                    path = self._catalog.paths.get(rid)
+                else:
+                    path = doc.get('path')
+                output.write(json.dumps({
+                    'status': status, 'uid': uid, 'path': path,
+                    'fields': fields}) + '\n')
+
+                if self.repair:
+                    self.repair_doc(status, uid, path, fields)
+
+        if self.buffer is not None:
+            self.buffer.finish()
+
+        for status in ('ok', 'missing', 'orphaned', 'stale'):
+            print "%s: %s" % (status, self.stats[status])
+        print "Differences written to %s" % self.output_path
+
+    def diff(self):
+        """Merge join the catalog's UID index and the Solr documents, both
+        sorted by UID. Yields (status, uid, rid, solr doc, differing fields).
+        """
+        catalog_items = self._catalog.getIndex('UID')._index.iteritems()
+        solr_docs = iter_solr_docs(fields=self.fields,
+                                   batch_size=self.batch_size)
+
+        item = next(catalog_items, None)
+        doc = next(solr_docs, None)
+        while item is not None or doc is not None:
+            doc_uid = str(doc['UID']) if doc is not None else None
+
+            if doc is None or (item is not None and item[0] < doc_uid):
+                yield 'missing', item[0], item[1], None, None
+                item = next(catalog_items, None)
+
+            elif item is None or doc_uid < item[0]:
+                yield 'orphaned', doc_uid, None, doc, None
+                doc = next(solr_docs, None)
+
+            else:
+                uid, rid = item
+                catalog_values = self.get_catalog_values(rid)
+                solr_values = [normalize(doc.get(name)) for name in self.fields]
+                if self.digest(catalog_values) == self.digest(solr_values):
+                    yield 'ok', uid, rid, doc, None
+                else:
+                    fields = [name for name, catalog_value, solr_value
+                              in zip(self.fields, catalog_values, solr_values)
+                              if catalog_value != solr_value]
+                    yield 'stale', uid, rid, doc, fields
+
+                item = next(catalog_items, None)
+                doc = next(solr_docs, None)
+
+    def get_catalog_values(self, rid):
+        record = self._catalog.data[rid]
+        values = []
+        for name in self.fields:
+            if name == 'path':
+                values.append(normalize(self._catalog.paths[rid]))
+            else:
+                values.append(normalize(record[self._catalog.schema[name]]))
+        return values
+
+    @staticmethod
+    def digest(values):
+        return hashlib.md5(repr(values)).digest()
+
+    def repair_doc(self, status, uid, path, fields):
+        if self.dryrun:
+            print "Would repair %s document %s (%s)" % (status, uid, path)
+            return
+
+        if status == 'orphaned':
+            self.buffer.connection.delete(uid)
+            self.buffer.added()
+            return
+
+        obj = self.portal.unrestrictedTraverse(path, None)
+        if obj is None:
+            print "Can't repair %s, object not found at %s" % (uid, path)
+            return
+
+        handler = getMultiAdapter((obj, self.buffer.manager), ISolrIndexHandler)
+        if status == 'missing':
+            handler.add(None)
+        else:
+            handler.add(fields)
+        self.buffer.added()
+
+
+def main():
+    app = setup_app()
+
+    parser = setup_option_parser()
+    parser.add_option("--fields", dest="fields",
+                      default=','.join(DEFAULT_FIELDS),
+                      help="Comma separated fields to compare")
+    parser.add_option("-o", "--output", dest="output_path", default=None)
+    parser.add_option("--repair", action="store_true", dest="repair",
+                      default=False)
+    parser.add_option("-n", "--dry-run", action="store_true",
+                      dest="dryrun", default=False)
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+                      default=1000)
+    parser.add_option("--soft-commit-interval", dest="soft_commit_interval",
+                      type="int", default=0)
+    (options, args) = parser.parse_args()
+
+    setup_plone(app, options)
+
+    # Only Solr gets modified
+    transaction.doom()
+
+    differ = CatalogSolrDiffer(
+        fields=options.fields.split(','),
+        output_path=options.output_path,
+        repair=options.repair,
+        dryrun=options.dryrun,
+        batch_size=options.batch_size,
+        soft_commit_interval=options.soft_commit_interval)
+    differ.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,17 @@
 """
 Script to find field values that haven't been persisted on objects.
 
-    bin/instance run find_non_persisted_values.py
+    bin/instance run find_non_persisted_values.py [--fast]
+
+With --fast, the pickled state of the content records is checked for the
+fields' attribute names / annotation keys instead of loading every object
+(see `FastNonPersistedValueFinder`).
 
 This script logs a detailed CSV report and a summary to var/log/, and displays
 some progress info and stats on STDERR/STDOUT.
 """
 
+from Acquisition import aq_base
 from App.config import getConfiguration
 from collections import Counter
 from datetime import datetime
@@ -14,9 +19,20 @@ from opengever.base.default_values import get_persisted_value_for_field
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.parallel import chunked
+from opengever.maintenance.scripts.object_audit import AuditChecker
+from opengever.maintenance.scripts.object_audit import get_wrapped
+from opengever.maintenance.scripts.object_audit import iter_btree_keys
+from opengever.maintenance.scripts.object_audit import load_state
+from opengever.maintenance.scripts.object_audit import ObjectAuditEngine
+from opengever.maintenance.scripts.object_audit import PersistentReference
+from opengever.maintenance.scripts.object_audit import StorageObjectSource
+from opengever.maintenance.scripts.object_audit import StorageRecord
 from operator import itemgetter
 from plone import api
+from plone.behavior.annotation import AnnotationsFactoryImpl
 from plone.dexterity.utils import iterSchemataForType
+from plone.uuid.interfaces import ATTRIBUTE_NAME
 from zope.component import getUtility
 from zope.intid.interfaces import IIntIds
 from zope.schema import getFieldsInOrder
@@ -29,7 +45,10 @@ import transaction
 root_logger = logging.root
 
 
-class NonPersistedValueFinder(object):
+class NonPersistedValueFinder(AuditChecker):
+
+    name = 'non_persisted_values'
+    supports_storage_source = True
 
     CSV_HEADER = "intid;portal_type;path;created;missing_fields"
     SCHEMA_CACHE = {}
@@ -49,32 +68,42 @@ class NonPersistedValueFinder(object):
             'find-nonpersistent-values-summary-%s.log' % ts)
 
     def run(self):
-        sys.stderr.write("Checking for non-persisted values...\n\n")
+        ObjectAuditEngine([self], self.catalog).run()
 
-        all_brains = self.catalog.unrestrictedSearchResults()
-        total = len(all_brains)
-
-        with open(self.csv_log_path, 'w') as self.csv_log:
-            with open(self.summary_log_path, 'w') as self.summary_log:
-                self.csv_log.write(self.CSV_HEADER + '\n')
+    def start(self):
+        sys.stderr.write("Checking for non-persisted values...\n\n")
 
-                for i, brain in enumerate(all_brains):
-                    obj = brain.getObject()
-                    missing_fields = self.check_for_missing_fields(obj)
-                    self.update_stats(missing_fields)
+        self.csv_log = open(self.csv_log_path, 'w')
+        self.summary_log = open(self.summary_log_path, 'w')
+        self.csv_log.write(self.CSV_HEADER + '\n')
 
-                    if missing_fields:
-                        self.write_csv_row(obj, missing_fields)
+    def check(self, obj, brain):
+        missing_fields = self.check_for_missing_fields(obj)
+        self.update_stats(missing_fields)
 
-                    if i % 100 == 0:
-                        sys.stderr.write("Progress: %s of %s objects\n" % (i, total))
+        if missing_fields:
+            self.write_csv_row(get_wrapped(obj, brain), missing_fields)
 
-                self.display_stats()
+    def finish(self):
+        self.display_stats()
+        self.summary_log.close()
+        self.csv_log.close()
 
     def check_for_missing_fields(self, obj):
         missing_fields = []
-        portal_type = obj.portal_type
+        for schema, field in self.iter_checked_fields(obj.portal_type):
+            try:
+                get_persisted_value_for_field(obj, field)
+            except AttributeError:
+                missing_fields.append((schema.__identifier__, field.getName()))
+
+        missing_fields.sort()
+        return missing_fields
 
+    def iter_checked_fields(self, portal_type):
+        """Yield (schema, field) for all fields of `portal_type` that should
+        have a persisted value.
+        """
         if portal_type not in self.SCHEMA_CACHE:
             self.SCHEMA_CACHE[portal_type] = list(iterSchemataForType(portal_type))
         schemas = self.SCHEMA_CACHE[portal_type]
@@ -100,13 +129,7 @@ class NonPersistedValueFinder(object):
                     # for all intents and purposes.
                     continue
 
-                try:
-                    get_persisted_value_for_field(obj, field)
-                except AttributeError:
-                    missing_fields.append((schema.__identifier__, name))
-
-        missing_fields.sort()
-        return missing_fields
+                yield schema, field
 
     def write_csv_row(self, obj, missing_fields):
         created = str(obj.created())
@@ -180,15 +203,170 @@ class NonPersistedValueFinder(object):
         return log_dir
 
 
+class FieldPresencePlan(object):
+    """Where the fields of a portal_type get persisted, precomputed as
+    bitmasks: every checked field gets a bit, and attribute names (for fields
+    stored on the object itself) and annotation keys (for fields of behaviors
+    with annotation storage) map to the bits of their fields.
+
+    The plan is derived from a sample object of the portal_type, by looking
+    at the storage adapters of its schemas. If a schema uses any other kind
+    of storage, the plan can't be used (`fallback` is set) and objects of
+    that type have to be checked the slow way.
+    """
+
+    def __init__(self, finder, obj):
+        self.fields = []
+        self.attribute_bits = {}
+        self.annotation_bits = {}
+        self.fallback = False
+
+        for schema, field in finder.iter_checked_fields(obj.portal_type):
+            name = field.getName()
+            bit = 1 << len(self.fields)
+            self.fields.append((schema.__identifier__, name))
+
+            try:
+                storage = field.interface(obj)
+            except TypeError:
+                self.fallback = True
+                continue
+
+            if aq_base(storage) is aq_base(obj):
+                key = name
+                bits = self.attribute_bits
+            elif isinstance(storage, AnnotationsFactoryImpl):
+                key = storage.__dict__['prefix'] + name
+                bits = self.annotation_bits
+            else:
+                self.fallback = True
+                continue
+
+            bits[key] = bits.get(key, 0) | bit
+
+        self.expected = (1 << len(self.fields)) - 1
+
+    def get_missing_fields(self, attribute_names, annotation_keys):
+        present = 0
+        for name in attribute_names:
+            present |= self.attribute_bits.get(name, 0)
+        for key in annotation_keys:
+            present |= self.annotation_bits.get(key, 0)
+
+        missing = self.expected & ~present
+        return sorted(field for i, field in enumerate(self.fields)
+                      if missing & (1 << i))
+
+
+class FastNonPersistedValueFinder(NonPersistedValueFinder):
+    """Detection-only variant of the `NonPersistedValueFinder`.
+
+    Walks the raw storage records of the content classes and checks which
+    attribute names and annotation keys are present in the pickled state,
+    instead of loading every object and asking its schema adapters. Objects
+    are only loaded to build the `FieldPresencePlan` for their portal_type,
+    for portal_types whose plan can't be used, and to write the report rows
+    of objects with missing values. Writes the same CSV report and summary.
+    """
+
+    def __init__(self, batch_size=1000):
+        super(FastNonPersistedValueFinder, self).__init__()
+        self.batch_size = batch_size
+        self.plans = {}
+
+    def run(self):
+        self.source = StorageObjectSource(api.portal.get(), self.catalog)
+        self.start()
+        try:
+            for i, batch in enumerate(
+                    chunked(self.source.iter_records(), self.batch_size)):
+                self.check_batch(batch)
+                sys.stderr.write(
+                    "Progress: %s\n" % self.source.progress(
+                        self.stats['missing'] + self.stats['ok']))
+        finally:
+            self.finish()
+
+    def check_batch(self, records):
+        states = []
+        for oid, data in records:
+            state = load_state(data)
+            if not isinstance(state, dict):
+                continue
+            if not self.source.is_cataloged(state.get(ATTRIBUTE_NAME)):
+                continue
+            states.append((oid, state))
+
+        # Fetch the annotation records of the whole batch in one go, if
+        # the storage supports it.
+        prefetch = getattr(self.source.conn, 'prefetch', None)
+        if prefetch is not None:
+            oids = [state['__annotations__'].oid for oid, state in states
+                    if isinstance(state.get('__annotations__'),
+                                  PersistentReference)]
+            oids = filter(None, oids)
+            if oids:
+                prefetch(oids)
+
+        for oid, state in states:
+            missing_fields = self.check_state(oid, state)
+            self.update_stats(missing_fields)
+
+            if missing_fields:
+                obj = self.source.conn.get(oid)
+                record = StorageRecord(self.source, obj)
+                self.write_csv_row(get_wrapped(obj, record), missing_fields)
+
+    def check_state(self, oid, state):
+        plan = self.get_plan(oid, state['portal_type'])
+        if plan.fallback:
+            return self.check_for_missing_fields(self.source.conn.get(oid))
+
+        annotation_keys = ()
+        if plan.annotation_bits:
+            try:
+                annotation_keys = self.get_annotation_keys(state)
+            except ValueError:
+                return self.check_for_missing_fields(
+                    self.source.conn.get(oid))
+
+        return plan.get_missing_fields(state, annotation_keys)
+
+    def get_plan(self, oid, portal_type):
+        if portal_type not in self.plans:
+            self.plans[portal_type] = FieldPresencePlan(
+                self, self.source.conn.get(oid))
+        return self.plans[portal_type]
+
+    def get_annotation_keys(self, state):
+        annotations = state.get('__annotations__')
+        if annotations is None:
+            return ()
+        if not isinstance(annotations, PersistentReference):
+            raise ValueError("Annotations aren't a persistent OOBTree")
+        return set(iter_btree_keys(self.source, annotations))
+
+
 if __name__ == '__main__':
     app = setup_app()
 
     parser = setup_option_parser()
+
+    parser.add_option("--fast", action="store_true", dest="fast",
+                      default=False,
+                      help="Check the pickled state of the storage records "
+                           "instead of loading every object")
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+                      default=1000,
+                      help="Number of records checked per batch (--fast)")
     (options, args) = parser.parse_args()
 
     plone = setup_plone(app, options)
 
     transaction.doom()
 
-    finder = NonPersistedValueFinder()
+    if options.fast:
+        finder = FastNonPersistedValueFinder(batch_size=options.batch_size)
+    else:
+        finder = NonPersistedValueFinder()
     finder.run()
@@ -1,24 +1,36 @@
 from logging import getLogger
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.object_audit import AuditChecker
+from opengever.maintenance.scripts.object_audit import ObjectAuditEngine
 from plone import api
 from zope.app.intid.interfaces import IIntIds
 import argparse
+import sys
 
 
-def main(portal):
-    intid_util = api.portal.getUtility(IIntIds)
-    for brain in portal.portal_catalog.unrestrictedSearchResults():
-        try:
-            obj = brain.getObject()
-        except KeyError:
-            path = brain.getPath()
-            portal_type = brain.portal_type
-            created = str(brain.created)
-            logger.error('Cannot get object of brain %s of portal type %s created on %s', path, portal_type, created)
-            continue
+logger = getLogger()
+
+
+class MissingIntIdFinder(AuditChecker):
+
+    name = 'missing_intids'
+
+    def __init__(self):
+        self.intid_util = api.portal.getUtility(IIntIds)
+
+    def run(self):
+        ObjectAuditEngine([self]).run()
+
+    def object_missing(self, brain):
+        path = brain.getPath()
+        portal_type = brain.portal_type
+        created = str(brain.created)
+        logger.error('Cannot get object of brain %s of portal type %s created on %s', path, portal_type, created)
+
+    def check(self, obj, brain):
         try:
-            intid_util.getId(obj)
+            self.intid_util.getId(obj)
         except KeyError:
             path = '/'.join(obj.getPhysicalPath())
             portal_type = obj.portal_type
@@ -26,8 +38,11 @@ def main(portal):
             logger.error('IntId missing on object %s of portal type %s created on %s', path, portal_type, created)
 
 
+def main(portal):
+    MissingIntIdFinder().run()
+
+
 if __name__ == '__main__':
-    logger = getLogger()
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', dest='site_root', default=None, help='Absolute path to the Plone site')
     options = parser.parse_args(sys.argv[3:])
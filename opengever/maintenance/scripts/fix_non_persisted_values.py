@@ -5,21 +5,34 @@ Script to fix (persist) field values that haven't been persisted on objects.
 
 This script logs a detailed CSV report and a summary to var/log/, and displays
 some progress info and stats on STDERR/STDOUT.
+
+Reindexing is queued (merging multiple reindexes of the same object) and
+done in batches of --solr-batch-size objects, and before the transaction is
+committed. Solr is only updated once the transaction has been committed
+successfully: the reindexed objects are remembered (by path) and their
+atomic updates are then sent in update requests of --solr-batch-size
+objects (see solr_batch.py). Solr is hard committed once at the end, with
+--solr-soft-commit-interval <n> a soft commit is sent every n objects in
+between (otherwise Solr's autoSoftCommit makes the changes visible). Dry
+runs don't send anything to Solr.
 """
 
 from App.config import getConfiguration
 from collections import Counter
 from collections import namedtuple
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
 from ftw.mail import utils
-from ftw.solr.interfaces import ISolrConnectionManager
 from ftw.solr.interfaces import ISolrIndexHandler
 from opengever.base.default_values import get_persisted_value_for_field
 from opengever.dossier.dossiertemplate.behaviors import IDossierTemplateSchema
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.object_audit import AuditChecker
+from opengever.maintenance.scripts.object_audit import ObjectAuditEngine
+from opengever.maintenance.scripts.solr_batch import SolrUpdateBuffer
 from opengever.meeting.interfaces import IMeetingDossier
 from opengever.meeting.proposal import IProposal
 from opengever.task.task import ITask
@@ -33,7 +46,7 @@ from zope.schema.interfaces import RequiredMissing
 from zope.component import getMultiAdapter
 from zope.component import getUtility
 from zope.component import queryMultiAdapter
-from zope.component import queryUtility
+from zope.interface import providedBy
 from zope.intid.interfaces import IIntIds
 from zope.schema import getFieldsInOrder
 import logging
@@ -42,6 +55,9 @@ import sys
 import transaction
 
 
+SOLR_BATCH_SIZE = 500
+
+
 # Lightweight data structure to keep track of field values that got persisted
 FixedField = namedtuple(
     'FixedField', [
@@ -53,6 +69,7 @@ FixedField = namedtuple(
     ]
 )
 
+
 # Fields that are not required, and have a field.default (but *not*
 # a field.defaultFactory, which could be dynamic).
 OPTIONAL_WITH_STATIC_DEFAULT = {
@@ -335,6 +352,68 @@ DEPENDENT_INDEXERS = {
 }
 
 
+class FieldFixPlan(object):
+    """How a single field gets fixed, and what it affects when it does.
+    """
+
+    def __init__(self, fixer, schema, field, index_names, metadata_names):
+        self.schema = schema
+        self.field = field
+        self.name = field.getName()
+        self.signature = (schema.__name__, self.name)
+        self.get_value = fixer.get_value_strategy(field)
+
+        # Persisting a static value doesn't change anything that could
+        # have been indexed (see Reindexer.no_dynamic_defaults_fixed)
+        self.static = any([self.name in mapping.get(schema.__name__, [])
+                           for mapping in (OPTIONAL_WITHOUT_DEFAULT,
+                                           OPTIONAL_WITH_STATIC_DEFAULT)])
+        self.indexed = self.name in index_names
+        self.in_metadata = self.name in metadata_names
+        self.dependent = self.name in DEPENDENT_INDEXERS
+
+
+class FixPlan(object):
+    """Everything about fixing objects of a portal_type (with a given set of
+    schemas) that doesn't depend on the individual object, compiled once per
+    run: the fields to check, how their values get determined and which
+    indexes and metadata columns they affect. The metadata indexers are
+    memoized by the `Reindexer`.
+    """
+
+    def __init__(self, fixer, portal_type, schemas):
+        self.portal_type = portal_type
+        self.fields = []
+
+        index_names = set(fixer.catalog.indexes())
+        metadata_names = set(fixer.catalog._catalog.schema.keys())
+
+        for schema in schemas:
+            for field in fixer.get_fields_for_schema(schema):
+                name = field.getName()
+
+                if name == 'changeNote':
+                    # The changeNote field from p.a.versioningbehavior
+                    # is a "fake" field - it never gets persisted, but
+                    # written to request annotations instead
+                    continue
+
+                if name == 'reference_number':
+                    # reference_number is a special field. It never gets
+                    # set directly, but instead acts as a computed field
+                    # for all intents and purposes.
+                    continue
+
+                self.fields.append(FieldFixPlan(
+                    fixer, schema, field, index_names, metadata_names))
+
+        self.by_signature = {f.signature: f for f in self.fields}
+
+    def get(self, fixed_field):
+        return self.by_signature[
+            (fixed_field.schema_name, fixed_field.field_name)]
+
+
 def get_volatile_value(obj, field):
     """Get the volatile field value by using the field accessor.
     This will trigger any fallbacks to default / missing
@@ -345,7 +424,7 @@ def get_volatile_value(obj, field):
     return volatile_value
 
 
-class NonPersistedValueFixer(object):
+class NonPersistedValueFixer(AuditChecker):
     """Queries the catalog for all objects, and persists any field values that
     currently aren't persisted by
       - iterating over all of the schemas of the object's portal_type
@@ -353,17 +432,30 @@ class NonPersistedValueFixer(object):
       - determining the value that the field should have
     """
 
+    name = 'fix_non_persisted_values'
+
     CSV_HEADER = "intid;portal_type;path;created;missing_fields;value_changed"
     SCHEMA_CACHE = {}
     FIELD_CACHE = {}
 
     def __init__(self, options):
         self.reindex = not options.no_reindex
+        self.dryrun = options.dryrun
+        self.solr_batch_size = options.solr_batch_size
+        self.solr_soft_commit_interval = options.solr_soft_commit_interval
 
         self.catalog = api.portal.get_tool('portal_catalog')
         self.intids = getUtility(IIntIds)
         self.reindexer = None
 
+        self.plans = {}
+        self.value_strategies = {}
+        self.value_handler = CustomValueHandler()
+
+        # We have some invalid example content on DEV
+        self.skip_meeting_dossier_responsible = (
+            api.portal.get().title == u'Finanzdirektion (FD) (Dev)')
+
         self.stats = Counter()
         self.stats['by_field'] = Counter()
         self.stats['value_changed_by_field'] = Counter()
@@ -382,47 +474,42 @@ class NonPersistedValueFixer(object):
         self.summary_log.write(line)
 
     def run(self):
-        sys.stderr.write("Fixing non-persisted values...\n\n")
+        ObjectAuditEngine([self], self.catalog).run()
 
-        all_brains = self.catalog.unrestrictedSearchResults()
-        total = len(all_brains)
-
-        self.reindexer = Reindexer(self)
+    def start(self):
+        sys.stderr.write("Fixing non-persisted values...\n\n")
 
-        with open(self.csv_log_path, 'w') as self.csv_log:
-            with open(self.summary_log_path, 'w') as self.summary_log:
-                self.csv_log.write(self.CSV_HEADER + '\n')
+        self.reindexer = Reindexer(
+            self, self.solr_batch_size, self.solr_soft_commit_interval,
+            dryrun=self.dryrun)
 
-                for i, brain in enumerate(all_brains):
-                    try:
-                        obj = brain.getObject()
-                    except KeyError:
-                        # Some deployments seem to have cataloged objects
-                        # where the real object doesn't exist (any more).
-                        self.log("KeyError when doing brain.getObject() "
-                                 "for %s, skipping." % brain.getPath())
-                        continue
+        self.csv_log = open(self.csv_log_path, 'w')
+        self.summary_log = open(self.summary_log_path, 'w')
+        self.csv_log.write(self.CSV_HEADER + '\n')
 
-                    if IDossierTemplateSchema.providedBy(obj):
-                        # DossierTemplates are messed up - they provide the
-                        # IDossier interface, but don't fully implement its
-                        # schema
-                        continue
+    def object_missing(self, brain):
+        self.log("KeyError when doing brain.getObject() "
+                 "for %s, skipping." % brain.getPath())
 
-                    fixed_fields = self.fix_missing_fields(obj, brain)
-                    self.update_stats(fixed_fields)
+    def check(self, obj, brain):
+        if IDossierTemplateSchema.providedBy(obj):
+            # DossierTemplates are messed up - they provide the
+            # IDossier interface, but don't fully implement its
+            # schema
+            return
 
-                    if fixed_fields:
-                        self.write_csv_row(obj, fixed_fields)
+        fixed_fields = self.fix_missing_fields(obj, brain)
+        self.update_stats(fixed_fields)
 
-                    if i % 100 == 0:
-                        sys.stderr.write("Progress: %s of %s objects\n" % (
-                            i, total))
+        if fixed_fields:
+            self.write_csv_row(obj, fixed_fields)
 
-                if self.reindexer.solr_enabled:
-                    self.reindexer._commit_to_solr()
+    def finish(self):
+        self.reindexer.finish()
 
-                self.display_stats()
+        self.display_stats()
+        self.summary_log.close()
+        self.csv_log.close()
 
     def get_fields_for_schema(self, schema):
         """Return fields for given schema (memoized).
@@ -440,84 +527,73 @@ class NonPersistedValueFixer(object):
         schemas = self.SCHEMA_CACHE[portal_type]
         return schemas
 
+    def get_fix_plan(self, portal_type):
+        schemas = self.get_schemas_for_type(portal_type)
+        key = (portal_type, tuple(schema.__identifier__ for schema in schemas))
+        if key not in self.plans:
+            self.plans[key] = FixPlan(self, portal_type, schemas)
+        return self.plans[key]
+
     def fix_missing_fields(self, obj, brain):
         """Persist all field values for the given object.
         """
         fixed_fields = []
-        portal_type = obj.portal_type
+        plan = self.get_fix_plan(obj.portal_type)
 
-        schemas = self.get_schemas_for_type(portal_type)
-        for schema in schemas:
-            fields = self.get_fields_for_schema(schema)
-
-            for field in fields:
-                name = field.getName()
+        for field_plan in plan.fields:
+            field = field_plan.field
+            name = field_plan.name
 
-                if IMeetingDossier.providedBy(obj) and name == 'responsible':
-                    portal = api.portal.get()
-                    if portal.title == u'Finanzdirektion (FD) (Dev)':
-                        # We have some invalid example content on DEV
-                        continue
-
-                if name == 'changeNote':
-                    # The changeNote field from p.a.versioningbehavior
-                    # is a "fake" field - it never gets persisted, but
-                    # written to request annotations instead
-                    continue
-
-                if name == 'reference_number':
-                    # reference_number is a special field. It never gets
-                    # set directly, but instead acts as a computed field
-                    # for all intents and purposes.
-                    continue
+            if (name == 'responsible'
+                    and self.skip_meeting_dossier_responsible
+                    and IMeetingDossier.providedBy(obj)):
+                continue
 
-                try:
-                    get_persisted_value_for_field(obj, field)
-                except AttributeError:
-                    volatile_value = get_volatile_value(obj, field)
-                    value = self.determine_value(obj, field)
-                    field.set(field.interface(obj), value)
+            try:
+                get_persisted_value_for_field(obj, field)
+            except AttributeError:
+                volatile_value = get_volatile_value(obj, field)
+                value = field_plan.get_value(obj, field)
+                field.set(field.interface(obj), value)
 
-                    # Track whether or not the value actually changed
-                    value_changed = volatile_value != value
+                # Track whether or not the value actually changed
+                value_changed = volatile_value != value
 
-                    fixed_fields.append(
-                        FixedField(schema_name=schema.__name__,
-                                   field_name=name,
-                                   new_value=repr(value),
-                                   value_changed=value_changed)
-                    )
+                fixed_fields.append(
+                    FixedField(schema_name=field_plan.schema.__name__,
+                               field_name=name,
+                               new_value=repr(value),
+                               value_changed=value_changed)
+                )
 
         if fixed_fields and self.reindex:
-            self.reindexer.reindex_if_necessary(obj, fixed_fields, brain)
+            self.reindexer.reindex_if_necessary(
+                obj, fixed_fields, brain, plan)
 
         fixed_fields.sort()
         return fixed_fields
 
-    def get_volatile_value(self, obj, field):
-        """Get the volatile field value by using the field accessor.
-        This will trigger any fallbacks to default / missing
-        value that are in place.
-        """
-        bound_field = field.bind(obj)
-        volatile_value = bound_field.get(field.interface(obj))
-        return volatile_value
-
-    def determine_value(self, obj, field):
-        """Determine which value should be persisted for a field.
+    def get_value_strategy(self, field):
+        """Return the function determining which value should be persisted
+        for a field (memoized).
 
         In most cases, this will be the volatile value (the value that is
         currently being returned by fallbacks). For some fields, especially
         those with defaultFactories, we have handlers though, that determine
         the correct value using some custom logic.
         """
+        key = (field.interface.__identifier__, field.getName())
+        if key not in self.value_strategies:
+            self.value_strategies[key] = self.compile_value_strategy(field)
+        return self.value_strategies[key]
+
+    def compile_value_strategy(self, field):
         fieldname = field.getName()
         schema_name = field.interface.__name__
 
         # First check if a special handler exists for this field
-        if CustomValueHandler().available_for(field):
-            value = CustomValueHandler().get_value(obj, field)
-            return value
+        if self.value_handler.available_for(field):
+            return self.value_handler.get_value
 
         # If the field is required we want to persist the value. Under the
         # hood this will eventually call the `determine_default_value` from
@@ -527,59 +603,79 @@ class NonPersistedValueFixer(object):
         # with fields added to the schema after the objects were created or
         # modified.
         if field.required:
-            volatile_value = get_volatile_value(obj, field)
-            return volatile_value
+            return get_volatile_value
 
         if fieldname in OPTIONAL_WITH_STATIC_DEFAULT.get(schema_name, []):
-            assert field.required is False, "Schema: %s Fieldname %s" % (
-                schema_name, fieldname)
-            assert field.default is not None, "Schema: %s Fieldname %s" % (
-                schema_name, fieldname)
-            assert field.defaultFactory is None, "Schema: %s Fieldname %s" % (
-                schema_name, fieldname)
-
-            volatile_value = get_volatile_value(obj, field)
-            # Field has a default - volatile value should therefore
-            # be equal to the field's default
-            assert volatile_value == field.default
-            return volatile_value
+            return self.get_static_default_value
 
         if fieldname in OPTIONAL_WITHOUT_DEFAULT.get(schema_name, []):
-            assert field.required is False, "Schema: %s Fieldname %s" % (
-                schema_name, fieldname)
-            assert field.default is None, "Schema: %s Fieldname %s" % (
-                schema_name, fieldname)
-            assert field.defaultFactory is None, "Schema: %s Fieldname %s" % (
-                schema_name, fieldname)
-
-            volatile_value = get_volatile_value(obj, field)
-            # Field has no default - volatile value should therefore
-            # be equal to the field's missing value
-            assert volatile_value == field.missing_value
-            return volatile_value
+            return self.get_missing_value
 
         # We should not have any default factories that haven't been handled
         # yet at this point.
-        default_factory = field.defaultFactory
-        if default_factory:
-            self.log("")
-            self.log("Field %r has a defaultFactory and no custom handler, "
-                     "refusing to persist its value" % fieldname)
-            try:
-                val = get_persisted_value_for_field(obj, field)
-                self.log("Currently persisted value: %r" % val)
-            except AttributeError:
-                self.log("Currently persisted value: <NO PERSISTED VALUE>")
-
-            self.log("")
-            raise Exception(
-                'Unexpected defaultFactory for field %r.%r' %
-                (schema_name, fieldname))
+        if field.defaultFactory:
+            return self.refuse_default_factory
 
         # If we end up here, it means that we encountered a field that has
         # not explicitly been handled (by either defining a custom handler,
         # or listing it in OPTIONAL_WITH_STATIC_DEFAULT or
         # OPTIONAL_WITHOUT_DEFAULT)
+        return self.refuse_unhandled_field
+
+    def get_static_default_value(self, obj, field):
+        schema_name = field.interface.__name__
+        fieldname = field.getName()
+        assert field.required is False, "Schema: %s Fieldname %s" % (
+            schema_name, fieldname)
+        assert field.default is not None, "Schema: %s Fieldname %s" % (
+            schema_name, fieldname)
+        assert field.defaultFactory is None, "Schema: %s Fieldname %s" % (
+            schema_name, fieldname)
+
+        volatile_value = get_volatile_value(obj, field)
+        # Field has a default - volatile value should therefore
+        # be equal to the field's default
+        assert volatile_value == field.default
+        return volatile_value
+
+    def get_missing_value(self, obj, field):
+        schema_name = field.interface.__name__
+        fieldname = field.getName()
+        assert field.required is False, "Schema: %s Fieldname %s" % (
+            schema_name, fieldname)
+        assert field.default is None, "Schema: %s Fieldname %s" % (
+            schema_name, fieldname)
+        assert field.defaultFactory is None, "Schema: %s Fieldname %s" % (
+            schema_name, fieldname)
+
+        volatile_value = get_volatile_value(obj, field)
+        # Field has no default - volatile value should therefore
+        # be equal to the field's missing value
+        assert volatile_value == field.missing_value
+        return volatile_value
+
+    def refuse_default_factory(self, obj, field):
+        schema_name = field.interface.__name__
+        fieldname = field.getName()
+
+        self.log("")
+        self.log("Field %r has a defaultFactory and no custom handler, "
+                 "refusing to persist its value" % fieldname)
+        try:
+            val = get_persisted_value_for_field(obj, field)
+            self.log("Currently persisted value: %r" % val)
+        except AttributeError:
+            self.log("Currently persisted value: <NO PERSISTED VALUE>")
+
+        self.log("")
+        raise Exception(
+            'Unexpected defaultFactory for field %r.%r' %
+            (schema_name, fieldname))
+
+    def refuse_unhandled_field(self, obj, field):
+        schema_name = field.interface.__name__
+        fieldname = field.getName()
+
         self.log("Unhandled field:\n\n")
 
         def safe_format_op(param):
@@ -707,6 +803,11 @@ class CustomValueHandler(object):
     special logic to determine their value.
     """
 
+    def __init__(self):
+        # (container path, schema, field name) => value of the acquired
+        # defaults, which only depend on the container
+        self.container_values = {}
+
     def get_value(self, obj, field):
         """Get the value for the given field by looking up the custom handler
         and calling it.
@@ -740,6 +841,20 @@ class CustomValueHandler(object):
 
         return volatile_value
 
+    def _get_container_value(self, obj, field):
+        """Get the volatile value of a field with an acquired default,
+        memoized per container.
+        """
+        path = obj.getPhysicalPath()
+        if 'abnahme' in path:
+            # See _get_volatile_value
+            return self._get_volatile_value(obj, field)
+
+        key = (path[:-1], field.interface.__identifier__, field.getName())
+        if key not in self.container_values:
+            self.container_values[key] = self._get_volatile_value(obj, field)
+        return self.container_values[key]
+
     def get_preserved_as_paper_value(self, obj, field):
         """Get value for preserved_as_paper field of IDocumentMetadata behavior.
 
@@ -856,26 +971,28 @@ class CustomValueHandler(object):
     # might not necessarily be what the user saw when they first saved the
     # form. But it's what last got displayed and effectively been used. It's
     # the best we can do.
+    # Since they are acquired from the container, they are the same for all
+    # objects in a container.
 
     def get_classification_value(self, obj, field):
         """Get value for classification field.
         """
-        return self._get_volatile_value(obj, field)
+        return self._get_container_value(obj, field)
 
     def get_custody_period_value(self, obj, field):
         """Get value for custody_period field.
         """
-        return self._get_volatile_value(obj, field)
+        return self._get_container_value(obj, field)
 
     def get_retention_period_value(self, obj, field):
         """Get value for retention_period field.
         """
-        return self._get_volatile_value(obj, field)
+        return self._get_container_value(obj, field)
 
     def get_privacy_layer_value(self, obj, field):
         """Get value for privacy_layer field.
         """
-        return self._get_volatile_value(obj, field)
+        return self._get_container_value(obj, field)
 
     handlers = {
         ('IDocumentMetadata', 'preserved_as_paper'): get_preserved_as_paper_value,  # noqa
@@ -893,19 +1010,35 @@ class CustomValueHandler(object):
 
 class Reindexer(object):
 
-    def __init__(self, fixer):
+    def __init__(self, fixer, solr_batch_size=SOLR_BATCH_SIZE,
+                 solr_soft_commit_interval=0, dryrun=False):
         self.catalog = fixer.catalog
+        self.dryrun = dryrun
         self.stats = fixer.stats
         self.fixer = fixer
+        self.solr_batch_size = solr_batch_size
+        self.solr_soft_commit_interval = solr_soft_commit_interval
 
         self._metadata_names = None
         self._index_names = None
         self._solr_enabled = None
-        self.processed = 0
+        self._solr_buffer = None
+        self.unsafe_indexers = {}
+
+        # path => (obj, idxs, update_metadata) of the queued reindexes
+        self.queue = OrderedDict()
+        self.hooked_transaction = None
+
+        # (path, idxs) of the reindexed objects, sent to Solr once the
+        # transaction has been committed
+        self.solr_pending = []
 
     @property
-    def solr_connection_manager(self):
-        return queryUtility(ISolrConnectionManager)
+    def solr_buffer(self):
+        if self._solr_buffer is None:
+            self._solr_buffer = SolrUpdateBuffer(
+                self.solr_batch_size, self.solr_soft_commit_interval)
+        return self._solr_buffer
 
     @property
     def solr_enabled(self):
@@ -934,16 +1067,16 @@ class Reindexer(object):
             self._index_names = self.catalog.indexes()
         return self._index_names
 
-    def reindex_if_necessary(self, obj, fixed_fields, brain):
+    def reindex_if_necessary(self, obj, fixed_fields, brain, plan):
         """Reindex indexes and metadata for the given object if needed.
         """
         update_metadata = self.needs_metadata_update(
-            obj, fixed_fields, brain)
+            obj, fixed_fields, brain, plan)
 
         self.stats['update_metadata'][update_metadata] += 1
 
         idxs_needing_reindex = self.get_idxs_needing_reindex(
-            obj, fixed_fields, brain)
+            obj, fixed_fields, brain, plan)
 
         if update_metadata or idxs_needing_reindex:
             # If idxs == [] the catalog defaults to *all* indexes, so we
@@ -954,32 +1087,76 @@ class Reindexer(object):
             sys.stderr.write(
                 "Reindexing %s (update_metadata=%r, idxs=%r)\n" % (
                     obj, update_metadata, idxs_needing_reindex))
-            self.catalog.reindexObject(obj, idxs=idxs_needing_reindex,
+            self.queue_reindex(obj, idxs_needing_reindex, update_metadata)
+
+    def queue_reindex(self, obj, idxs, update_metadata):
+        """Queue reindexing an object, merged with an already queued reindex
+        of the same object.
+        """
+        path = '/'.join(obj.getPhysicalPath())
+        idxs = set(idxs)
+        if path in self.queue:
+            queued_obj, queued_idxs, queued_update_metadata = self.queue[path]
+            idxs |= queued_idxs
+            update_metadata = update_metadata or queued_update_metadata
+        self.queue[path] = (obj, idxs, update_metadata)
+
+        # Make sure the queue is processed before the transaction commits,
+        # and Solr is only updated after it has been committed
+        txn = transaction.get()
+        if txn is not self.hooked_transaction:
+            txn.addBeforeCommitHook(self.process_queue)
+            txn.addAfterCommitHook(self.send_to_solr)
+            self.hooked_transaction = txn
+
+        if len(self.queue) >= self.solr_batch_size:
+            self.process_queue()
+
+    def process_queue(self):
+        queue, self.queue = self.queue, OrderedDict()
+        for obj, idxs, update_metadata in queue.values():
+            idxs = sorted(idxs)
+            self.catalog.reindexObject(obj, idxs=idxs,
                                        update_metadata=update_metadata)
-            if self.solr_enabled:
-                self.reindex_in_solr(obj, idxs_needing_reindex, update_metadata)
+            if self.solr_enabled and not self.dryrun:
+                self.queue_solr_update(obj, idxs, update_metadata)
 
-    def reindex_in_solr(self, obj, idxs, update_metadata):
+    def queue_solr_update(self, obj, idxs, update_metadata):
         if update_metadata:
             # If update_metadata is True, we need to force an update of all
             # indexes, irrespective of what `idxs` says. Setting `idxs` to
             # something falsy will cause the handler to not do atomic updates.
             idxs = None
+        self.solr_pending.append(('/'.join(obj.getPhysicalPath()), idxs))
 
-        handler = getMultiAdapter(
-            (obj, self.solr_connection_manager), ISolrIndexHandler)
-        handler.add(idxs)
-
-        if self.processed % 100 == 0:
-            self._commit_to_solr()
-
-        self.processed += 1
-
-    def _commit_to_solr(self):
-        conn = self.solr_connection_manager.connection
-        conn.commit(after_commit=False)
-        print('Intermediate commit to solr (%d items '
-              'processed)' % self.processed)
+    def send_to_solr(self, success):
+        """After commit hook: send the updates of the committed objects to
+        Solr in batches and hard commit Solr once.
+        """
+        pending, self.solr_pending = self.solr_pending, []
+        if not pending:
+            return
+        if not success:
+            print 'Transaction failed, not updating %d objects in ' \
+                'solr' % len(pending)
+            return
+
+        portal = api.portal.get()
+        for path, idxs in pending:
+            obj = portal.unrestrictedTraverse(path, None)
+            if obj is None:
+                continue
+            handler = getMultiAdapter(
+                (obj, self.solr_buffer.manager), ISolrIndexHandler)
+            handler.add(idxs)
+            self.solr_buffer.added()
+        self.solr_buffer.finish()
+
+    def finish(self):
+        """Process the remaining queue. Solr is updated when the transaction
+        gets committed.
+        """
+        self.process_queue()
 
     def get_metadata_indexers(self, obj):
         """Get a mapping of (metadata_name => indexer) of the indexers for
@@ -993,12 +1170,29 @@ class Reindexer(object):
                 metadata_indexers[name] = indexer
         return metadata_indexers
 
-    def get_idxs_needing_reindex(self, obj, fixed_fields, brain):
+    def get_unsafe_indexers(self, obj):
+        """Get a list of (metadata_name, callable name, callable module) of
+        the indexers for metadata columns that aren't declared as safe.
+
+        Indexers are looked up by the interfaces the object provides, so the
+        result is memoized per set of provided interfaces.
+        """
+        key = providedBy(obj)
+        if key not in self.unsafe_indexers:
+            indexers = self.get_metadata_indexers(obj)
+            self.unsafe_indexers[key] = sorted(
+                (name, indexer.callable.__name__, indexer.callable.__module__)
+                for name, indexer in indexers.items()
+                if name not in SAFE_INDEXERS and
+                name not in DEPENDENT_INDEXERS)
+        return self.unsafe_indexers[key]
+
+    def get_idxs_needing_reindex(self, obj, fixed_fields, brain, plan):
         """Determine which indexes need reindexing, based on the list of
 
         fields that got fixed (persisted).
         """
-        if self.no_dynamic_defaults_fixed(fixed_fields):
+        if self.no_dynamic_defaults_fixed(fixed_fields, plan):
             values_changed = [f.value_changed for f in fixed_fields]
             if not any(values_changed):
                 return []
@@ -1012,7 +1206,7 @@ class Reindexer(object):
             wrapper = obj
 
         for f in fixed_fields:
-            if f.field_name in self.index_names:
+            if plan.get(f).indexed:
                 index = self.catalog._catalog.getIndex(f.field_name)
                 index_value = index.getEntryForObject(rid)
                 new_index_value = getattr(obj, f.field_name)
@@ -1024,7 +1218,7 @@ class Reindexer(object):
 
         return idxs_needing_reindex
 
-    def no_dynamic_defaults_fixed(self, fixed_fields):
+    def no_dynamic_defaults_fixed(self, fixed_fields, plan):
         """Return True if the only values that got persisted are either
         static defaults (as opposed to defaultFactories) or fields that didn't
         have default, and therefore got their missing value persisted (which
@@ -1035,14 +1229,9 @@ class Reindexer(object):
         they had the same value back when the object was indexed, and
         therefore reindexing the object can be skipped.
         """
-        static = (OPTIONAL_WITHOUT_DEFAULT, OPTIONAL_WITH_STATIC_DEFAULT)
-        for f in fixed_fields:
-            if not any([f.field_name in mapping.get(f.schema_name, [])
-                       for mapping in static]):
-                return False
-        return True
+        return all(plan.get(f).static for f in fixed_fields)
 
-    def needs_metadata_update(self, obj, fixed_fields, brain):
+    def needs_metadata_update(self, obj, fixed_fields, brain, plan):
         """Check whether an object needs to have its metadata reindexed
 
         based on what fields got fixed (persisted).
@@ -1053,21 +1242,22 @@ class Reindexer(object):
         # are the values that always got returned by the fallbacks, already
         # were present at object indexing time, and therefore are correctly
         # indexed.
-        if self.no_dynamic_defaults_fixed(fixed_fields):
+        if self.no_dynamic_defaults_fixed(fixed_fields, plan):
             values_changed = [f.value_changed for f in fixed_fields]
             if not any(values_changed):
                 return False
 
         fixed_fieldnames = [f.field_name for f in fixed_fields]
+        field_plans = [plan.get(f) for f in fixed_fields]
 
         # If for any of the fixed fields a metadata column exists with
         # exactly that name, metadata needs to be rebuilt
-        if any([fn in self.metadata_names for fn in fixed_fieldnames]):
+        if any([f.in_metadata for f in field_plans]):
             return True
 
         # If any of the fixed fields have an indexer that is dependent on them
         # in an indirect way, metadata needs to be rebuilt
-        if any([fn in DEPENDENT_INDEXERS for fn in fixed_fieldnames]):
+        if any([f.dependent for f in field_plans]):
             return True
 
         # All remaining indexers that exist with a name that is present in
@@ -1076,16 +1266,12 @@ class Reindexer(object):
         # (Safe means the indexer doesn't take into account any other field
         # data other than from the exact field that corresponds to the name
         # of the metadata column).
-        indexers = self.get_metadata_indexers(obj)
-        unsafe_indexers = {name: indexer for name, indexer in indexers.items()
-                           if name not in SAFE_INDEXERS and
-                           name not in DEPENDENT_INDEXERS}
+        unsafe_indexers = self.get_unsafe_indexers(obj)
         if unsafe_indexers:
             self.fixer.log("Obj has indexers not explicitly declared as safe:")
-            for name, indexer in unsafe_indexers.items():
+            for name, callable_name, callable_module in unsafe_indexers:
                 self.fixer.log("%s (%r, %r)" % (
-                    name, indexer.callable.__name__,
-                    indexer.callable.__module__))
+                    name, callable_name, callable_module))
 
             # Fall back to doing a full metadata diff
             self.fixer.log("Falling back to full metadata diff for %r "
@@ -1151,6 +1337,11 @@ if __name__ == '__main__':
                       dest="no_reindex", default=False)
     parser.add_option("-n", "--dry-run", action="store_true",
                       dest="dryrun", default=False)
+    parser.add_option("--solr-batch-size", dest="solr_batch_size",
+                      type="int", default=SOLR_BATCH_SIZE)
+    parser.add_option("--solr-soft-commit-interval",
+                      dest="solr_soft_commit_interval", type="int",
+                      default=0)
     (options, args) = parser.parse_args()
 
     plone = setup_plone(app, options)
@@ -17,6 +17,11 @@ optional arguments:
   -t : Will check and update tasks only. Used to update remote tasks on other
        deployments than the one where the groups were modified. We can therefore
        assume that the groups are only used for permissions on tasks (remote tasks).
+  --solr-batch-size : Number of documents per Solr update request.
+  --index-candidates : Only check the local roles of the objects found for
+       the old groups in the allowedRolesAndUsers index, instead of all objects
+       of the affected types. Faster, but misses local roles that don't grant
+       the View permission.
 """
 import argparse
 import gc
@@ -24,10 +29,14 @@ import json
 import logging
 import os
 import sys
+import time
 from collections import Counter
 
 import transaction
 from Acquisition import aq_base
+from BTrees.IIBTree import IISet
+from BTrees.IIBTree import intersection
+from BTrees.IIBTree import multiunion
 from ftw.solr.converters import CONVERTERS
 from ftw.solr.interfaces import ISolrConnectionManager
 from ftw.upgrade.progresslogger import ProgressLogger
@@ -54,12 +63,15 @@ from opengever.tasktemplates.content.templatefoldersschema import \
 from opengever.workspace.interfaces import IWorkspace
 from opengever.workspace.interfaces import IWorkspaceFolder
 from plone import api
+from zope.component import getUtility
 from zope.component import queryUtility
 from zope.component.hooks import getSite
 from zope.component.hooks import setSite
+from zope.intid.interfaces import IIntIds
 
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.solr_batch import SolrUpdateBuffer
 from opengever.maintenance.utils import LogFilePathFinder
 from opengever.maintenance.utils import TextTable
 
@@ -86,6 +98,19 @@ class LocalRolesUpdater(object):
         self.orgunits_with_modified_inbox_group = []
         self.catalog = api.portal.get_tool('portal_catalog')
         self.sm = queryUtility(ISolrConnectionManager)
+        # (UID, allowedRolesAndUsers) of the Solr documents to update, they
+        # are only sent once the ZODB transaction has been committed.
+        self.solr_updates = []
+        self.intids = getUtility(IIntIds)
+
+        # Only the intids of the objects to update are kept (the paths of
+        # objects without an intid), the objects are loaded again lazily
+        # when updating them.
+        self.intids_to_update = IISet()
+        self.paths_to_update = set()
+        self.obj_stats = Counter()
+        self.paths_table = TextTable()
+        self.paths_table.add_row(["portal_type", "path"])
 
     def check_preconditions(self):
         for org_unit in OrgUnit.query:
@@ -155,34 +180,31 @@ class LocalRolesUpdater(object):
                 '\n'.join(interfaces_to_update))
         )
 
-        brains = self.catalog.unrestrictedSearchResults(
-            object_provides=interfaces_to_update,
-            sort_on="path",
-            sort_order="descending",
-        )
+        if self.options.index_candidates:
+            candidates = self.get_candidate_objects(interfaces_to_update)
+        else:
+            candidates = self.get_all_objects(interfaces_to_update)
 
-        self.objs_to_update = []
-        for i, brain in enumerate(ProgressLogger(
-                'Analysing objects...', brains, logger=logger)):
-            obj = brain.getObject()
+        for i, obj in enumerate(ProgressLogger(
+                'Analysing objects...', candidates, logger=logger)):
             if self.needs_update(obj):
-                self.objs_to_update.append(obj)
+                self.mark_for_update(obj)
 
                 if ITask.providedBy(obj):
                     for item in getattr(aq_base(obj), 'relatedItems', []):
                         doc = item.to_object
                         if self.needs_update(doc):
-                            self.objs_to_update.append(doc)
+                            self.mark_for_update(doc)
 
                         if self._is_inside_a_proposal(doc):
                             proposal = doc.get_proposal()
                             if self.needs_update(proposal):
-                                self.objs_to_update.append(proposal)
+                                self.mark_for_update(proposal)
 
                     if self.options.tasks_only:
                         dossier = obj.get_containing_dossier()
-                        if dossier and self.needs_update(dossier) and dossier not in self.objs_to_update:
-                            self.objs_to_update.append(dossier)
+                        if dossier and self.needs_update(dossier):
+                            self.mark_for_update(dossier)
 
             # GC every 500 items proved a happy medium between memory
             # high watermark and slowdown in runtime
@@ -192,7 +214,7 @@ class LocalRolesUpdater(object):
 
         logger.info(
             '{} Plone objects have to be uptated'.format(
-                len(self.objs_to_update))
+                len(self.intids_to_update) + len(self.paths_to_update))
         )
 
         # Check for remote tasks that might need to be updated.
@@ -220,6 +242,76 @@ class LocalRolesUpdater(object):
         self.write_team_ids()
         self.print_analysis_stats()
 
+    def get_all_objects(self, interfaces):
+        brains = self.catalog.unrestrictedSearchResults(
+            object_provides=interfaces,
+            sort_on="path",
+            sort_order="descending",
+        )
+        return LazyObjects(brains, lambda brain: brain.getObject())
+
+    def get_candidate_objects(self, interfaces):
+        """Only objects whose allowedRolesAndUsers contain one of the old
+        groups can have a local role for it. Their RIDs are found by
+        intersecting the forward index entries of the old groups with the
+        object_provides entries of the interfaces, so only these candidates
+        need to be loaded.
+
+        allowedRolesAndUsers only contains principals having the View
+        permission, local roles not granting View are missed. That's why
+        this is only used with --index-candidates.
+        """
+        _catalog = self.catalog._catalog
+        provides_index = _catalog.indexes['object_provides']._index
+        principals_index = _catalog.indexes['allowedRolesAndUsers']._index
+
+        type_rids = multiunion(
+            [as_set(provides_index.get(name)) for name in interfaces])
+        group_rids = multiunion(
+            [as_set(principals_index.get('user:{}'.format(group_id)))
+             for group_id in self.old_group_ids])
+        rids = intersection(type_rids, group_rids)
+
+        logger.info(
+            '{} candidates (of {} objects of the checked types)'.format(
+                len(rids), len(type_rids)))
+
+        portal = api.portal.get()
+        paths = sorted((_catalog.paths[rid] for rid in rids), reverse=True)
+        return LazyObjects(paths, portal.unrestrictedTraverse)
+
+    def mark_for_update(self, obj):
+        path = '/'.join(obj.getPhysicalPath())
+        intid = self.intids.queryId(obj)
+        if intid is None:
+            if path in self.paths_to_update:
+                return
+            logger.warning('{} has no intid, keeping its path.'.format(path))
+            self.paths_to_update.add(path)
+        else:
+            if intid in self.intids_to_update:
+                return
+            self.intids_to_update.insert(intid)
+
+        self.obj_stats[obj.portal_type] += 1
+        self.paths_table.add_row([obj.portal_type, path])
+
+    def get_objs_to_update(self):
+        """The objects to update, loaded lazily in intid order, followed by
+        the objects without an intid. The order doesn't matter, local roles
+        are updated without reindexing and the indexes are updated in bulk
+        afterwards (see `update_indexes`).
+        """
+        portal = api.portal.get()
+
+        def get_object(item):
+            if isinstance(item, basestring):
+                return portal.unrestrictedTraverse(item)
+            return self.intids.getObject(item)
+
+        items = list(self.intids_to_update) + sorted(self.paths_to_update)
+        return LazyObjects(items, get_object)
+
     def _is_inside_a_proposal(self, maybe_document):
         if not IBaseDocument.providedBy(maybe_document):
             return False
@@ -241,7 +333,8 @@ class LocalRolesUpdater(object):
                 org_unit.inbox_group_id = self.group_mapping[org_unit.inbox_group_id]
 
         # Update objects
-        for i, obj in enumerate(ProgressLogger('Update role mappings', self.objs_to_update)):
+        objs_to_update = self.get_objs_to_update()
+        for i, obj in enumerate(ProgressLogger('Update role mappings', objs_to_update)):
             changes = []
             manager = RoleAssignmentManager(obj)
 
@@ -268,6 +361,10 @@ class LocalRolesUpdater(object):
                     logger.info('Committing after {} items...'.format(i))
                     transaction.commit()
 
+            if i % 500 == 0:
+                # Trigger GC to keep memory usage in check
+                self.collect_garbage(getSite())
+
         # Update teams
         for team in self.teams:
             logger.info("Updating team {!r}".format(team))
@@ -295,6 +392,11 @@ class LocalRolesUpdater(object):
 
         logger.info('Updating indexes...')
 
+        # RIDs of all objects with one of the old groups, taken from the
+        # forward index before it gets updated
+        docids = multiunion([as_set(index._index.get(old_group))
+                             for old_group in old_principal_ids])
+
         # Forward index is of the form _index[principal] = [docid1, docid2]
         for old_group, new_group in principal_mapping.items():
             if old_group in index._index:
@@ -303,24 +405,44 @@ class LocalRolesUpdater(object):
                 else:
                     index._index[new_group] = index._index.pop(old_group)
 
+        # The Solr updates are queued and only sent after the ZODB
+        # transaction has been committed (see `commit`), so Solr doesn't get
+        # ahead of the catalog if the commit fails. Nothing is sent on dry
+        # runs.
         # Backward index is of the form _unindex[docid] = [principal1, principal2]
         # Solr index contains the same data as this backward index
-        for docid, principals in index._unindex.items():
-            if any([old_group in principals for old_group in old_principal_ids]):
-                # Update the catalog index
-                index._unindex[docid] = [principal_mapping.get(principal, principal)
-                                         for principal in principals]
-                # Update the solr index
-                uid = uid_index.getEntryForObject(docid)
+        start = time.time()
+        for i, docid in enumerate(docids, 1):
+            principals = index._unindex.get(docid)
+            if principals is None:
+                continue
+
+            # Update the catalog index
+            index._unindex[docid] = [principal_mapping.get(principal, principal)
+                                     for principal in principals]
+
+            # Update the solr index
+            uid = uid_index._unindex.get(docid)
+            if not self.options.dryrun and uid is not None:
                 value = converter(index._unindex[docid], multivalued)
-                self.sm.connection.add({'allowedRolesAndUsers': {'set': value}, 'UID': uid})
+                self.solr_updates.append((uid, value))
 
+            if i % 10000 == 0:
+                self.log_index_throughput(i, len(docids), start)
+
+        self.log_index_throughput(len(docids), len(docids), start)
         logger.info('DONE Updating indexes.')
 
+    @staticmethod
+    def log_index_throughput(count, total, start):
+        elapsed = time.time() - start
+        logger.info('{}/{} index entries updated ({:.1f}/s)'.format(
+            count, total, count / max(elapsed, 0.001)))
+
     def sync_tasks(self):
         if self.options.tasks_only:
             # When only tasks are updated, we can simply sync the tasks.
-            for obj in ProgressLogger('Syncing tasks', self.objs_to_update):
+            for obj in ProgressLogger('Syncing tasks', self.get_objs_to_update()):
                 if ITask.providedBy(obj) and self._needs_syncing(obj):
                     obj.sync()
         else:
@@ -351,7 +473,7 @@ class LocalRolesUpdater(object):
         return False
 
     def print_analysis_stats(self):
-        obj_stats = Counter(obj.portal_type for obj in self.objs_to_update)
+        obj_stats = self.obj_stats
 
         self.stats_table = TextTable()
         self.stats_table.add_row(["portal_type", "number"])
@@ -369,15 +491,10 @@ class LocalRolesUpdater(object):
             self.stats_table.write_csv(logfile)
 
     def write_obj_paths(self):
-        paths_table = TextTable()
-        paths_table.add_row(["portal_type", "path"])
-        for obj in self.objs_to_update:
-            paths_table.add_row([obj.portal_type, '/'.join(obj.getPhysicalPath())])
-
         log_filename = LogFilePathFinder().get_logfile_path(
             'group_migration_paths', extension="csv")
         with open(log_filename, "w") as logfile:
-            paths_table.write_csv(logfile)
+            self.paths_table.write_csv(logfile)
 
     def write_remote_tasks_paths(self):
         paths_table = TextTable()
@@ -418,7 +535,19 @@ class LocalRolesUpdater(object):
 
     def commit(self):
         transaction.commit()
-        self.sm.connection.commit(soft_commit=False, after_commit=False)
+        self.send_solr_updates()
+
+    def send_solr_updates(self):
+        """Send the queued Solr updates in bulk requests and hard commit
+        Solr once.
+        """
+        solr_updates, self.solr_updates = self.solr_updates, []
+        solr_buffer = SolrUpdateBuffer(self.options.solr_batch_size)
+        for uid, value in solr_updates:
+            self.sm.connection.add(
+                {'allowedRolesAndUsers': {'set': value}, 'UID': uid})
+            solr_buffer.added()
+        solr_buffer.finish()
 
     def collect_garbage(self, site):
         # In order to get rid of leaking references, the Plone site needs to be
@@ -441,6 +570,32 @@ class LocalRolesUpdater(object):
         # to remove these without affecting the max memory consumed too much.)
 
 
+def as_set(value):
+    """Index entries are sets of RIDs, or a single RID (int).
+    """
+    if value is None:
+        return IISet()
+    if isinstance(value, int):
+        return IISet((value, ))
+    return value
+
+
+class LazyObjects(object):
+    """Sized iterable that loads the objects only when iterated over.
+    """
+
+    def __init__(self, items, get_object):
+        self.items = items
+        self.get_object = get_object
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for item in self.items:
+            yield self.get_object(item)
+
+
 def main():
     app = setup_app()
 
@@ -478,6 +633,20 @@ def main():
         help='Used to update remote tasks on other deployments',
     )
 
+    parser.add_argument(
+        '--solr-batch-size', dest='solr_batch_size',
+        type=int,
+        default=1000,
+        help='Number of documents per Solr update request',
+    )
+    parser.add_argument(
+        '--index-candidates', dest='index_candidates',
+        action='store_true',
+        default=False,
+        help='Only check the candidates from the allowedRolesAndUsers index '
+             '(misses local roles not granting View)',
+    )
+
     options = parser.parse_args(sys.argv[3:])
 
     plone = setup_plone(app, options)
@@ -0,0 +1,376 @@
+"""
+Shared single-pass engine for scripts that audit every cataloged object.
+
+Instead of every audit script walking the whole catalog and waking every
+object on its own, the `ObjectAuditEngine` walks the catalog once, loads each
+object once and hands it to all of its checkers. Checkers are plugins
+(subclasses of `AuditChecker`) that keep their own stats and write their own
+CSV reports / summaries.
+
+Checkers that only need catalog data (brains) can set `needs_object` to
+False. If none of the checkers of a run needs objects, objects aren't loaded
+at all.
+
+Objects are taken from a source. By default that's the catalog
+(`CatalogObjectSource`). The `StorageObjectSource` instead walks the records
+of the ZODB storage in OID order and only unpickles records of the requested
+classes. It avoids the catalog query and the traversal (and acquisition
+wrapping) through the containers for every object. Checkers that can deal
+with such unwrapped objects declare `supports_storage_source`. They get a
+`StorageRecord` in place of the brain, which only resolves the object's path
+(through the catalog's UID index) when it is actually needed, for example to
+write a report row.
+
+Scripts that can decide from an object's persisted state alone can skip
+loading objects altogether: `StorageObjectSource.iter_records` yields the
+raw records, and `load_state` unpickles a record's state without creating
+the object or loading anything it references.
+
+See `run_object_audit.py` for running several checkers in one pass.
+"""
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from plone.uuid.interfaces import IUUID
+from zope.dottedname.resolve import resolve
+from StringIO import StringIO
+from ZODB.utils import get_pickle_metadata
+import cPickle
+import sys
+
+
+class AuditChecker(object):
+    """Base class for checkers plugged into the `ObjectAuditEngine`.
+    """
+
+    # Name to select the checker in run_object_audit.py
+    name = None
+
+    # Whether `check` needs the object, or only the brain
+    needs_object = True
+
+    # Whether the checker can handle unwrapped objects from the storage
+    supports_storage_source = False
+
+    # Set by the engine once all objects have been checked
+    completed = False
+
+    def start(self):
+        """Called once before the first object is checked.
+        """
+
+    def check(self, obj, brain):
+        """Check a single object. `obj` is None if `needs_object` is False.
+        """
+        raise NotImplementedError
+
+    def object_missing(self, brain):
+        """Called for brains whose object can't be loaded.
+        """
+
+    def finish(self):
+        """Called once after the last object has been checked (also if the
+        run has been aborted by an exception, `completed` is False then).
+        """
+
+
+def get_wrapped(obj, brain):
+    """Return the acquisition wrapped object, which objects from the storage
+    source aren't. Only traverses to the object if it's not wrapped.
+    """
+    if aq_parent(aq_inner(obj)) is not None:
+        return obj
+
+    wrapped = brain.getObject()
+    if wrapped is None:
+        return obj
+    return wrapped
+
+
+class CatalogObjectSource(object):
+    """Yields all cataloged objects (and their brains).
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.brains = None
+
+    def __len__(self):
+        return len(self.get_brains())
+
+    def get_brains(self):
+        if self.brains is None:
+            self.brains = self.catalog.unrestrictedSearchResults()
+        return self.brains
+
+    def iter_items(self, load_objects):
+        for brain in self.get_brains():
+            obj = None
+            if load_objects:
+                try:
+                    obj = brain.getObject()
+                except KeyError:
+                    # Some deployments seem to have cataloged objects where
+                    # the real object doesn't exist (any more).
+                    obj = None
+            yield obj, brain
+
+    def progress(self, count):
+        return "%s of %s objects" % (count, len(self))
+
+
+class StorageObjectSource(object):
+    """Yields objects of the given classes by walking the storage records.
+
+    `classes` are dotted names of persistent classes, by default the content
+    classes of all dexterity FTIs. Objects that aren't cataloged (most
+    likely objects that were deleted, but not packed away yet) are skipped
+    unless `include_uncataloged` is set.
+    """
+
+    def __init__(self, context, catalog, classes=None,
+                 include_uncataloged=False, gc_interval=1000):
+        self.context = context
+        self.catalog = catalog
+        self.conn = context._p_jar
+        self.storage = self.conn.db().storage
+        self.include_uncataloged = include_uncataloged
+        self.gc_interval = gc_interval
+        self.scanned = 0
+
+        if not hasattr(self.storage, 'record_iternext'):
+            raise Exception(
+                "Storage %r doesn't support iterating over its records." %
+                self.storage)
+
+        if classes is None:
+            classes = self.get_content_classes()
+        self.classes = set(classes)
+
+        self.uid_index = catalog._catalog.getIndex('UID')._index
+        self.paths = catalog._catalog.paths
+
+    def __len__(self):
+        # Number of records, not number of objects that will be yielded
+        return len(self.storage)
+
+    def get_content_classes(self):
+        """Dotted names of the content classes of all dexterity FTIs, the
+        way they appear in pickles (defining module, not an alias).
+        """
+        classes = set()
+        types_tool = self.context.portal_types
+        for fti in types_tool.objectValues():
+            klass = getattr(fti, 'klass', None)
+            if not klass:
+                continue
+            try:
+                cls = resolve(klass)
+            except ImportError:
+                continue
+            classes.add('%s.%s' % (cls.__module__, cls.__name__))
+        return classes
+
+    def iter_items(self, load_objects):
+        for oid, data in self.iter_records():
+            obj = self.conn.get(oid)
+            record = StorageRecord(self, obj)
+            if self.include_uncataloged or record.getRID() is not None:
+                yield obj, record
+
+    def iter_records(self):
+        """Yield (oid, data) of the raw records of the requested classes,
+        without loading any objects.
+        """
+        next_oid = None
+        while True:
+            oid, tid, data, next_oid = self.storage.record_iternext(next_oid)
+            self.scanned += 1
+
+            if '.'.join(get_pickle_metadata(data)) in self.classes:
+                yield oid, data
+
+            if self.scanned % self.gc_interval == 0:
+                self.conn.cacheGC()
+
+            if next_oid is None:
+                break
+
+    def is_cataloged(self, uid):
+        return uid is not None and self.uid_index.get(uid) is not None
+
+    def load_record(self, oid):
+        """Load the raw record of `oid` as seen by our connection.
+        """
+        data, serial = self.conn._storage.load(oid)
+        return data
+
+    def progress(self, count):
+        return "%s objects (%s of ~%s records scanned)" % (
+            count, self.scanned, len(self))
+
+
+class PersistentReference(object):
+    """Placeholder for references to other persistent objects in states
+    loaded by `load_state`.
+    """
+
+    def __init__(self, reference):
+        self.reference = reference
+
+    @property
+    def oid(self):
+        """OID of the referenced object, None for reference formats (weak
+        or cross-database references) we don't follow.
+        """
+        if isinstance(self.reference, str):
+            return self.reference
+        if isinstance(self.reference, tuple):
+            return self.reference[0]
+        return None
+
+
+def load_state(data):
+    """Unpickle the state of a raw record, without loading the objects it
+    references (they are replaced by `PersistentReference`s) and without
+    creating the object itself.
+    """
+    unpickler = cPickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = PersistentReference
+    unpickler.load()  # class metadata
+    return unpickler.load()
+
+
+def iter_btree_keys(source, reference):
+    """Yield the keys of the OOBTree (or OOBucket) referenced by
+    `reference` by reading the raw records of the tree and its buckets.
+
+    Raises ValueError for anything that isn't an OOBTree / OOBucket.
+    """
+    oid = reference.oid
+    if oid is None:
+        raise ValueError("Can't follow reference %r" % reference.reference)
+
+    data = source.load_record(oid)
+    module, classname = get_pickle_metadata(data)
+    if module != 'BTrees.OOBTree' or classname not in ('OOBTree', 'OOBucket'):
+        raise ValueError("Not an OOBTree: %s.%s" % (module, classname))
+
+    state = load_state(data)
+    if state is None:
+        # Empty tree
+        return
+
+    if classname == 'OOBucket':
+        # ((key, value, key, value, ...), [next bucket])
+        for key in state[0][::2]:
+            yield key
+
+    elif len(state) == 1:
+        # A tree with a single bucket embeds the bucket's state:
+        # (((key, value, ...),),)
+        for key in state[0][0][0][::2]:
+            yield key
+
+    else:
+        # ((child, key, child, key, ..., child), first bucket)
+        for child in state[0][::2]:
+            for key in iter_btree_keys(source, child):
+                yield key
+
+
+class StorageRecord(object):
+    """Stands in for the catalog brain of an object from the storage source.
+
+    Path and RID are looked up in the catalog (by UID) only when asked for.
+    """
+
+    def __init__(self, source, obj):
+        self.source = source
+        self.obj = obj
+        self._rid = None
+        self._rid_looked_up = False
+
+    @property
+    def portal_type(self):
+        return self.obj.portal_type
+
+    @property
+    def UID(self):
+        return IUUID(self.obj, None)
+
+    def getRID(self):
+        if not self._rid_looked_up:
+            uid = self.UID
+            if uid is not None:
+                self._rid = self.source.uid_index.get(uid)
+            self._rid_looked_up = True
+        return self._rid
+
+    def getPath(self):
+        rid = self.getRID()
+        if rid is None:
+            return None
+        return self.source.paths.get(rid)
+
+    def getObject(self):
+        path = self.getPath()
+        if path is None:
+            return None
+        return self.source.context.unrestrictedTraverse(path)
+
+
+class ObjectAuditEngine(object):
+    """Walks the objects of a source once and dispatches every object to all
+    checkers, in the order the checkers are given.
+    """
+
+    def __init__(self, checkers, catalog=None, progress_interval=100,
+                 source=None):
+        if catalog is None:
+            from plone import api
+            catalog = api.portal.get_tool('portal_catalog')
+
+        if source is None:
+            source = CatalogObjectSource(catalog)
+
+        if isinstance(source, StorageObjectSource):
+            unsupported = [checker.name for checker in checkers
+                           if not checker.supports_storage_source]
+            if unsupported:
+                raise ValueError(
+                    "Checks %r don't support the storage source." % unsupported)
+
+        self.checkers = checkers
+        self.catalog = catalog
+        self.source = source
+        self.progress_interval = progress_interval
+        self.needs_object = any(checker.needs_object for checker in checkers)
+
+    def run(self):
+        started = []
+        try:
+            for checker in self.checkers:
+                checker.start()
+                started.append(checker)
+
+            items = self.source.iter_items(self.needs_object)
+            for i, (obj, brain) in enumerate(items):
+                self.dispatch(obj, brain)
+
+                if i % self.progress_interval == 0:
+                    sys.stderr.write("Progress: %s\n" % self.source.progress(i))
+
+            for checker in self.checkers:
+                checker.completed = True
+        finally:
+            for checker in started:
+                checker.finish()
+
+    def dispatch(self, obj, brain):
+        for checker in self.checkers:
+            if not checker.needs_object:
+                checker.check(None, brain)
+            elif obj is None:
+                checker.object_missing(brain)
+            else:
+                checker.check(obj, brain)
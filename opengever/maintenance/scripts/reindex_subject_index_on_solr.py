@@ -1,11 +1,19 @@
+"""
+Reindexes 'Subject' in Solr for all objects.
+
+    bin/instance run reindex_subject_index_on_solr.py [-n] [--batch-size <n>]
+        [--soft-commit-interval <n>]
+
+See solr_backfill.py.
+"""
 from opengever.base.interfaces import ISearchSettings
 from opengever.maintenance.debughelpers import setup_app
+from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.solr_backfill import add_backfill_options
+from opengever.maintenance.scripts.solr_backfill import run_backfill
 from plone import api
-from zope.component import queryMultiAdapter
-import argparse
 import logging
-import sys
 
 
 logger = logging.getLogger('reindex_subject_index')
@@ -14,27 +22,29 @@ for handler in logging.getLogger().handlers:
     handler.setLevel(logging.INFO)
 
 
-def reindex_subject_index():
+FIELDS = ['Subject']
+QUERY = u'*:*'
+
+
+def reindex_subject_index(options):
     solr_enabled = api.portal.get_registry_record(
         name='use_solr', interface=ISearchSettings)
     if not solr_enabled:
         raise Exception('Solr is not enabled.')
 
-    portal = api.portal.get()
-    solr_maintenance = queryMultiAdapter(
-        (portal, portal.REQUEST), name=u'solr-maintenance')
-    solr_maintenance.reindex(idxs=['Subject'])
+    run_backfill(FIELDS, QUERY, options)
 
 
 def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-s', dest='site_root', default=None,
-                        help='Absolute path to the Plone site')
-    options = parser.parse_args(sys.argv[3:])
     app = setup_app()
+
+    parser = setup_option_parser()
+    add_backfill_options(parser)
+    (options, args) = parser.parse_args()
+
     setup_plone(app, options)
 
-    reindex_subject_index()
+    reindex_subject_index(options)
 
 
 if __name__ == '__main__':
@@ -11,6 +11,12 @@ optional arguments:
        syncing are stored and dumped in a json file that can then be used
        to sync the tasks.
   -n : dry-run.
+  --reindex-batch-size : number of objects reindexed per commit (default 500).
+  -p : number of worker processes (default 1, requires RelStorage). The
+       operations are grouped into independent branches of the repository,
+       which are then migrated concurrently (phase by phase, except for the
+       creation of new positions). Also used for the validation. Dry runs
+       log the execution plan with its critical path and estimated runtime.
 
 If task syncing was skipped, it can be later performed in debug mode:
 
@@ -23,6 +29,15 @@ with open(path/to/tasks_to_sync.json, "r") as infile:
 TaskSyncer(tasks_to_sync)()
 transaction.commit()
 
+The objects touched by the migration are reindexed in batches, grouped by
+the indexes they need, with a commit after every batch. The progress is
+written to reindex_progress.json in the output directory. If the reindexing
+gets interrupted, it can be resumed in debug mode:
+
+from opengever.maintenance import dm; dm()
+from opengever.maintenance.scripts.repository_migration import BulkReindexer
+BulkReindexer.load(path/to/reindex_progress.json).run()
+
 Notes:
 - permissions for positions that get merged are disregarded
 - Setting new permissions will replace the existing sharing permissions.
@@ -61,6 +76,8 @@ from opengever.globalindex.handlers.task import TaskSqlSyncer
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.parallel import chunked
+from opengever.maintenance.parallel import WorkerPool
 from opengever.maintenance.scripts.update_object_ids import ObjectIDUpdater
 from opengever.repository.behaviors import referenceprefix
 from opengever.repository.deleter import RepositoryDeleter
@@ -75,11 +92,13 @@ from plone.app.uuid.utils import uuidToCatalogBrain
 from plone.uuid.interfaces import IUUID
 from Products.CMFPlone.utils import safe_unicode
 from uuid import uuid4
+from ZODB.POSException import ConflictError
 from zope.annotation import IAnnotations
 from zope.component import queryAdapter
 import json
 import logging
 import os
+import random
 import shutil
 import sys
 import tempfile
@@ -512,9 +531,20 @@ class PositionsMapping(object):
         self.old_pos_guid = {}
         self.new_pos_guid = {}
         self.old_pos_new_guid = {}
+        # Sets of the values of old_pos_guid and new_pos_guid
+        self.old_guids = set()
+        self.new_guids = set()
         self.reference_repository_mapping = reference_repository_mapping
         self._create_mapping(operations)
 
+    def add_root(self, guid):
+        """Add the repository root, which has no position.
+        """
+        self.old_pos_guid[''] = guid
+        self.new_pos_guid[''] = guid
+        self.old_guids.add(guid)
+        self.new_guids.add(guid)
+
     def _add_creation(self, operation):
         new_refnum = operation['new_repo_pos'].position
         if new_refnum in self.new_pos_guid:
@@ -522,6 +552,7 @@ class PositionsMapping(object):
             # exists and does not change, this should not happen
             raise Exception("Useless creation operation for {}".format(new_refnum))
         self.new_pos_guid[new_refnum] = uuid4().hex[:8]
+        self.new_guids.add(self.new_pos_guid[new_refnum])
 
     def _add_move(self, operation):
         old_refnum = operation['old_repo_pos'].position
@@ -540,8 +571,10 @@ class PositionsMapping(object):
         guid = IAnnotations(obj)[BUNDLE_GUID_KEY]
 
         self.old_pos_guid[old_refnum] = guid
+        self.old_guids.add(guid)
         if new_refnum not in self.new_pos_guid:
             self.new_pos_guid[new_refnum] = guid
+            self.new_guids.add(guid)
         else:
             # Will get merged, let's remember into which guid
             self.old_pos_new_guid[old_refnum] = self.new_pos_guid[new_refnum]
@@ -608,6 +641,60 @@ class PositionsMapping(object):
         return complete
 
 
+class RepositoryIndex(object):
+    """In-memory index of the repository root and repository folders, built
+    from a single catalog scan, so that the analysis of the rows doesn't
+    need catalog queries or UID lookups.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.root = None
+        self.objects_by_uid = {}
+        self.uid_by_guid = {}
+        self.uid_by_position = {}
+        self.path_by_uid = {}
+        self._contains_dossiers = {}
+
+    def add(self, obj):
+        uid = IUUID(obj)
+        self.objects_by_uid[uid] = obj
+        self.path_by_uid[uid] = '/'.join(obj.getPhysicalPath())
+
+        guid = IAnnotations(obj).get(BUNDLE_GUID_KEY)
+        if guid:
+            self.uid_by_guid[guid] = uid
+
+        if IRepositoryFolder.providedBy(obj):
+            position = obj.get_repository_number().replace('.', '')
+            self.uid_by_position[position] = uid
+        else:
+            self.root = obj
+
+    def get_object(self, uid):
+        if not uid:
+            return None
+        return self.objects_by_uid.get(uid)
+
+    def get_object_for_guid(self, guid):
+        return self.get_object(self.uid_by_guid.get(guid))
+
+    def get_objects_by_position(self):
+        return {position: self.objects_by_uid[uid]
+                for position, uid in self.uid_by_position.items()}
+
+    def contains_dossiers(self, uid):
+        """Whether there are dossiers directly inside the position. Looked
+        up in the catalog (once per position), without loading objects.
+        """
+        if uid not in self._contains_dossiers:
+            brains = self.catalog.unrestrictedSearchResults(
+                path={'query': self.path_by_uid[uid], 'depth': 1},
+                object_provides=IDossierMarker.__identifier__)
+            self._contains_dossiers[uid] = len(brains) > 0
+        return self._contains_dossiers[uid]
+
+
 class MigratorBase(object):
 
     def guid_to_object(self, guid):
@@ -638,6 +725,8 @@ class RepositoryExcelAnalyser(MigratorBase):
         self.analysed_rows = []
         self._reference_repository_mapping = None
         self.catalog = api.portal.get_tool('portal_catalog')
+        self.repository_index = RepositoryIndex(self.catalog)
+        self._max_depth = None
         self.is_valid = True
 
         self.check_preconditions()
@@ -671,9 +760,13 @@ class RepositoryExcelAnalyser(MigratorBase):
         a new repository folder in the repository root.
         We also add a guid for all repository folders, as these allow to
         unequivocally identify a parent when creating a new repofolder.
+
+        This is the only scan over the repository folders, it also builds
+        the `repository_index` used for analysing the rows.
         """
         logger.info(u"\n\nPreparing GUIDs...\n")
         add_guid_index()
+        guid_index = self.catalog._catalog.getIndex('bundle_guid')
         brains = self.catalog.unrestrictedSearchResults(
             portal_type=['opengever.repository.repositoryroot',
                          'opengever.repository.repositoryfolder']
@@ -682,16 +775,24 @@ class RepositoryExcelAnalyser(MigratorBase):
             obj = brain.getObject()
             if not IAnnotations(obj).get(BUNDLE_GUID_KEY):
                 IAnnotations(obj)[BUNDLE_GUID_KEY] = uuid4().hex[:8]
-            # reindex, whether the guid was already here or not, to make sure
-            # it's also in the catalog
-            obj.reindexObject(idxs=['bundle_guid'])
+            # reindex if the guid isn't in the catalog yet, which also is the
+            # case for existing guids if the index was just added
+            guid = IAnnotations(obj)[BUNDLE_GUID_KEY]
+            if guid_index.getEntryForObject(brain.getRID()) != guid:
+                obj.reindexObject(idxs=['bundle_guid'])
+            self.repository_index.add(obj)
 
     def get_reporoot_and_guid(self):
-        brains = self.catalog.unrestrictedSearchResults(
-            portal_type='opengever.repository.repositoryroot')
-        reporoot = brains[0].getObject()
+        reporoot = self.repository_index.root
         return reporoot, IAnnotations(reporoot)[BUNDLE_GUID_KEY]
 
+    def guid_to_object(self, guid):
+        obj = self.repository_index.get_object_for_guid(guid)
+        if obj is None:
+            logger.warning(
+                u"Couldn't find object with GUID %s in repository" % guid)
+        return obj
+
     def extract_data(self):
         logger.info(u"\n\nExtracting data from Excel...\n")
         data_extractor = ExcelDataExtractor(self.diff_xlsx_path)
@@ -736,8 +837,7 @@ class RepositoryExcelAnalyser(MigratorBase):
 
         self.positions_mapping = PositionsMapping(data, self.get_repository_reference_mapping())
         # add the repository root to the mapping
-        self.positions_mapping.old_pos_guid[''] = self.reporoot_guid
-        self.positions_mapping.new_pos_guid[''] = self.reporoot_guid
+        self.positions_mapping.add_root(self.reporoot_guid)
         if not self.positions_mapping.is_complete(ignored=self.skipped):
             self.is_valid = False
 
@@ -802,7 +902,7 @@ class RepositoryExcelAnalyser(MigratorBase):
         # object's but only issue a warning if they don't.
         operation['metadata_mismatch'] = False
         if operation['uid']:
-            obj = unrestrictedUuidToObject(operation['uid'])
+            obj = self.repository_index.get_object(operation['uid'])
             if not obj:
                 logger.warning("\nInvalid operation: uid is not valid."
                                "or uid. {}\n".format(operation))
@@ -846,7 +946,7 @@ class RepositoryExcelAnalyser(MigratorBase):
 
         # Make sure that if a position is being created, its parent will be found
         if operation['need_creation']:
-            if not operation['new_parent_guid'] in self.positions_mapping.new_pos_guid.values():
+            if not operation['new_parent_guid'] in self.positions_mapping.new_guids:
                 logger.warning(
                     "\nInvalid operation: could not find new parent for create "
                     "operation. {}\n".format(operation))
@@ -888,7 +988,7 @@ class RepositoryExcelAnalyser(MigratorBase):
                     "\nInvalid operation: blocking inheritance without setting "
                     "local roles. {}\n".format(operation))
                 operation['is_valid'] = False
-            obj = unrestrictedUuidToObject(operation['uid'])
+            obj = self.repository_index.get_object(operation['uid'])
             if not obj:
                 # newly created positions will have the local_roles set
                 # in the pipeline
@@ -981,8 +1081,11 @@ class RepositoryExcelAnalyser(MigratorBase):
         return need_number_change, need_move, need_merge
 
     def check_repository_depth_violation(self, operation):
-        max_depth = api.portal.get_registry_record(
-            interface=IRepositoryFolderRecords, name='maximum_repository_depth')
+        if self._max_depth is None:
+            self._max_depth = api.portal.get_registry_record(
+                interface=IRepositoryFolderRecords,
+                name='maximum_repository_depth')
+        max_depth = self._max_depth
 
         new_repo_pos = operation['new_repo_pos']
         if new_repo_pos.position and len(new_repo_pos.position) > max_depth:
@@ -999,7 +1102,7 @@ class RepositoryExcelAnalyser(MigratorBase):
             # object is neither moved nor created, nothing to worry about
             return
 
-        if operation['new_parent_guid'] not in self.positions_mapping.old_pos_guid.values():
+        if operation['new_parent_guid'] not in self.positions_mapping.old_guids:
             # parent is being created, hard to check leaf node principle
             return
         parent_repo = self.guid_to_object(operation['new_parent_guid'])
@@ -1009,7 +1112,7 @@ class RepositoryExcelAnalyser(MigratorBase):
             operation['is_valid'] = False
             logger.warning("\nInvalid operation: parent not found. {}\n".format(operation))
             return
-        if any([IDossierMarker.providedBy(item) for item in parent_repo.objectValues()]):
+        if self.repository_index.contains_dossiers(IUUID(parent_repo)):
             operation['is_valid'] = False
             operation['leaf_node_violated'] = True
             logger.warning("\nInvalid operation: leaf node principle violated."
@@ -1017,18 +1120,14 @@ class RepositoryExcelAnalyser(MigratorBase):
 
     def get_repository_reference_mapping(self):
         if not self._reference_repository_mapping:
-            repos = [brain.getObject() for brain in
-                     self.catalog(object_provides=IRepositoryFolder.__identifier__)]
-            self._reference_repository_mapping = {
-                repo.get_repository_number().replace('.', ''): repo for repo in repos}
+            self._reference_repository_mapping = (
+                self.repository_index.get_objects_by_position())
 
         return self._reference_repository_mapping
 
     def get_uuid_for_position(self, position):
-        mapping = self.get_repository_reference_mapping()
-
-        if position and position in mapping:
-            return IUUID(mapping[position])
+        if position:
+            return self.repository_index.uid_by_position.get(position)
 
         return None
 
@@ -1164,14 +1263,358 @@ class RepositoryExcelAnalyser(MigratorBase):
                 cell.value = attr
 
 
+class ReindexQueue(object):
+    """Collects the objects to reindex and the indexes to update for them.
+
+    Objects queued `with_children` are only recorded as subtree roots, their
+    contents are looked up when the queue gets expanded (once per subtree,
+    nested subtrees are skipped).
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.uids = defaultdict(set)
+        self.subtrees = defaultdict(set)
+
+    def add(self, uid, idxs, with_children=False):
+        if with_children:
+            self.subtrees[uid].update(idxs)
+        else:
+            self.uids[uid].update(idxs)
+
+    def pop(self, uid):
+        self.uids.pop(uid, None)
+        self.subtrees.pop(uid, None)
+
+    def __contains__(self, uid):
+        return uid in self.uids or uid in self.subtrees
+
+    def keys(self):
+        return list(set(self.uids) | set(self.subtrees))
+
+    def get_path(self, uid):
+        brain = uuidToCatalogBrain(uid)
+        if brain is None:
+            logger.error("Could not find {} to reindex. Skipping".format(uid))
+            return None
+        return brain.getPath()
+
+    def expand(self):
+        """Return the paths to reindex grouped by their (sorted) tuple of
+        indexes, every group in path order.
+        """
+        idxs_by_path = defaultdict(set)
+        for uid, idxs in self.uids.items():
+            path = self.get_path(uid)
+            if path is not None:
+                idxs_by_path[path].update(idxs)
+
+        roots_by_idxs = defaultdict(list)
+        for uid, idxs in self.subtrees.items():
+            path = self.get_path(uid)
+            if path is not None:
+                roots_by_idxs[tuple(sorted(idxs))].append(path)
+
+        for idxs, roots in roots_by_idxs.items():
+            expanded = None
+            for root in sorted(roots):
+                if expanded and root.startswith(expanded + '/'):
+                    # Already contained in the subtree expanded before
+                    continue
+                expanded = root
+                for brain in self.catalog.unrestrictedSearchResults(path=root):
+                    idxs_by_path[brain.getPath()].update(idxs)
+
+        groups = defaultdict(list)
+        for path, idxs in idxs_by_path.items():
+            groups[tuple(sorted(idxs))].append(path)
+        for paths in groups.values():
+            paths.sort()
+        return dict(groups)
+
+
+class BulkReindexer(object):
+    """Reindexes groups of objects sharing the same indexes in batches.
+
+    The objects of a group are loaded in path order. The catalog and Solr
+    updates of a batch are processed together by the indexing queue when
+    the batch is committed. The progress file (JSON lines) starts with the
+    groups, followed by a line for every committed batch, so an interrupted
+    reindex can be resumed with `BulkReindexer.load`.
+    """
+
+    def __init__(self, groups, batch_size=500, progress_path=None,
+                 dry_run=False):
+        self.groups = sorted(groups.items())
+        self.batch_size = batch_size
+        self.progress_path = progress_path
+        self.dry_run = dry_run
+        self.done = set()
+
+    @classmethod
+    def load(cls, progress_path, dry_run=False):
+        with open(progress_path, "r") as infile:
+            data = json.loads(infile.readline())
+            done = [json.loads(line) for line in infile if line.strip()]
+
+        groups = dict((tuple(idxs), paths) for idxs, paths in data['groups'])
+        reindexer = cls(groups, data['batch_size'], progress_path, dry_run)
+        reindexer.done = set(tuple(batch) for batch in done)
+        return reindexer
+
+    def write_progress(self, batch=None):
+        """Write the groups (once, before the first batch) or append a
+        committed batch to the progress file.
+        """
+        if not self.progress_path:
+            return
+
+        if batch is None:
+            if os.path.isfile(self.progress_path):
+                # Resumed, the groups are already there
+                return
+            with open(self.progress_path, "w") as outfile:
+                json.dump({'batch_size': self.batch_size,
+                           'groups': self.groups}, outfile)
+                outfile.write('\n')
+        else:
+            with open(self.progress_path, "a") as outfile:
+                outfile.write(json.dumps(batch) + '\n')
+
+    def run(self):
+        portal = api.portal.get()
+        n_tot = sum(len(paths) for idxs, paths in self.groups)
+        n_done = 0
+        start = time.time()
+        self.write_progress()
+
+        for group_number, (idxs, paths) in enumerate(self.groups):
+            logger.info(u"Reindexing {} objects: {}".format(
+                len(paths), ', '.join(idxs)))
+
+            batches = chunked(paths, self.batch_size)
+            for batch_number, batch in enumerate(batches):
+                n_done += len(batch)
+                if (group_number, batch_number) in self.done:
+                    continue
+
+                for path in batch:
+                    obj = portal.unrestrictedTraverse(path, None)
+                    if obj is None:
+                        logger.error(
+                            "Could not find {} to reindex. Skipping".format(path))
+                        continue
+
+                    # WARNING! idxs needs to be a tuple, otherwise solr will always update all attributes
+                    # See: https://github.com/plone/collective.indexing/blob/2.0/src/collective/indexing/queue.py#L142
+                    obj.reindexObject(idxs=tuple(idxs))
+                    if obj.portal_type == 'opengever.task.task':
+                        # make sure that the model is up to date.
+                        TaskSqlSyncer(obj, None).sync()
+
+                if not self.dry_run:
+                    transaction.commit()
+                    self.done.add((group_number, batch_number))
+                    self.write_progress((group_number, batch_number))
+                portal._p_jar.cacheGC()
+
+                elapsed = time.time() - start
+                logger.info(u'{}: Reindexed {} / {} ({:.1f}/s)'.format(
+                    time.strftime('%d.%m.%Y %H:%M:%S'), n_done, n_tot,
+                    n_done / max(elapsed, 0.001)))
+
+
+# Phases that can be executed concurrently for independent branches:
+# phase -> (selection of the operations, method executing one operation)
+PARALLEL_PHASES = {
+    'set_permissions': ('items_to_set_permissions', 'set_item_permissions'),
+    'move_branches': ('items_to_move', 'move_branch'),
+    'merge_branches': ('items_to_merge', 'merge_branch'),
+    'adjust_reference_number_prefix': (
+        'items_to_adjust_number', 'adjust_item_reference_number_prefix'),
+    'rename': ('items_to_rename', 'rename_item'),
+}
+
+PHASE_ORDER = ['set_permissions', 'move_branches', 'merge_branches',
+               'adjust_reference_number_prefix', 'rename']
+
+# Rough assumption used for the runtime estimate of the execution plan
+ESTIMATED_SECONDS_PER_OBJECT = 0.02
+
+MAX_CONFLICT_RETRIES = 5
+
+
+class ExecutionPlan(object):
+    """Groups the operations into independent branches, so that the phases
+    in PARALLEL_PHASES can be executed for several groups concurrently.
+
+    Operations depend on each other if they touch the same top level branch
+    of the repository, by their old or their new position. Creating, moving,
+    merging or renumbering a top level position also touches the repository
+    root. Dependent operations end up in the same group and are executed in
+    order, with a commit after every operation. Groups are executed
+    concurrently by worker processes, phase after phase. Operations failing
+    with a ConflictError are retried.
+
+    The costs (for the estimate and the critical path) are the number of
+    objects in the subtree of an operation, since these get reindexed.
+    """
+
+    def __init__(self, migrator, processes):
+        self.migrator = migrator
+        self.processes = processes
+        self.groups = self.get_groups(migrator.operations_list)
+        self._subtree_sizes = {}
+
+    @staticmethod
+    def get_branches(operation):
+        branches = set()
+        top_level = False
+        for repo_pos in (operation['old_repo_pos'], operation['new_repo_pos']):
+            position = repo_pos.position
+            if not position:
+                continue
+            branches.add(position[0])
+            top_level = top_level or len(position) == 1
+
+        # Every existing position has a row, so only operations changing the
+        # contents or the mappings of the repository root depend on it.
+        changes_root = (operation['need_creation'] or operation['need_move']
+                        or operation['need_merge'] or operation['new_number'])
+        if top_level and changes_root:
+            branches.add('')
+        return branches
+
+    def get_groups(self, operations):
+        """Return lists of operation indexes, connected by shared branches.
+        """
+        parents = {}
+
+        def find(branch):
+            while parents.setdefault(branch, branch) != branch:
+                branch = parents[branch]
+            return branch
+
+        for operation in operations:
+            roots = [find(branch) for branch in self.get_branches(operation)]
+            for root in roots[1:]:
+                parents[root] = roots[0]
+
+        groups = defaultdict(list)
+        for i, operation in enumerate(operations):
+            branches = self.get_branches(operation)
+            if branches:
+                groups[find(min(branches))].append(i)
+        return [indexes for key, indexes in sorted(groups.items())]
+
+    def get_phase_groups(self, phase):
+        """Return the operation indexes of every group having operations in
+        that phase.
+        """
+        selection, method = PARALLEL_PHASES[phase]
+        operations = self.migrator.operations_list
+        selected = set(id(item) for item in getattr(self.migrator, selection)())
+
+        phase_groups = []
+        for group in self.groups:
+            indexes = [i for i in group if id(operations[i]) in selected]
+            if indexes:
+                phase_groups.append(indexes)
+        return phase_groups
+
+    def get_cost(self, index):
+        uid = self.migrator.operations_list[index]['uid']
+        if not uid:
+            return 1
+        if uid not in self._subtree_sizes:
+            brain = uuidToCatalogBrain(uid)
+            size = 1
+            if brain is not None:
+                size = len(self.migrator.catalog.unrestrictedSearchResults(
+                    path=brain.getPath()))
+            self._subtree_sizes[uid] = size
+        return self._subtree_sizes[uid]
+
+    def log_plan(self):
+        logger.info(u"\n\nExecution plan: {} independent groups, {} "
+                    u"processes\n".format(len(self.groups), self.processes))
+
+        critical_path = []
+        sequential_cost = 0
+        parallel_cost = 0
+        for phase in PHASE_ORDER:
+            costs = [(sum(self.get_cost(i) for i in indexes), indexes)
+                     for indexes in self.get_phase_groups(phase)]
+            if not costs:
+                continue
+
+            total = sum(cost for cost, indexes in costs)
+            slowest, indexes = max(costs)
+            sequential_cost += total
+            parallel_cost += max(slowest, total / float(self.processes))
+            critical_path.append((phase, slowest, indexes))
+
+            logger.info(u"{}: {} operations in {} groups, {} objects".format(
+                phase, sum(len(indexes) for cost, indexes in costs),
+                len(costs), total))
+
+        logger.info(u"\nCritical path:")
+        for phase, cost, indexes in critical_path:
+            positions = [self.migrator.operations_list[i]['new_repo_pos'].position
+                         for i in indexes]
+            logger.info(u"{}: {} objects, positions {}".format(
+                phase, cost, ', '.join(positions)))
+
+        logger.info(u"\nEstimated runtime: {:.0f}s (sequential: {:.0f}s)\n".format(
+            parallel_cost * ESTIMATED_SECONDS_PER_OBJECT,
+            sequential_cost * ESTIMATED_SECONDS_PER_OBJECT))
+
+    def execute(self, phase):
+        logger.info(u"\n\nExecuting {} in parallel...\n".format(phase))
+
+        # The forked workers must not inherit uncommitted changes (e.g. the
+        # GUIDs set up by prepare_guids), and they only see committed state.
+        transaction.commit()
+
+        shards = [(phase, indexes) for indexes in self.get_phase_groups(phase)]
+        pool = WorkerPool(api.portal.get(), self.processes,
+                          self.migrator.setup_execution_worker,
+                          _execute_operations, writable=True)
+
+        parents = set()
+        for result in pool.imap(shards):
+            for uid, idxs in result['uids'].items():
+                self.migrator.to_reindex.add(uid, idxs)
+            for uid, idxs in result['subtrees'].items():
+                self.migrator.to_reindex.add(uid, idxs, with_children=True)
+            for uid in result['deleted']:
+                self.migrator.to_reindex.pop(uid)
+            tasks_to_sync.update(result['tasks_to_sync'])
+            parents.update(result['parents'])
+
+        # Start a new transaction to see the changes of the workers
+        transaction.abort()
+
+        if parents:
+            self.migrator.regenerate_reference_number_mapping(
+                [unrestrictedUuidToObject(uid) for uid in parents])
+            transaction.commit()
+
+
 class RepositoryMigrator(MigratorBase):
 
-    def __init__(self, operations_list, dry_run=False):
+    def __init__(self, operations_list, dry_run=False,
+                 reindex_batch_size=500, reindex_progress_path=None,
+                 validation_processes=1, execution_processes=1):
         self.operations_list = operations_list
         self.dry_run = dry_run
+        self.validation_processes = validation_processes
+        self.execution_processes = execution_processes
+        self.reindex_batch_size = reindex_batch_size
+        self.reindex_progress_path = reindex_progress_path
         self._reference_repository_mapping = None
-        self.to_reindex = defaultdict(set)
         self.catalog = api.portal.get_tool('portal_catalog')
+        self.to_reindex = ReindexQueue(self.catalog)
         self.check_preconditions()
 
     def check_preconditions(self):
@@ -1179,17 +1622,71 @@ class RepositoryMigrator(MigratorBase):
             raise MigrationPreconditionsError("Some operations are invalid.")
 
     def run(self):
-        self.set_permissions(self.items_to_set_permissions())
+        plan = ExecutionPlan(self, self.execution_processes)
+        if self.dry_run or self.execution_processes > 1:
+            plan.log_plan()
+        if self.dry_run or self.execution_processes <= 1:
+            # Workers wouldn't see the uncommitted changes of a dry run
+            plan = None
+
+        self.run_phase(plan, 'set_permissions')
         self.create_repository_folders(self.items_to_create())
-        self.move_branches(self.items_to_move())
-        self.merge_branches(self.items_to_merge())
-        self.adjust_reference_number_prefix(self.items_to_adjust_number())
+        self.run_phase(plan, 'move_branches')
+        self.run_phase(plan, 'merge_branches')
+        self.run_phase(plan, 'adjust_reference_number_prefix')
         self.regenerate_reference_number_mapping(self.objects_to_fix_refnum_mapping())
-        self.rename(self.items_to_rename())
+        self.run_phase(plan, 'rename')
         self.update_description(self.operations_list)
         self.reindex()
         self.validate()
 
+    def run_phase(self, plan, phase):
+        if plan is None:
+            selection, method = PARALLEL_PHASES[phase]
+            getattr(self, phase)(getattr(self, selection)())
+        else:
+            plan.execute(phase)
+
+    def setup_execution_worker(self, site):
+        return RepositoryMigrator(self.operations_list)
+
+    def execute_operations(self, phase, indexes):
+        """Execute the operations of a phase in order, committing after every
+        operation and retrying operations failing with a ConflictError.
+        Returns what needs to be merged into the main process' state.
+        """
+        selection, method = PARALLEL_PHASES[phase]
+        self.to_reindex = ReindexQueue(self.catalog)
+        known_tasks = set(tasks_to_sync)
+        parents = set()
+        deleted = []
+
+        for i in indexes:
+            item = self.operations_list[i]
+            for attempt in range(1, MAX_CONFLICT_RETRIES + 1):
+                try:
+                    result = getattr(self, method)(item)
+                    transaction.commit()
+                    break
+                except ConflictError:
+                    transaction.abort()
+                    if attempt == MAX_CONFLICT_RETRIES:
+                        raise
+                    logger.info(u"Conflict for {}, retrying ({})".format(
+                        item['uid'], attempt))
+                    time.sleep(random.uniform(0, attempt))
+
+            if phase == 'adjust_reference_number_prefix':
+                parents.add(IUUID(result))
+            if phase == 'merge_branches':
+                deleted.append(item['uid'])
+
+        return {'uids': dict(self.to_reindex.uids),
+                'subtrees': dict(self.to_reindex.subtrees),
+                'deleted': deleted,
+                'parents': list(parents),
+                'tasks_to_sync': list(set(tasks_to_sync) - known_tasks)}
+
     def objects_to_fix_refnum_mapping(self):
         """Items that get created over the bundle import will get the
         default value as the reference number prefix is their number is already
@@ -1236,15 +1733,7 @@ class RepositoryMigrator(MigratorBase):
         return [item for item in self.operations_list if item['set_permissions']]
 
     def add_to_reindexing_queue(self, uid, idxs, with_children=False):
-        self.to_reindex[uid].update(idxs)
-        obj = unrestrictedUuidToObject(uid)
-        if not with_children:
-            return
-
-        contained_brains = self.catalog.unrestrictedSearchResults(
-            path=obj.absolute_url_path())
-        for brain in contained_brains:
-            self.to_reindex[brain.UID].update(idxs)
+        self.to_reindex.add(uid, idxs, with_children=with_children)
 
     def create_repository_folders(self, items):
         """Add repository folders - by using the ogg.bundle import. """
@@ -1289,58 +1778,70 @@ class RepositoryMigrator(MigratorBase):
         n_tot = len(items)
         for i, item in enumerate(items):
             log_progress(i, n_tot, 1)
-            parent = self.guid_to_object(item['new_parent_guid'])
-            repo = unrestrictedUuidToObject(item['uid'])
-            if not parent or not repo:
-                raise Exception('No parent or repo found for {}'.format(item))
-
-            api.content.move(source=repo, target=parent, safe_id=True)
+            self.move_branch(item)
             if not self.dry_run:
                 transaction.commit()
 
+    def move_branch(self, item):
+        parent = self.guid_to_object(item['new_parent_guid'])
+        repo = unrestrictedUuidToObject(item['uid'])
+        if not parent or not repo:
+            raise Exception('No parent or repo found for {}'.format(item))
+
+        api.content.move(source=repo, target=parent, safe_id=True)
+
     def merge_branches(self, items):
         logger.info("\n\nMerging...\n")
         n_tot = len(items)
         for i, item in enumerate(items):
             log_progress(i, n_tot, 1)
-            target = self.guid_to_object(item['new_parent_guid'])
-            repo = unrestrictedUuidToObject(item['uid'])
-            if not target or not repo:
-                raise Exception('No target or repo found for {}'.format(item))
-
-            for obj in repo.contentValues():
-                api.content.move(source=obj, target=target, safe_id=True)
-                self.add_to_reindexing_queue(
-                    obj.UID(), ('Title', 'sortable_title', 'reference', 'sortable_reference'),
-                    with_children=True)
-
-            deleter = RepositoryDeleter(repo)
-            if not deleter.is_delete_allowed():
-                raise Exception('Trying to delete not empty object {}'.format(item))
-            deleter.delete()
-
-            if item['uid'] in self.to_reindex:
-                self.to_reindex.pop(item['uid'])
+            self.merge_branch(item)
             if not self.dry_run:
                 transaction.commit()
 
+    def merge_branch(self, item):
+        target = self.guid_to_object(item['new_parent_guid'])
+        repo = unrestrictedUuidToObject(item['uid'])
+        if not target or not repo:
+            raise Exception('No target or repo found for {}'.format(item))
+
+        for obj in repo.contentValues():
+            api.content.move(source=obj, target=target, safe_id=True)
+            self.add_to_reindexing_queue(
+                obj.UID(), ('Title', 'sortable_title', 'reference', 'sortable_reference'),
+                with_children=True)
+
+        deleter = RepositoryDeleter(repo)
+        if not deleter.is_delete_allowed():
+            raise Exception('Trying to delete not empty object {}'.format(item))
+        deleter.delete()
+
+        if item['uid'] in self.to_reindex:
+            self.to_reindex.pop(item['uid'])
+
     def adjust_reference_number_prefix(self, items):
         logger.info("\n\nAdjusting reference number prefix...\n")
         parents = set()
         n_tot = len(items)
         for i, item in enumerate(items):
             log_progress(i, n_tot, 5)
-            repo = unrestrictedUuidToObject(item['uid'])
-            referenceprefix.IReferenceNumberPrefix(repo).reference_number_prefix = item['new_number']
-            parents.add(aq_parent(aq_inner(repo)))
-            self.add_to_reindexing_queue(
-                item['uid'], ('Title', 'sortable_title', 'reference', 'sortable_reference'),
-                with_children=True)
+            parents.add(self.adjust_item_reference_number_prefix(item))
         if not self.dry_run:
             transaction.commit()
 
         self.regenerate_reference_number_mapping(list(parents))
 
+    def adjust_item_reference_number_prefix(self, item):
+        """Set the new prefix, returns the parent whose reference number
+        mapping needs to be regenerated.
+        """
+        repo = unrestrictedUuidToObject(item['uid'])
+        referenceprefix.IReferenceNumberPrefix(repo).reference_number_prefix = item['new_number']
+        self.add_to_reindexing_queue(
+            item['uid'], ('Title', 'sortable_title', 'reference', 'sortable_reference'),
+            with_children=True)
+        return aq_parent(aq_inner(repo))
+
     def regenerate_reference_number_mapping(self, objs):
         logger.info("\n\nRegenerating number mappings...\n")
         for obj in objs:
@@ -1358,20 +1859,23 @@ class RepositoryMigrator(MigratorBase):
         n_tot = len(items)
         for i, item in enumerate(items):
             log_progress(i, n_tot, 1)
-            repo = unrestrictedUuidToObject(item['uid'])
+            self.rename_item(item)
+            if not self.dry_run:
+                transaction.commit()
 
-            # Rename
-            repo.title_de = item['new_title']
+    def rename_item(self, item):
+        repo = unrestrictedUuidToObject(item['uid'])
 
-            # Adjust id if necessary
-            ObjectIDUpdater(repo, FakeOptions()).maybe_update_id()
+        # Rename
+        repo.title_de = item['new_title']
 
-            # We do not need to reindex path as this seems to already happen
-            # recursively
-            self.add_to_reindexing_queue(
-                item['uid'], ('Title', 'title_de', 'title_fr', 'title_en', 'sortable_title'))
-            if not self.dry_run:
-                transaction.commit()
+        # Adjust id if necessary
+        ObjectIDUpdater(repo, FakeOptions()).maybe_update_id()
+
+        # We do not need to reindex path as this seems to already happen
+        # recursively
+        self.add_to_reindexing_queue(
+            item['uid'], ('Title', 'title_de', 'title_fr', 'title_en', 'sortable_title'))
 
     def update_description(self, items):
         logger.info("\n\nUpdating descriptions...\n")
@@ -1394,11 +1898,14 @@ class RepositoryMigrator(MigratorBase):
         n_tot = len(items)
         for i, item in enumerate(items):
             log_progress(i, n_tot, 5)
-            repo = unrestrictedUuidToObject(item['uid'])
-            self._set_permissions_on_object(repo, item['permissions'])
+            self.set_item_permissions(item)
             if not self.dry_run:
                 transaction.commit()
 
+    def set_item_permissions(self, item):
+        repo = unrestrictedUuidToObject(item['uid'])
+        self._set_permissions_on_object(repo, item['permissions'])
+
     def _set_permissions_on_object(self, obj, permissions):
         """ We set the local roles and block inheritance if needed.
         local_roles are only set if the inheritance is blocked.
@@ -1426,69 +1933,57 @@ class RepositoryMigrator(MigratorBase):
 
     def reindex(self):
         logger.info("\n\nReindexing...\n")
-        n_tot = len(self.to_reindex)
-        for i, (uid, idxs) in enumerate(self.to_reindex.items()):
-            log_progress(i, n_tot)
-            obj = unrestrictedUuidToObject(uid)
-            if not obj:
-                logger.error("Could not find {} to reindex. Skipping".format(uid))
-                continue
-
-            # WARNING! idxs needs to be a tuple, otherwise solr will always update all attributes
-            # See: https://github.com/plone/collective.indexing/blob/2.0/src/collective/indexing/queue.py#L142
-            obj.reindexObject(idxs=tuple(idxs))
-            if obj.portal_type == 'opengever.task.task':
-                # make sure that the model is up to date.
-                TaskSqlSyncer(obj, None).sync()
+        BulkReindexer(
+            self.to_reindex.expand(),
+            batch_size=self.reindex_batch_size,
+            progress_path=self.reindex_progress_path,
+            dry_run=self.dry_run).run()
 
     def validate(self):
         """This steps make sure that the repository system has
-        been correctly migrated."""
+        been correctly migrated.
+
+        The operations are validated in parallel by `validation_processes`
+        worker processes. They all see the same committed state, so
+        everything is committed first. Dry runs are validated in the current
+        process, the workers wouldn't see the uncommitted changes. The
+        migration information is then stored on the validated objects in
+        the current process.
+        """
         logger.info("\n\nValidating...\n")
         self.validation_errors = defaultdict(list)
         self.validation_failed = False
 
-        n_tot = len(self.operations_list)
-        for i, operation in enumerate(self.operations_list):
-            log_progress(i, n_tot)
-            # Three possibilities here: position was created, deleted or modified
-            if operation['new_position_guid']:
-                # new position was created
-                obj = self.guid_to_object(operation['new_position_guid'])
-            elif operation['uid']:
-                obj = unrestrictedUuidToObject(operation['uid'])
-                if operation['need_merge']:
-                    # position was deleted
-                    if obj:
-                        logger.error(u"Positions wasn't deleted correctly {}.".format(operation['uid']))
-                        self.validation_failed = True
-                    continue
-            else:
-                logger.error(u"Invalid operation {}".format(operation))
-                self.validation_failed = True
-                continue
-
-            if not obj:
-                uid = operation['new_position_guid'] or operation['uid']
-                logger.error(u"Could not resolve object {}. Skipping validation.".format(uid))
-                self.validation_failed = True
-                continue
-
-            # Assert reference number, title and description on the object
-            uid = obj.UID()
-            new = operation['new_repo_pos']
-            self.assertEqual(uid, new.position, obj.get_repository_number().replace('.', ''), 'incorrect number')
-            self.assertEqual(uid, new.title, obj.title_de, 'incorrect title')
-            self.assertEqual(uid, new.description, obj.description, 'incorrect description')
+        portal = api.portal.get()
+        processes = self.validation_processes
+        at = None
+        if processes > 1 and self.dry_run:
+            logger.info("Dry run, validating in the current process.")
+            processes = 1
+        if processes > 1:
+            transaction.commit()
+            at = portal._p_jar.db().lastTransaction()
 
-            # Assert that data in the catalog is consistent with data on the object
-            self.checkObjectConsistency(obj)
+        pool = WorkerPool(portal, processes, self.setup_validation_worker,
+                          _validate_operations, at=at)
 
-            if operation['need_creation']:
-                # Check that metadata was set correctly
-                self.check_metadata(obj, operation)
+        validated = []
+        n_done = 0
+        n_tot = len(self.operations_list)
+        shards = chunked(range(n_tot), 20)
+        for result in pool.imap(shards):
+            for uid, errors in result['errors'].items():
+                self.validation_errors[uid].extend(errors)
+            if result['failed']:
+                self.validation_failed = True
+            validated.extend(result['validated'])
+            n_done += result['count']
+            log_progress(n_done, n_tot, 20)
 
+        for i, uid in validated:
             # Store some migration information on the object
+            operation = self.operations_list[i]
+            obj = unrestrictedUuidToObject(uid)
             IAnnotations(obj)[MIGRATION_KEY] = {
                 'old_position': operation['old_repo_pos'].position,
                 'new_position': operation['new_repo_pos'].position,
@@ -1506,6 +2001,71 @@ class RepositoryMigrator(MigratorBase):
         if self.validation_failed:
             raise MigrationValidationError("See log for details")
 
+    def setup_validation_worker(self, site):
+        return RepositoryMigrator(self.operations_list, dry_run=True)
+
+    def validate_operations(self, indexes):
+        """Validate the operations with the given indexes (read-only).
+        Returns the validation errors and the (index, uid) of the objects
+        that have been validated.
+        """
+        self.validation_errors = defaultdict(list)
+        self.validation_failed = False
+
+        validated = []
+        for i in indexes:
+            uid = self.validate_operation(self.operations_list[i])
+            if uid is not None:
+                validated.append((i, uid))
+
+        return {'count': len(indexes),
+                'errors': dict(self.validation_errors),
+                'failed': self.validation_failed,
+                'validated': validated}
+
+    def validate_operation(self, operation):
+        """Validate a single operation. Returns the UID of the validated
+        object, None if there is no object to validate.
+        """
+        # Three possibilities here: position was created, deleted or modified
+        if operation['new_position_guid']:
+            # new position was created
+            obj = self.guid_to_object(operation['new_position_guid'])
+        elif operation['uid']:
+            obj = unrestrictedUuidToObject(operation['uid'])
+            if operation['need_merge']:
+                # position was deleted
+                if obj:
+                    logger.error(u"Positions wasn't deleted correctly {}.".format(operation['uid']))
+                    self.validation_failed = True
+                return None
+        else:
+            logger.error(u"Invalid operation {}".format(operation))
+            self.validation_failed = True
+            return None
+
+        if not obj:
+            uid = operation['new_position_guid'] or operation['uid']
+            logger.error(u"Could not resolve object {}. Skipping validation.".format(uid))
+            self.validation_failed = True
+            return None
+
+        # Assert reference number, title and description on the object
+        uid = obj.UID()
+        new = operation['new_repo_pos']
+        self.assertEqual(uid, new.position, obj.get_repository_number().replace('.', ''), 'incorrect number')
+        self.assertEqual(uid, new.title, obj.title_de, 'incorrect title')
+        self.assertEqual(uid, new.description, obj.description, 'incorrect description')
+
+        # Assert that data in the catalog is consistent with data on the object
+        self.checkObjectConsistency(obj)
+
+        if operation['need_creation']:
+            # Check that metadata was set correctly
+            self.check_metadata(obj, operation)
+
+        return uid
+
     def check_metadata(self, obj, operation):
         err_msg = "metadata not set correctly"
         uid = obj.UID()
@@ -1570,6 +2130,15 @@ class RepositoryMigrator(MigratorBase):
         return self.catalog.getIndexDataForRID(rid)
 
 
+def _execute_operations(migrator, shard):
+    phase, indexes = shard
+    return migrator.execute_operations(phase, indexes)
+
+
+def _validate_operations(migrator, indexes):
+    return migrator.validate_operations(indexes)
+
+
 class TaskSyncer(object):
 
     def __init__(self, tasks_to_sync):
@@ -1597,6 +2166,13 @@ def main():
                       dest="sync_task", default=False)
     parser.add_option("-n", "--dry-run", action="store_true",
                       dest="dryrun", default=False)
+    parser.add_option("--reindex-batch-size", dest="reindex_batch_size",
+                      type="int", default=500,
+                      help="Number of objects reindexed per commit")
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      default=1,
+                      help="Number of worker processes for the execution "
+                           "of independent branches and the validation")
     (options, args) = parser.parse_args()
 
     if not len(args) == 1:
@@ -1655,7 +2231,21 @@ def main():
         logger.info('\n\nInvalid migration excel, aborting...\n')
         return
 
-    migrator = RepositoryMigrator(analyser.analysed_rows, dry_run=options.dryrun)
+    execution_processes = options.processes
+    if options.sync_task and execution_processes > 1:
+        # Syncing tasks writes to the OGDS, whose connections can't be
+        # shared with forked processes.
+        logger.info("Syncing tasks, executing the operations in the current "
+                    "process.")
+        execution_processes = 1
+
+    migrator = RepositoryMigrator(
+        analyser.analysed_rows, dry_run=options.dryrun,
+        reindex_batch_size=options.reindex_batch_size,
+        reindex_progress_path=os.path.join(
+            options.output_directory, "reindex_progress.json"),
+        validation_processes=options.processes,
+        execution_processes=execution_processes)
 
     logger.info('\n\nstarting migration...\n')
     migrator.run()
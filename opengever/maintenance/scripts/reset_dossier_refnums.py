@@ -1,7 +1,35 @@
+"""
+Resets the reference numbers of dossiers: the dossier mappings of their
+containers are reset, and the dossiers are numbered again in the order they
+were created.
+
+    bin/instance run reset_dossier_refnums.py [--commit]
+
+Without options, all dossiers are reset in a single transaction, the whole
+catalog is reindexed and statistics are written to
+reset_dossier_refnums_statistics.csv. Nothing is committed unless --commit
+is given.
+
+With --path <path> (can be given multiple times) only the containers of the
+dossiers below these paths are reset. With --incremental only containers
+whose dossier mapping is inconsistent (not persistent, dossiers missing or
+with duplicate numbers) are reset, containers that are fine are left alone.
+In both cases the containers are processed in batches of --batch-size and
+every batch is committed. Only the subtrees of dossiers whose number
+changed get their `reference` index and metadata updated, in the catalog
+and with atomic updates in Solr (in update requests of --solr-batch-size
+documents). Since every batch is committed, running it again with
+--incremental only picks up the containers still needing a reset. The
+changed numbers are written to reset_dossier_refnums_changes.csv. The
+selfcheck at the end only checks the dossiers within the containers that
+have been reset. Without --commit, the containers that would be reset are
+only reported.
+"""
 from Acquisition import aq_inner
 from Acquisition import aq_parent
 from contextlib import contextmanager
 from csv import DictWriter
+from ftw.solr.interfaces import ISolrIndexHandler
 from ftw.upgrade.progresslogger import ProgressLogger
 from opengever.base.adapters import CHILD_REF_KEY
 from opengever.base.adapters import DOSSIER_KEY
@@ -10,16 +38,23 @@ from opengever.base.adapters import REPOSITORY_FOLDER_KEY
 from opengever.base.interfaces import IReferenceNumber
 from opengever.base.interfaces import IReferenceNumberPrefix
 from opengever.dossier.behaviors.dossier import IDossierMarker
+from opengever.maintenance.browser.refnum_selfcheck import is_persistent
 from opengever.maintenance.browser.refnum_selfcheck import ReferenceNumberChecker
 from opengever.maintenance.debughelpers import setup_app
+from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.parallel import chunked
+from opengever.maintenance.scripts.solr_batch import DEFAULT_BATCH_SIZE
+from opengever.maintenance.scripts.solr_batch import SolrUpdateBuffer
 from opengever.repository.interfaces import IRepositoryFolder
 from opengever.repository.repositoryroot import IRepositoryRoot
 from persistent.dict import PersistentDict
 from persistent.list import PersistentList
+from plone import api
 from Products.CMFCore.utils import getToolByName
 from zope.annotation.interfaces import IAnnotations
 from zope.app.intid.interfaces import IIntIds
+from zope.component import getMultiAdapter
 from zope.component import getUtility
 import logging
 import os.path
@@ -54,6 +89,11 @@ STATS_CSV_PATH = os.path.abspath(
                  '..', '..', '..', '..',
                  'reset_dossier_refnums_statistics.csv'))
 
+CHANGES_CSV_PATH = os.path.abspath(
+    os.path.join(__file__,
+                 '..', '..', '..', '..',
+                 'reset_dossier_refnums_changes.csv'))
+
 
 BACKUPS_KEY = 'reference_numbers_backups'
 LAST_BACKUP_ID_KEY = 'reference_numbers_last_backup_id'
@@ -85,19 +125,24 @@ class DossierRefnumsResetter(object):
             print 'ABORTING TRANSACTION'
             print 'Reason:', str(exc)
 
-    def fix_repository_storages(self):
-        brains = self.catalog(object_provides=IRepositoryFolder.__identifier__)
+    def fix_repository_storages(self, **query):
+        brains = self.catalog(object_provides=IRepositoryFolder.__identifier__,
+                              **query)
         brains = ProgressLogger('Making repository storages persistent.', brains)
-        objects = tuple(brain.getObject() for brain in brains)
 
-        changes = map(self._make_repo_storages_persistent, objects)
+        made_persistent = put_in_parent_mappings = 0
+        for brain in brains:
+            obj = brain.getObject()
+            if self._make_repo_storages_persistent(obj):
+                made_persistent += 1
+            if self._put_in_parent_mappings(obj):
+                put_in_parent_mappings += 1
+
         print 'Changed refnum storages for {} repository folders.'.format(
-            len(filter(None, changes)))
+            made_persistent)
         print ''
-
-        changes = map(self._put_in_parent_mappings, objects)
         print 'Put folder in parent mappings for {} repository folders.'.format(
-            len(filter(None, changes)))
+            put_in_parent_mappings)
         print ''
 
     def _make_repo_storages_persistent(self, repo_folder):
@@ -184,19 +229,232 @@ class DossierRefnumsResetter(object):
             obj = brain.getObject()
             obj.reindexObject(idxs=['reference'])
 
-    def selfcheck(self):
+    def selfcheck(self, path=None):
         print ''
         print '=' * 30
 
         def print_logger(msg):
             print msg
 
-        checker = ReferenceNumberChecker(print_logger, self.portal)
+        checker = ReferenceNumberChecker(print_logger, self.portal, path=path)
         results = checker.selfcheck()
         if set(results.values()) != {'PASSED'}:
             raise Abort('Selfcheck failed.')
 
 
+class ScopedDossierRefnumsResetter(DossierRefnumsResetter):
+    """Resets the dossier reference numbers below `paths` (by default the
+    whole site), container by container in batches of `batch_size`
+    containers, committing every batch. With `incremental`, only containers
+    whose dossier mapping is inconsistent are reset.
+
+    Only the subtrees of dossiers whose number changed are reindexed, and
+    only the `reference` index and metadata. On dry runs, the containers
+    that would be reset are only reported.
+    """
+
+    def __init__(self, portal, paths=None, incremental=False, batch_size=100,
+                 solr_batch_size=DEFAULT_BATCH_SIZE, dryrun=True):
+        super(ScopedDossierRefnumsResetter, self).__init__(portal)
+        self.paths = [self.get_physical_path(path) for path in paths or []]
+        self.incremental = incremental
+        self.batch_size = batch_size
+        self.dryrun = dryrun
+
+        self.solr_buffer = None
+        solr_enabled = api.portal.get_registry_record(
+            'opengever.base.interfaces.ISearchSettings.use_solr',
+            default=False)
+        if solr_enabled and not dryrun:
+            self.solr_buffer = SolrUpdateBuffer(solr_batch_size)
+
+        self.stats = {'containers': 0, 'reset': 0, 'changed': 0,
+                      'reindexed': 0}
+        self.reset_container_paths = []
+
+    def __call__(self):
+        self.fix_repository_storages(**self.get_scope_query())
+        self.commit()
+
+        self.reset_dossier_refnums()
+        if self.solr_buffer is not None:
+            self.solr_buffer.finish()
+
+        print ''
+        print '{} containers checked, {} reset, {} dossiers renumbered, ' \
+            '{} objects reindexed.'.format(
+                self.stats['containers'], self.stats['reset'],
+                self.stats['changed'], self.stats['reindexed'])
+
+        if not self.reset_container_paths or self.dryrun:
+            # Dry runs don't persist the reset, there is nothing to check
+            return
+
+        # Only check the dossiers within the reset containers
+        try:
+            self.selfcheck(path={'query': self.reset_container_paths,
+                                 'depth': 1})
+        except Abort:
+            print 'WARNING: Selfcheck failed. Batches that have been ' \
+                'committed are not rolled back.'
+
+    def get_physical_path(self, path):
+        site_path = '/'.join(self.portal.getPhysicalPath())
+        path = '/' + path.strip('/')
+        if path == site_path or path.startswith(site_path + '/'):
+            return path
+        return site_path + path
+
+    def get_scope_query(self):
+        if not self.paths:
+            return {}
+        return {'path': self.paths}
+
+    def get_container_paths(self):
+        """Paths of the containers of the dossiers in scope, sorted, so
+        containers are reset before the containers within them.
+        """
+        brains = self.catalog.unrestrictedSearchResults(
+            object_provides=IDossierMarker.__identifier__,
+            **self.get_scope_query())
+        return sorted(set(brain.getPath().rsplit('/', 1)[0]
+                          for brain in brains))
+
+    def get_dossiers(self, container, container_path):
+        """The dossiers directly within `container`, in the order they were
+        created.
+        """
+        brains = self.catalog.unrestrictedSearchResults(
+            object_provides=IDossierMarker.__identifier__,
+            path={'query': container_path, 'depth': 1},
+            sort_on='created')
+
+        dossiers = []
+        for brain in brains:
+            dossier = container._getOb(brain.getPath().split('/')[-1], None)
+            if dossier is None:
+                print 'WARNING: Dossier {} not found.'.format(brain.getPath())
+                continue
+            dossiers.append(dossier)
+        return dossiers
+
+    def reset_dossier_refnums(self):
+        container_paths = self.get_container_paths()
+        msg = 'Resetting dossier reference numbers of {} containers.'.format(
+            len(container_paths))
+        batches = chunked(ProgressLogger(msg, container_paths),
+                          self.batch_size)
+
+        with open(CHANGES_CSV_PATH, 'a') as csvfile:
+            writer = DictWriter(csvfile, fieldnames=[
+                'path', 'before', 'after'])
+            if not csvfile.tell():
+                writer.writeheader()
+
+            for batch in batches:
+                changed_paths = []
+                for container_path in batch:
+                    for row in self.reset_container(container_path):
+                        writer.writerow(make_utf8(row))
+                        changed_paths.append(row['path'])
+
+                self.update_catalog(changed_paths)
+                self.commit()
+
+    def reset_container(self, container_path):
+        """Reset the dossier mapping of a container (if it needs it) and
+        return the dossiers whose number changed.
+        """
+        container = self.portal.unrestrictedTraverse(container_path)
+        dossiers = self.get_dossiers(container, container_path)
+        self.stats['containers'] += 1
+
+        if self.incremental and not self.needs_reset(container, dossiers):
+            return []
+
+        self.stats['reset'] += 1
+        self.reset_container_paths.append(container_path)
+        if self.dryrun:
+            print 'Would reset {} ({} dossiers).'.format(
+                container_path, len(dossiers))
+            return []
+
+        prefix = IReferenceNumberPrefix(container)
+        before = [prefix.get_number(dossier) for dossier in dossiers]
+
+        self.maybe_reset_storage(container)
+        changes = []
+        for dossier, number in zip(dossiers, before):
+            prefix.set_number(dossier)
+            if prefix.get_number(dossier) != number:
+                changes.append({
+                    'path': '/'.join(dossier.getPhysicalPath()),
+                    'before': number,
+                    'after': prefix.get_number(dossier)})
+
+        self.stats['changed'] += len(changes)
+        return changes
+
+    def needs_reset(self, container, dossiers):
+        """Whether the dossier mapping of `container` isn't persistent, or
+        doesn't map all its dossiers to distinct numbers in both directions.
+        Entries of other objects (deleted or moved away dossiers) are fine,
+        they only block their numbers.
+        """
+        storage = IAnnotations(container).get(DOSSIER_KEY)
+        if storage is None:
+            return bool(dossiers)
+        if not is_persistent(storage):
+            return True
+
+        child_mapping = storage.get(CHILD_REF_KEY, {})
+        prefix_mapping = storage.get(PREFIX_REF_KEY, {})
+        numbers = set()
+        for dossier in dossiers:
+            intid = self.intids.queryId(dossier)
+            number = prefix_mapping.get(intid)
+            if intid is None or number is None or number in numbers:
+                return True
+            if child_mapping.get(number) != intid:
+                return True
+            numbers.add(number)
+
+        return False
+
+    def update_catalog(self, dossier_paths):
+        """Update the `reference` index and metadata of the objects within
+        the dossiers whose number changed.
+        """
+        roots = []
+        for path in sorted(dossier_paths):
+            if roots and path.startswith(roots[-1] + '/'):
+                # Already covered by a renumbered parent dossier
+                continue
+            roots.append(path)
+
+        for path in roots:
+            for brain in self.catalog.unrestrictedSearchResults(path=path):
+                obj = brain._unrestrictedGetObject()
+                self.catalog.reindexObject(
+                    obj, idxs=['reference'], update_metadata=1)
+
+                if self.solr_buffer is not None:
+                    handler = getMultiAdapter(
+                        (obj, self.solr_buffer.manager), ISolrIndexHandler)
+                    handler.add(['reference'])
+                    self.solr_buffer.added()
+                self.stats['reindexed'] += 1
+
+        if self.solr_buffer is not None:
+            self.solr_buffer.flush()
+
+    def commit(self):
+        if not self.dryrun:
+            transaction.get().note('reset_dossier_refnums')
+            transaction.commit()
+        self.portal._p_jar.cacheGC()
+
+
 def make_utf8(value):
     if isinstance(value, unicode):
         return value.encode('utf-8')
@@ -310,12 +568,40 @@ class RefnumsStatistics(object):
 
 if __name__ == '__main__':
     app = setup_app()
-    plone = setup_plone(app, [])
 
-    if True:
+    parser = setup_option_parser()
+    parser.add_option("--commit", action="store_true", dest="commit",
+                      default=False,
+                      help="Commit the changes, otherwise it's a dry run")
+    parser.add_option("--path", action="append", dest="paths", default=None,
+                      help="Only reset the dossiers below this path (can be "
+                           "given multiple times)")
+    parser.add_option("--incremental", action="store_true",
+                      dest="incremental", default=False,
+                      help="Only reset containers with an inconsistent "
+                           "dossier mapping")
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+                      default=100,
+                      help="Number of containers per transaction (with "
+                           "--path or --incremental)")
+    parser.add_option("--solr-batch-size", dest="solr_batch_size",
+                      type="int", default=DEFAULT_BATCH_SIZE,
+                      help="Number of documents per Solr update request")
+    (options, args) = parser.parse_args()
+
+    plone = setup_plone(app, options)
+
+    if not options.commit:
         print 'WARNING: transaction dommed because we are in dry-mode.'
         print ''
         transaction.doom()
 
-    DossierRefnumsResetter(plone)()
-    transaction.commit()
+    if options.paths or options.incremental:
+        ScopedDossierRefnumsResetter(
+            plone, paths=options.paths, incremental=options.incremental,
+            batch_size=options.batch_size,
+            solr_batch_size=options.solr_batch_size,
+            dryrun=not options.commit)()
+    else:
+        DossierRefnumsResetter(plone)()
+        transaction.commit()
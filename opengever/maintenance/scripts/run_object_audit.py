@@ -0,0 +1,146 @@
+"""
+Run several full-catalog audits in a single pass over all objects.
+
+    bin/instance run run_object_audit.py [-c <check> [-c <check> ...]] [-n]
+
+Every object is loaded only once and handed to all selected checks. Each check
+writes the same reports as when running its own script. Available checks:
+
+non_persisted_values
+    find_non_persisted_values.py
+
+schema_conformance
+    validate_object_schema_conformance.py (--verbose groups errors by message,
+    --incremental [--state <path>] [--revalidate] to only validate changed
+    objects and write a diff against the previous run)
+
+missing_intids
+    find_objects_with_missing_intids.py
+
+catalog_consistency
+    check_catalog_consistency.py
+
+fix_non_persisted_values
+    fix_non_persisted_values.py (--no-reindex to skip reindexing,
+    --solr-batch-size and --solr-soft-commit-interval). This is the
+    only check that modifies objects. Checks run in the given order, so select
+    it last to have the other checks report the unfixed state.
+
+Without -c, all read-only checks (supporting the chosen source) are run. Unless fix_non_persisted_values is
+selected (and -n is not given), the transaction is doomed.
+
+With --storage, objects are read by walking the ZODB storage instead of
+querying the catalog and traversing to every object (supported by
+non_persisted_values and schema_conformance). Only records of content classes
+are unpickled, use --class <dotted.name> (repeatable) to restrict them further.
+Uncataloged objects are skipped unless --include-uncataloged is given. Note
+that these objects aren't acquisition wrapped, so defaults depending on
+acquisition might not be resolved the same way as in a catalog based run.
+"""
+from opengever.maintenance.debughelpers import setup_app
+from opengever.maintenance.debughelpers import setup_option_parser
+from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.object_audit import ObjectAuditEngine
+from opengever.maintenance.scripts.object_audit import StorageObjectSource
+from plone import api
+import sys
+import transaction
+
+
+READ_ONLY_CHECKS = (
+    'non_persisted_values',
+    'schema_conformance',
+    'missing_intids',
+    'catalog_consistency',
+)
+
+# Read-only checks that support the storage source (--storage)
+STORAGE_CHECKS = (
+    'non_persisted_values',
+    'schema_conformance',
+)
+
+
+def get_checker(name, options):
+    if name == 'non_persisted_values':
+        from opengever.maintenance.scripts.find_non_persisted_values import NonPersistedValueFinder
+        return NonPersistedValueFinder()
+
+    if name == 'schema_conformance':
+        from opengever.maintenance.scripts.validate_object_schema_conformance import SchemaNonConformingObjectsFinder
+        return SchemaNonConformingObjectsFinder(options)
+
+    if name == 'missing_intids':
+        from opengever.maintenance.scripts.find_objects_with_missing_intids import MissingIntIdFinder
+        return MissingIntIdFinder()
+
+    if name == 'catalog_consistency':
+        from opengever.maintenance.scripts.check_catalog_consistency import CatalogConsistencyChecker
+        return CatalogConsistencyChecker()
+
+    if name == 'fix_non_persisted_values':
+        from opengever.maintenance.scripts.fix_non_persisted_values import NonPersistedValueFixer
+        return NonPersistedValueFixer(options)
+
+    raise ValueError('Unknown check %r' % name)
+
+
+def main():
+    app = setup_app()
+
+    parser = setup_option_parser()
+    parser.add_option("-c", "--check", action="append", dest="checks",
+                      default=None)
+    parser.add_option("--no-reindex", action="store_true",
+                      dest="no_reindex", default=False)
+    parser.add_option("-n", "--dry-run", action="store_true",
+                      dest="dryrun", default=False)
+    parser.add_option("--incremental", action="store_true",
+                      dest="incremental", default=False)
+    parser.add_option("--state", dest="state_path", default=None)
+    parser.add_option("--revalidate", action="store_true",
+                      dest="revalidate", default=False)
+    parser.add_option("--solr-batch-size", dest="solr_batch_size",
+                      type="int", default=500)
+    parser.add_option("--solr-soft-commit-interval",
+                      dest="solr_soft_commit_interval", type="int",
+                      default=0)
+    parser.add_option("--storage", action="store_true",
+                      dest="storage", default=False)
+    parser.add_option("--class", action="append", dest="classes",
+                      default=None)
+    parser.add_option("--include-uncataloged", action="store_true",
+                      dest="include_uncataloged", default=False)
+    (options, args) = parser.parse_args()
+
+    checks = options.checks
+    if not checks:
+        checks = STORAGE_CHECKS if options.storage else READ_ONLY_CHECKS
+    modifying = 'fix_non_persisted_values' in checks
+    for name in checks:
+        if name not in READ_ONLY_CHECKS + ('fix_non_persisted_values', ):
+            print "Unknown check %r" % name
+            sys.exit(1)
+
+    plone = setup_plone(app, options)
+
+    if options.dryrun or not modifying:
+        transaction.doom()
+
+    checkers = [get_checker(name, options) for name in checks]
+
+    catalog = api.portal.get_tool('portal_catalog')
+    source = None
+    if options.storage:
+        source = StorageObjectSource(
+            plone, catalog, classes=options.classes,
+            include_uncataloged=options.include_uncataloged)
+
+    ObjectAuditEngine(checkers, catalog, source=source).run()
+
+    if modifying and not options.dryrun:
+        transaction.commit()
+
+
+if __name__ == '__main__':
+    main()
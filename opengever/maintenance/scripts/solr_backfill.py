@@ -0,0 +1,122 @@
+"""
+Engine to (re)index single fields in Solr for all documents matching a query.
+
+Used by `reindex_path_depth_in_solr.py`, `reindex_is_subtask_in_solr.py`
+and `reindex_subject_index_on_solr.py`, which only define the query and the
+fields.
+
+The matching documents are paged through with a cursorMark (see
+solr_batch.py), only fetching their UID and path. The objects of a page are
+looked up through the catalog's UID index (in path order) and the fields
+are sent as atomic updates. Objects that can't be found are skipped and
+reported, they don't show up again in later pages. Updates are sent to Solr
+in bulk and committed according to the commit options (see
+`SolrUpdateBuffer`). They are sent right away, the ZODB transaction is
+doomed since only Solr gets modified.
+"""
+from ftw.solr.interfaces import ISolrIndexHandler
+from opengever.maintenance.parallel import chunked
+from opengever.maintenance.scripts.solr_batch import DEFAULT_BATCH_SIZE
+from opengever.maintenance.scripts.solr_batch import iter_solr_docs
+from opengever.maintenance.scripts.solr_batch import SolrUpdateBuffer
+from plone import api
+from zope.component import getMultiAdapter
+import transaction
+
+
+def add_backfill_options(parser):
+    """Add the options for the backfill engine to an OptionParser.
+    """
+    parser.add_option("-n", "--dry-run", action="store_true",
+                      dest="dryrun", default=False)
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+                      default=DEFAULT_BATCH_SIZE,
+                      help="Number of documents per page and per update "
+                           "request")
+    parser.add_option("--soft-commit-interval", dest="soft_commit_interval",
+                      type="int", default=0,
+                      help="Soft commit every n documents (0 for only one "
+                           "hard commit at the end)")
+
+
+def run_backfill(fields, query, options):
+    """Run the backfill with the options added by `add_backfill_options`.
+    """
+    # Only Solr gets modified
+    transaction.doom()
+
+    SolrFieldBackfill(
+        fields, query=query,
+        batch_size=options.batch_size,
+        soft_commit_interval=options.soft_commit_interval,
+        dryrun=options.dryrun).run()
+
+
+class SolrFieldBackfill(object):
+    """Reindexes `fields` in Solr for all documents matching `query`.
+    """
+
+    def __init__(self, fields, query=u'*:*', filters=None,
+                 batch_size=DEFAULT_BATCH_SIZE, soft_commit_interval=0,
+                 dryrun=False):
+        self.fields = list(fields)
+        self.query = query
+        self.filters = filters
+        self.batch_size = batch_size
+        self.dryrun = dryrun
+
+        self.portal = api.portal.get()
+        self.conn = self.portal._p_jar
+        _catalog = api.portal.get_tool('portal_catalog')._catalog
+        self.uid_index = _catalog.getIndex('UID')._index
+        self.paths = _catalog.paths
+
+        self.buffer = SolrUpdateBuffer(batch_size, soft_commit_interval)
+        self.stats = {'updated': 0, 'not_found': 0}
+
+    def run(self):
+        docs = iter_solr_docs(query=self.query, filters=self.filters,
+                              fields=('UID', 'path'),
+                              batch_size=self.batch_size)
+
+        for page in chunked(docs, self.batch_size):
+            for uid, obj in self.get_objects(page):
+                if obj is None:
+                    print "Object for %s not found, skipping" % uid
+                    self.stats['not_found'] += 1
+                    continue
+
+                self.stats['updated'] += 1
+                if self.dryrun:
+                    continue
+
+                handler = getMultiAdapter(
+                    (obj, self.buffer.manager), ISolrIndexHandler)
+                handler.add(self.fields)
+                self.buffer.added()
+
+            print "Reindexed %s for %s documents (%s not found)" % (
+                ', '.join(self.fields), self.stats['updated'],
+                self.stats['not_found'])
+            self.conn.cacheGC()
+
+        if not self.dryrun:
+            self.buffer.finish()
+
+    def get_objects(self, docs):
+        """Yield (uid, object) for the documents of a page, in path order.
+        """
+        paths = []
+        for doc in docs:
+            rid = self.uid_index.get(str(doc['UID']))
+            if rid is not None:
+                path = self.paths.get(rid)
+            else:
+                path = doc.get('path')
+            paths.append((path, doc['UID']))
+
+        for path, uid in sorted(paths):
+            obj = None
+            if path is not None:
+                obj = self.portal.unrestrictedTraverse(path, None)
+            yield uid, obj
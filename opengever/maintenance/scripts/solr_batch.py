@@ -0,0 +1,108 @@
+"""
+Helpers for scripts that page through all Solr documents or send lots of
+updates to Solr.
+
+`iter_solr_docs` pages through the documents matching a query with a
+cursorMark, sorted by UID (unrestricted, so regardless of what the user
+running the script is allowed to see). Unlike paging with start/rows, this doesn't get
+slower with every page and isn't affected by documents being updated while
+paging (for example by the script itself).
+
+`SolrUpdateBuffer` keeps track of the updates added to the Solr connection.
+Every `batch_size` updates they are sent to Solr in one update request,
+without committing. Updates are sent immediately, independent of the ZODB
+transaction, so they also work with doomed or read-only transactions. Optionally a soft commit is sent every
+`soft_commit_interval` updates, and `finish` sends a single hard commit.
+"""
+from ftw.solr.interfaces import ISolrConnectionManager
+from ftw.solr.interfaces import ISolrSearch
+from zope.component import getUtility
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def iter_solr_docs(query=u'*:*', filters=None, fields=('UID', ),
+                   batch_size=DEFAULT_BATCH_SIZE):
+    """Yield all Solr documents (dicts with `fields`) matching the query,
+    sorted by UID.
+    """
+    solr = getUtility(ISolrSearch)
+    fields = list(fields)
+    if 'UID' not in fields:
+        fields.append('UID')
+
+    cursor = '*'
+    while True:
+        response = solr.unrestricted_search(
+            query=query, filters=filters, rows=batch_size, sort='UID asc',
+            fl=fields, cursorMark=cursor)
+        if not response.is_ok():
+            raise Exception('Solr query failed: %s' % response.error_msg())
+
+        for doc in response.docs:
+            yield doc
+
+        next_cursor = response.body.get('nextCursorMark')
+        if next_cursor is None or next_cursor == cursor:
+            break
+        cursor = next_cursor
+
+
+class SolrUpdateBuffer(object):
+    """Flushes the updates added to the Solr connection in batches and
+    commits according to the configured policy.
+
+    Usage:
+
+        buffer = SolrUpdateBuffer(batch_size=500)
+        for obj in objs:
+            handler = getMultiAdapter((obj, buffer.manager), ISolrIndexHandler)
+            handler.add(['path_depth'])
+            buffer.added()
+        buffer.finish()
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, soft_commit_interval=0):
+        self.manager = getUtility(ISolrConnectionManager)
+        self.batch_size = batch_size
+        self.soft_commit_interval = soft_commit_interval
+
+        self.processed = 0
+        self.buffered = 0
+        self.since_soft_commit = 0
+
+    @property
+    def connection(self):
+        return self.manager.connection
+
+    def added(self, count=1):
+        """Register `count` updates added to the connection.
+        """
+        self.processed += count
+        self.buffered += count
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+
+        self.since_soft_commit += self.buffered
+        self.buffered = 0
+
+        interval = self.soft_commit_interval
+        if interval and self.since_soft_commit >= interval:
+            # Also sends the buffered updates
+            self.connection.commit(soft_commit=True, after_commit=False)
+            self.since_soft_commit = 0
+            print 'Soft commit to solr (%d items processed)' % self.processed
+        else:
+            # Send right away, not in an after commit hook of the ZODB
+            # transaction (which might never commit, or only at the very end)
+            self.connection.flush(after_commit=False)
+
+    def finish(self, soft_commit=False):
+        self.flush()
+        self.connection.commit(soft_commit=soft_commit, after_commit=False)
+        print 'Commit to solr (%d items processed)' % self.processed
@@ -1,5 +1,20 @@
+"""
+Runs a mode of the ftw.solr `solr-maintenance` view.
+
+    bin/instance run solr_maintenance.py <reindex|sync|diff|clear>
+
+    bin/instance run solr_maintenance.py parallel_reindex -p <processes>
+        [--partitions <n>] [--batch-size <n>] [--max-rate <docs/s>]
+        [--idxs <idx1,idx2>] [--restart]
+
+`parallel_reindex` reindexes all cataloged objects with several worker
+processes, see solr_parallel_reindex.py.
+"""
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.solr_parallel_reindex import DEFAULT_BATCH_SIZE
+from opengever.maintenance.scripts.solr_parallel_reindex import DEFAULT_PARTITIONS
+from opengever.maintenance.scripts.solr_parallel_reindex import ParallelSolrReindex
 from StringIO import StringIO
 from zope.component import queryMultiAdapter
 import argparse
@@ -15,10 +30,29 @@ for handler in logging.getLogger().handlers:
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('mode', choices=['reindex', 'sync', 'diff', 'clear'],
+    parser.add_argument('mode', choices=['reindex', 'sync', 'diff', 'clear',
+                                         'parallel_reindex'],
                         help='solr-maintenance mode')
     parser.add_argument('-s', dest='site_root', default=None,
                         help='Absolute path to the Plone site')
+    parser.add_argument('-p', dest='processes', type=int, default=1,
+                        help='Number of worker processes (parallel_reindex)')
+    parser.add_argument('--partitions', dest='partitions', type=int,
+                        default=DEFAULT_PARTITIONS,
+                        help='Number of UID ranges (parallel_reindex)')
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help='Documents per update request (parallel_reindex)')
+    parser.add_argument('--max-rate', dest='max_rate', type=float, default=0,
+                        help='Maximum documents per second and worker '
+                             '(parallel_reindex)')
+    parser.add_argument('--idxs', dest='idxs', default=None,
+                        help='Comma separated fields to reindex, all if not '
+                             'given (parallel_reindex)')
+    parser.add_argument('--restart', dest='restart', action='store_true',
+                        default=False,
+                        help='Ignore the progress of an interrupted run '
+                             '(parallel_reindex)')
     options = parser.parse_args(sys.argv[3:])
     app = setup_app()
 
@@ -28,9 +62,17 @@ def main():
     logger.info('Start solr maintenance mode `{}`'.format(options.mode))
     solr_maintenance = queryMultiAdapter(
         (portal, portal.REQUEST), name=u'solr-maintenance')
-    getattr(solr_maintenance, options.mode)()
 
-    if options.mode in ['reindex', 'sync']:
+    if options.mode == 'parallel_reindex':
+        idxs = options.idxs.split(',') if options.idxs else None
+        ParallelSolrReindex(
+            portal, options.processes, partitions=options.partitions,
+            batch_size=options.batch_size, max_rate=options.max_rate,
+            idxs=idxs, restart=options.restart).run()
+    else:
+        getattr(solr_maintenance, options.mode)()
+
+    if options.mode in ['reindex', 'sync', 'parallel_reindex']:
         solr_maintenance.optimize()
 
 
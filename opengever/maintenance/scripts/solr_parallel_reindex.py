@@ -0,0 +1,219 @@
+"""
+Parallel full reindex of all cataloged objects in Solr.
+
+Used by `solr_maintenance.py parallel_reindex`. The catalog's UID index is
+partitioned into UID ranges, and the partitions are reindexed by worker
+processes with their own ZODB connections (see
+opengever.maintenance.parallel). Every worker extracts the Solr documents
+of its objects (including SearchableText) and sends them to Solr in bulk
+update requests of --batch-size documents. The workers are read-only and
+never commit, so the updates are sent right away and not when the ZODB
+transaction commits (see solr_batch.py). These requests are synchronous,
+so a worker waits for Solr to accept a batch before preparing the next one.
+With --max-rate the number of documents a worker sends per second is
+limited additionally. A worker soft commits at the end of each partition,
+and the whole run ends with a single hard commit.
+
+Finished partitions are recorded in a progress file. If a run gets
+interrupted, running it again with the same arguments skips the partitions
+that are already done (use --restart to start over).
+"""
+from datetime import datetime
+from ftw.solr.interfaces import ISolrConnectionManager
+from ftw.solr.interfaces import ISolrIndexHandler
+from opengever.maintenance.parallel import WorkerPool
+from opengever.maintenance.scripts.solr_batch import SolrUpdateBuffer
+from opengever.maintenance.utils import LogFilePathFinder
+from plone import api
+from zope.component import getMultiAdapter
+from zope.component import getUtility
+import json
+import os
+import time
+
+
+DEFAULT_PARTITIONS = 256
+DEFAULT_BATCH_SIZE = 200
+
+# Number of hex digits of the partition boundaries
+BOUNDARY_DIGITS = 4
+
+
+def get_partitions(count):
+    """Split the UID space (UIDs are hex strings) into `count` ranges.
+    Returns (number, min, max) tuples, max is exclusive. The first and last
+    range are open, so they also cover UIDs that aren't hex.
+    """
+    space = 16 ** BOUNDARY_DIGITS
+    boundaries = ['%0*x' % (BOUNDARY_DIGITS, i * space // count)
+                  for i in range(count)]
+    partitions = []
+    for number in range(count):
+        low = boundaries[number] if number > 0 else None
+        high = boundaries[number + 1] if number + 1 < count else None
+        partitions.append((number, low, high))
+    return partitions
+
+
+class ReindexProgress(object):
+    """Persists the numbers of the finished partitions in a JSON file.
+    """
+
+    def __init__(self, path, job):
+        self.path = path
+        self.job = job
+        self.done = set()
+        self.indexed = 0
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path) as progress_file:
+            data = json.load(progress_file)
+
+        if data.get('job') != self.job:
+            raise Exception(
+                "Progress file %s belongs to a different job (%r), use "
+                "--restart." % (self.path, data.get('job')))
+        self.done = set(data['done'])
+        self.indexed = data['indexed']
+
+    def partition_done(self, number, indexed):
+        self.done.add(number)
+        self.indexed += indexed
+
+        data = {'job': self.job,
+                'done': sorted(self.done),
+                'indexed': self.indexed,
+                'updated': datetime.now().isoformat()}
+
+        # Write and rename, so an interrupted write never corrupts the file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as progress_file:
+            json.dump(data, progress_file)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class PartitionReindexer(object):
+    """Reindexes the objects of UID partitions in Solr, in a worker process.
+    """
+
+    def __init__(self, site, idxs, batch_size, max_rate):
+        self.site = site
+        self.idxs = idxs
+        self.max_rate = max_rate
+        self.buffer = SolrUpdateBuffer(batch_size)
+
+        _catalog = api.portal.get_tool('portal_catalog')._catalog
+        self.uid_index = _catalog.getIndex('UID')._index
+        self.paths = _catalog.paths
+
+    def reindex_partition(self, partition):
+        number, low, high = partition
+        start = time.time()
+
+        if high is None:
+            items = self.uid_index.items(min=low)
+        else:
+            items = self.uid_index.items(min=low, max=high, excludemax=True)
+        paths = sorted(filter(None, [self.paths.get(rid) for uid, rid in items]))
+
+        result = {'partition': number, 'indexed': 0, 'errors': []}
+        for path in paths:
+            obj = self.site.unrestrictedTraverse(path, None)
+            if obj is None:
+                result['errors'].append((path, 'Object not found'))
+                continue
+
+            try:
+                handler = getMultiAdapter(
+                    (obj, self.buffer.manager), ISolrIndexHandler)
+                handler.add(self.idxs)
+            except Exception as exc:
+                result['errors'].append((path, repr(exc)))
+                continue
+
+            self.buffer.added()
+            result['indexed'] += 1
+            self.throttle(result['indexed'], time.time() - start)
+
+        # Sends the remaining adds and extract commands, a partition is only
+        # recorded as done once Solr has all of its documents.
+        self.buffer.finish(soft_commit=True)
+        self.site._p_jar.cacheGC()
+        return result
+
+    def throttle(self, count, elapsed):
+        if not self.max_rate:
+            return
+
+        min_duration = count / self.max_rate
+        if elapsed < min_duration:
+            time.sleep(min_duration - elapsed)
+
+
+class ParallelSolrReindex(object):
+
+    def __init__(self, portal, processes, partitions=DEFAULT_PARTITIONS,
+                 batch_size=DEFAULT_BATCH_SIZE, max_rate=0, idxs=None,
+                 restart=False):
+        self.portal = portal
+        self.processes = processes
+        self.partitions = partitions
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.idxs = idxs
+
+        job = 'partitions=%s idxs=%s' % (partitions, ','.join(idxs or []))
+        path = LogFilePathFinder().get_logfile_path(
+            'solr-parallel-reindex-progress', add_timestamp=False,
+            extension='json')
+        self.progress = ReindexProgress(path, job)
+        if restart:
+            self.progress.clear()
+        self.progress.load()
+
+    def setup_worker(self, site):
+        return PartitionReindexer(
+            site, self.idxs, self.batch_size, self.max_rate)
+
+    def run(self):
+        partitions = [partition for partition in get_partitions(self.partitions)
+                      if partition[0] not in self.progress.done]
+        if len(partitions) < self.partitions:
+            print "Resuming, %s of %s partitions already done" % (
+                self.partitions - len(partitions), self.partitions)
+
+        start = time.time()
+        indexed_at_start = self.progress.indexed
+        pool = WorkerPool(self.portal, self.processes, self.setup_worker,
+                          _reindex_partition)
+
+        # Partitions are small work units (UID ranges), imap hands them out
+        # to the workers as they become idle.
+        for result in pool.imap(partitions):
+            for path, error in result['errors']:
+                print "Failed to index %s: %s" % (path, error)
+
+            self.progress.partition_done(result['partition'], result['indexed'])
+
+            elapsed = time.time() - start
+            rate = (self.progress.indexed - indexed_at_start) / max(elapsed, 1)
+            ts = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+            print "{} {}/{} partitions done, {} objects indexed ({:.1f}/s)".format(
+                ts, len(self.progress.done), self.partitions,
+                self.progress.indexed, rate)
+
+        manager = getUtility(ISolrConnectionManager)
+        manager.connection.commit(soft_commit=False, after_commit=False)
+        self.progress.clear()
+        print "Done, %s objects indexed." % self.progress.indexed
+
+
+def _reindex_partition(worker, partition):
+    return worker.reindex_partition(partition)
@@ -1,19 +1,28 @@
 from App.config import getConfiguration
+from BTrees.OOBTree import OOBTree
 from collections import Counter
 from collections import defaultdict
 from datetime import datetime
 from opengever.maintenance.debughelpers import setup_app
 from opengever.maintenance.debughelpers import setup_option_parser
 from opengever.maintenance.debughelpers import setup_plone
+from opengever.maintenance.scripts.object_audit import AuditChecker
+from opengever.maintenance.scripts.object_audit import get_wrapped
+from opengever.maintenance.scripts.object_audit import ObjectAuditEngine
 from opengever.maintenance.utils import TextTable
+from persistent import Persistent
 from plone import api
 from plone.dexterity.utils import iterSchemataForType
+from plone.uuid.interfaces import IUUID
 from zope.component import getUtility
 from zope.intid.interfaces import IIntIds
 from zope.schema import getFieldsInOrder
 from zope.schema.interfaces import ValidationError
+import hashlib
+import json
 import logging
 import os
+import sqlite3
 import transaction
 import sys
 
@@ -29,14 +38,149 @@ Options:
             This only affects logging and will likely produce too much output on large
             installations. The full error message is always saved in the CSV report.
 
+--incremental : keep the results in a SQLite state file (--state, by default
+            var/log/schema-conformance-state.sqlite) and only validate objects that
+            changed since the last run (based on the serials of the object and its
+            annotations, and on the schemas of its type). Results of unchanged objects
+            are taken from the state file, so the reports are still complete. Also
+            writes a diff CSV listing every violation as new, fixed or persisting
+            compared to the previous run. Use --revalidate to validate all objects
+            anyway (e.g. after changing vocabularies or validators).
+            This only saves the validation itself: every object is still loaded
+            (the objects are traversed from the catalog), and reading the serials
+            loads its annotations and their BTree buckets too.
+
 This script logs a detailed CSV report and a summary to var/log/, and displays
 some progress info and stats on STDERR/STDOUT.
 """
 
 
-class SchemaNonConformingObjectsFinder(object):
+VIOLATION_KINDS = ('missing', 'invalid', 'failed')
+
+
+def get_serials(obj):
+    """Yield the serials of an object and of its annotations (fields of
+    behaviors with annotation storage are persisted there, not on the object).
+    """
+    obj._p_activate()
+    yield obj._p_serial
+
+    annotations = obj.__dict__.get('__annotations__')
+    if isinstance(annotations, OOBTree):
+        for serial in get_btree_serials(annotations):
+            yield serial
+    elif isinstance(annotations, Persistent):
+        annotations._p_activate()
+        yield annotations._p_serial
+
+
+def get_btree_serials(btree):
+    btree._p_activate()
+    yield btree._p_serial
+
+    state = btree.__getstate__()
+    if state is None or len(state) == 1:
+        # Empty, or a single bucket embedded in the tree's record
+        return
+
+    # ((child, key, child, ..., child), first bucket), where the children
+    # are either buckets or trees
+    for child in state[0][::2]:
+        if isinstance(child, type(btree)):
+            for serial in get_btree_serials(child):
+                yield serial
+        else:
+            child._p_activate()
+            yield child._p_serial
+
+
+class ConformanceState(object):
+    """Validation results of the previous run(s), keyed by UID, in a SQLite
+    database.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS results (
+            uid TEXT PRIMARY KEY,
+            serial TEXT,
+            fingerprint TEXT,
+            portal_type TEXT,
+            path TEXT,
+            csv_row TEXT,
+            violations TEXT,
+            run INTEGER
+        )
+    """
+
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute(self.SCHEMA)
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS results_run ON results (run)")
+        previous = self.db.execute("SELECT MAX(run) FROM results").fetchone()[0]
+        self.run = (previous or 0) + 1
+        self.pending = 0
+
+    def get(self, uid):
+        row = self.db.execute(
+            "SELECT serial, fingerprint, portal_type, path, csv_row, "
+            "violations FROM results WHERE uid = ?", (uid, )).fetchone()
+        if row is None:
+            return None
+
+        serial, fingerprint, portal_type, path, csv_row, violations = row
+        return {'serial': serial,
+                'fingerprint': fingerprint,
+                'portal_type': portal_type,
+                'path': path,
+                'csv_row': csv_row,
+                'violations': json.loads(violations)}
+
+    def put(self, uid, serial, fingerprint, portal_type, path, csv_row,
+            violations):
+        self.db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (uid, serial, fingerprint, portal_type, path, csv_row,
+             json.dumps(violations), self.run))
+        self.maybe_commit()
+
+    def touch(self, uid):
+        self.db.execute(
+            "UPDATE results SET run = ? WHERE uid = ?", (self.run, uid))
+        self.maybe_commit()
+
+    def maybe_commit(self):
+        self.pending += 1
+        if self.pending >= self.COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending = 0
+
+    def pop_removed(self):
+        """Remove and return the results of objects that weren't seen in
+        this run.
+        """
+        rows = self.db.execute(
+            "SELECT uid, portal_type, path, violations FROM results "
+            "WHERE run < ?", (self.run, )).fetchall()
+        self.db.execute("DELETE FROM results WHERE run < ?", (self.run, ))
+        return [(uid, portal_type, path, json.loads(violations))
+                for uid, portal_type, path, violations in rows]
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class SchemaNonConformingObjectsFinder(AuditChecker):
+
+    name = 'schema_conformance'
+    supports_storage_source = True
 
     CSV_HEADER = "intid;portal_type;path;created;missing_fields;invalid_fields;failed_fields"
+    DIFF_CSV_HEADER = "status;uid;portal_type;path;kind;field;error"
     SCHEMA_CACHE = {}
     FIELD_CACHE = {}
 
@@ -59,40 +203,152 @@ class SchemaNonConformingObjectsFinder(object):
         self.summary_log_path = self.get_logfile_path(
             'find-nonconforming-objects-summary-%s.log' % ts)
 
-        if options.verbose:
-            self.error_repr = self.verbose_error_repr
-        else:
-            self.error_repr = self.non_verbose_error_repr
-
-    @staticmethod
-    def verbose_error_repr(err):
-        return repr(err)
-
-    @staticmethod
-    def non_verbose_error_repr(err):
-        return str(type(err))
+        self.verbose = options.verbose
+
+        self.state = None
+        self.revalidate = options.revalidate
+        self.state_path = None
+        self.diff_log_path = None
+        self.fingerprints = {}
+        if options.incremental:
+            self.state_path = options.state_path or self.get_logfile_path(
+                'schema-conformance-state.sqlite')
+            self.diff_log_path = self.get_logfile_path(
+                'find-nonconforming-objects-diff-%s.csv' % ts)
+            self.stats['diff'] = Counter()
+            self.stats['incremental'] = Counter()
 
     def run(self):
+        ObjectAuditEngine([self], self.catalog).run()
+
+    def start(self):
         sys.stderr.write("Checking for object not conforming to schema...\n\n")
 
-        all_brains = self.catalog.unrestrictedSearchResults()
-        total = len(all_brains)
-        object_generator = (brain.getObject() for brain in all_brains)
+        self.csv_log = open(self.csv_log_path, 'w')
+        self.summary_log = open(self.summary_log_path, 'w')
+        self.csv_log.write(self.CSV_HEADER + '\n')
 
-        with open(self.csv_log_path, 'w') as self.csv_log:
-            with open(self.summary_log_path, 'w') as self.summary_log:
-                self.csv_log.write(self.CSV_HEADER + '\n')
+        if self.state_path:
+            self.state = ConformanceState(self.state_path)
+            self.diff_log = open(self.diff_log_path, 'w')
+            self.diff_log.write(self.DIFF_CSV_HEADER + '\n')
 
-                for i, obj in enumerate(object_generator):
-                    missing_fields, invalid_fields, failed = self.validate_schema_conformance(obj)
-                    self.update_stats(obj, missing_fields, invalid_fields, failed)
+    def check(self, obj, brain):
+        portal_type = obj.portal_type
+        if self.state is None:
+            violations, csv_row = self.validate(obj, brain)
+            self.report(portal_type, violations, csv_row)
+            return
+
+        uid = IUUID(obj, None)
+        serial = max(get_serials(obj)).encode('hex')
+        fingerprint = self.get_fingerprint(portal_type)
+
+        previous = self.state.get(uid) if uid is not None else None
+        if (previous is not None and not self.revalidate
+                and previous['serial'] == serial
+                and previous['fingerprint'] == fingerprint):
+            self.stats['incremental']['unchanged'] += 1
+            violations = previous['violations']
+            self.report(portal_type, violations, previous['csv_row'])
+            self.write_diff(uid, portal_type, previous['path'],
+                            violations, violations)
+            self.state.touch(uid)
+            return
+
+        self.stats['incremental']['validated'] += 1
+        violations, csv_row = self.validate(obj, brain)
+        self.report(portal_type, violations, csv_row)
 
-                    if missing_fields or invalid_fields or failed:
-                        self.write_csv_row(obj, missing_fields, invalid_fields, failed)
+        if uid is None:
+            return
+
+        path = brain.getPath()
+        previous_violations = previous['violations'] if previous else {}
+        self.write_diff(uid, portal_type, path, previous_violations, violations)
+        self.state.put(uid, serial, fingerprint, portal_type, path, csv_row,
+                       violations)
 
-                    if i % 100 == 0:
-                        sys.stderr.write("Progress: %s of %s objects\n" % (i, total))
-                self.display_stats()
+    def validate(self, obj, brain):
+        """Validate the object and return its violations and its CSV row
+        (None if there are no violations).
+        """
+        missing_fields, invalid_fields, failed = self.validate_schema_conformance(obj)
+        violations = {
+            'missing': self.serialize_errors(missing_fields),
+            'invalid': self.serialize_errors(invalid_fields),
+            'failed': self.serialize_errors(failed),
+        }
+
+        csv_row = None
+        if missing_fields or invalid_fields or failed:
+            csv_row = self.format_csv_row(
+                get_wrapped(obj, brain), missing_fields, invalid_fields, failed)
+        return violations, csv_row
+
+    def report(self, portal_type, violations, csv_row):
+        self.update_stats(portal_type, violations)
+        if csv_row is not None:
+            self.csv_log.write(csv_row + '\n')
+
+    @staticmethod
+    def serialize_errors(errors):
+        """(field, err) => [field, error type, error repr]
+        """
+        return [[field, str(type(err)), repr(err)] for field, err in errors]
+
+    def get_fingerprint(self, portal_type):
+        """Hash of the schemas and fields of a portal_type, so objects get
+        revalidated when the schemas change.
+        """
+        if portal_type not in self.fingerprints:
+            fields = []
+            for schema in iterSchemataForType(portal_type):
+                fields.append(schema.__identifier__)
+                fields.extend(name for name, field in getFieldsInOrder(schema))
+            self.fingerprints[portal_type] = hashlib.md5(
+                '\n'.join(fields)).hexdigest()
+        return self.fingerprints[portal_type]
+
+    def write_diff(self, uid, portal_type, path, previous, current):
+        """Write the violations of an object as new, fixed or persisting
+        compared to the previous run.
+        """
+        def by_key(violations):
+            return {(kind, field): error
+                    for kind in VIOLATION_KINDS
+                    for field, error_type, error in violations.get(kind, [])}
+
+        previous = by_key(previous)
+        current = by_key(current)
+
+        rows = []
+        for key in sorted(set(previous) | set(current)):
+            if key not in previous:
+                rows.append(('new', key, current[key]))
+            elif key not in current:
+                rows.append(('fixed', key, previous[key]))
+            else:
+                rows.append(('persisting', key, current[key]))
+
+        for status, (kind, field), error in rows:
+            self.stats['diff'][status] += 1
+            row = (status, uid, portal_type, path or '', kind, field, error)
+            self.diff_log.write(';'.join(row) + '\n')
+
+    def finish(self):
+        if self.state is not None:
+            # Objects not reached by an aborted run haven't been removed
+            if self.completed:
+                for uid, portal_type, path, violations in self.state.pop_removed():
+                    self.stats['incremental']['removed'] += 1
+                    self.write_diff(uid, portal_type, path, violations, {})
+            self.state.close()
+            self.diff_log.close()
+
+        self.display_stats()
+        self.summary_log.close()
+        self.csv_log.close()
 
     def validate_schema_conformance(self, obj):
         missing_fields = []
@@ -143,7 +399,7 @@ class SchemaNonConformingObjectsFinder(object):
     def get_portal_type_label(portal_type):
         return ".".join(portal_type.split(".")[-2:])
 
-    def write_csv_row(self, obj, missing_fields, invalid_fields, failed):
+    def format_csv_row(self, obj, missing_fields, invalid_fields, failed):
         created = str(obj.created())
         intid = self.intids.queryId(obj)
         row = (str(intid),
@@ -153,12 +409,10 @@ class SchemaNonConformingObjectsFinder(object):
                str(missing_fields),
                str(invalid_fields),
                str(failed),)
-        self.csv_log.write(';'.join(row) + '\n')
+        return ';'.join(row)
 
-    def update_stats(self, obj, missing_fields, invalid_fields, failed):
-        portal_type = obj.portal_type
-
-        if not (missing_fields or invalid_fields or failed):
+    def update_stats(self, portal_type, violations):
+        if not any(violations.values()):
             self.stats['global']['conforming'] += 1
             self.stats['per_portal_type'][portal_type]['conforming'] += 1
             return
@@ -166,17 +420,14 @@ class SchemaNonConformingObjectsFinder(object):
         self.stats['global']['non_conforming'] += 1
         self.stats['per_portal_type'][portal_type]['non_conforming'] += 1
 
-        for field, err in missing_fields:
-            self.stats[portal_type][field]["missing"] += 1
-            self.stats[portal_type][field][self.error_repr(err)] += 1
-
-        for field, err in invalid_fields:
-            self.stats[portal_type][field]["invalid"] += 1
-            self.stats[portal_type][field][self.error_repr(err)] += 1
-
-        for field, err in failed:
-            self.stats[portal_type][field]["failed"] += 1
-            self.stats[portal_type][field][self.error_repr(err)] += 1
+        # Errors are grouped by message in verbose mode, else by class
+        for kind in VIOLATION_KINDS:
+            for field, error_type, error in violations[kind]:
+                self.stats[portal_type][field][kind] += 1
+                if self.verbose:
+                    self.stats[portal_type][field][error] += 1
+                else:
+                    self.stats[portal_type][field][error_type] += 1
 
     def display_stats(self):
 
@@ -222,7 +473,7 @@ class SchemaNonConformingObjectsFinder(object):
 
         log("\n\n")
         for portal_type in sorted(self.stats):
-            if portal_type in ("global", "per_portal_type"):
+            if portal_type in ("global", "per_portal_type", "diff", "incremental"):
                 continue
             log("\n\n")
             log("{:=>134}\n".format(""))
@@ -248,6 +499,18 @@ class SchemaNonConformingObjectsFinder(object):
 
         log("\n")
 
+        if self.state_path:
+            incremental = self.stats['incremental']
+            diff = self.stats['diff']
+            log("Objects validated: %s, unchanged: %s, removed: %s\n" % (
+                incremental['validated'], incremental['unchanged'],
+                incremental['removed']))
+            log("Violations new: %s, fixed: %s, persisting: %s\n" % (
+                diff['new'], diff['fixed'], diff['persisting']))
+            log("\n")
+            log("Diff CSV report written to %s\n" % self.diff_log_path)
+            log("State written to %s\n" % self.state_path)
+
         log("Detailed CSV report written to %s\n" % self.csv_log_path)
         log("Summary written to %s\n" % self.summary_log_path)
 
@@ -282,6 +545,16 @@ if __name__ == '__main__':
     app = setup_app()
 
     parser = setup_option_parser()
+    parser.add_option("--incremental", action="store_true",
+                      dest="incremental", default=False,
+                      help="Only validate objects changed since the last run. "
+                           "All objects and their annotations are still "
+                           "loaded to compare their serials.")
+    parser.add_option("--state", dest="state_path", default=None,
+                      help="Path of the SQLite state file (--incremental)")
+    parser.add_option("--revalidate", action="store_true",
+                      dest="revalidate", default=False,
+                      help="Validate unchanged objects too (--incremental)")
     (options, args) = parser.parse_args()
 
     plone = setup_plone(app, options)
@@ -0,0 +1,115 @@
+from ftw.solr.interfaces import ISolrConnectionManager
+from ftw.solr.interfaces import ISolrSearch
+from opengever.maintenance.scripts.diff_catalog_solr import CatalogSolrDiffer
+from opengever.maintenance.testing import OG_MAINTENANCE_INTEGRATION
+from plone import api
+from zope.component import getGlobalSiteManager
+from zope.component import provideUtility
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+
+class FakeSolrConnection(object):
+    """Records the commands that actually reach Solr. Like ftw.solr's
+    connection, commands flushed with `after_commit` are only sent when the
+    ZODB transaction commits.
+    """
+
+    def __init__(self):
+        self.update_commands = []
+        self.deferred = []
+        self.sent = []
+
+    def add(self, data):
+        self.update_commands.append(('add', data))
+
+    def delete(self, uid):
+        self.update_commands.append(('delete', uid))
+
+    def flush(self, after_commit=True):
+        commands, self.update_commands = self.update_commands, []
+        if after_commit:
+            self.deferred.extend(commands)
+        else:
+            self.sent.extend(commands)
+
+    def commit(self, soft_commit=False, after_commit=True):
+        self.flush(after_commit=after_commit)
+        if not after_commit:
+            self.sent.append(('commit', soft_commit))
+
+
+class FakeSolrConnectionManager(object):
+
+    def __init__(self):
+        self.connection = FakeSolrConnection()
+
+
+class FakeSolrResponse(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.body = {'nextCursorMark': '*'}
+
+    def is_ok(self):
+        return True
+
+
+class FakeSolrSearch(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def unrestricted_search(self, **params):
+        return FakeSolrResponse(self.docs)
+
+
+class TestCatalogSolrDifferRepair(unittest.TestCase):
+
+    layer = OG_MAINTENANCE_INTEGRATION
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.manager = FakeSolrConnectionManager()
+        provideUtility(self.manager, ISolrConnectionManager)
+
+        # Solr is in sync with the catalog, except for an orphaned document
+        _catalog = api.portal.get_tool('portal_catalog')._catalog
+        docs = [{'UID': uid, 'path': _catalog.paths[rid]}
+                for uid, rid in _catalog.getIndex('UID')._index.items()]
+        docs.append({'UID': 'z' * 32, 'path': '/plone/gone'})
+        self.search = FakeSolrSearch(docs)
+        provideUtility(self.search, ISolrSearch)
+
+    def tearDown(self):
+        gsm = getGlobalSiteManager()
+        gsm.unregisterUtility(self.manager, provided=ISolrConnectionManager)
+        gsm.unregisterUtility(self.search, provided=ISolrSearch)
+        shutil.rmtree(self.tempdir)
+
+    def run_differ(self, **kwargs):
+        differ = CatalogSolrDiffer(
+            fields=('path', ),
+            output_path=os.path.join(self.tempdir, 'diff.jsonl'),
+            **kwargs)
+        differ.run()
+        return differ
+
+    def test_repair_sends_updates_to_solr_in_a_doomed_transaction(self):
+        transaction.doom()
+        differ = self.run_differ(repair=True)
+
+        self.assertEqual(1, differ.stats['orphaned'])
+        self.assertEqual([('delete', 'z' * 32), ('commit', False)],
+                         self.manager.connection.sent)
+        self.assertEqual([], self.manager.connection.deferred)
+
+    def test_dry_run_does_not_change_solr(self):
+        differ = self.run_differ(repair=True, dryrun=True)
+
+        self.assertEqual(1, differ.stats['orphaned'])
+        self.assertEqual([], self.manager.connection.sent)
+        self.assertEqual([], self.manager.connection.deferred)
@@ -0,0 +1,55 @@
+from opengever.maintenance.scripts.repository_migration import ExecutionPlan
+from opengever.maintenance.scripts.repository_migration import RepositoryPosition
+import unittest
+
+
+class FakeMigrator(object):
+
+    def __init__(self, operations):
+        self.operations_list = operations
+
+
+def operation(old_position, new_position, need_creation=False,
+              need_move=False, need_merge=False, new_number=None):
+    return {'old_repo_pos': RepositoryPosition(old_position),
+            'new_repo_pos': RepositoryPosition(new_position),
+            'need_creation': need_creation,
+            'need_move': need_move,
+            'need_merge': need_merge,
+            'new_number': new_number}
+
+
+class TestExecutionPlanGroups(unittest.TestCase):
+
+    def get_groups(self, operations):
+        return ExecutionPlan(FakeMigrator(operations), 2).groups
+
+    def test_unchanged_top_level_positions_keep_branches_independent(self):
+        # A complete mapping has a row for every existing position
+        operations = [
+            operation('1', '1'),
+            operation('2', '2'),
+            operation('3', '3'),
+            operation('11', '12', new_number='2'),
+            operation('21', '22', new_number='2'),
+            operation('31', '32', new_number='2'),
+        ]
+        self.assertEqual([[0, 3], [1, 4], [2, 5]], self.get_groups(operations))
+
+    def test_operations_changing_the_root_depend_on_each_other(self):
+        operations = [
+            operation('1', '1'),
+            operation('2', '3', new_number='3'),
+            operation(None, '4', need_creation=True),
+            operation('11', '12', new_number='2'),
+        ]
+        self.assertEqual([[0, 3], [1, 2]], self.get_groups(operations))
+
+    def test_move_between_branches_joins_them(self):
+        operations = [
+            operation('1', '1'),
+            operation('2', '2'),
+            operation('11', '21', need_move=True, new_number='1'),
+            operation('3', '3'),
+        ]
+        self.assertEqual([[0, 1, 2], [3]], self.get_groups(operations))